@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+This script benchmarks diann_convert.py on synthetic DIA-NN experiments of several scales, recording the
+time of each conversion stage, the end-to-end wall and CPU time and the memory high-water mark of the
+conversion. Results are saved as JSON, with the commit they were measured at, and two result files can
+be compared to find regressions between commits.
+License: Apache 2.0
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+import click
+
+from synthetic_diann import SyntheticExperiment
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+REPO_DIR = Path(__file__).resolve().parent.parent
+DIANN_CONVERT = REPO_DIR / "bin" / "diann_convert.py"
+# Scales as runs x precursors
+DEFAULT_SCALES = ("4x5000", "12x20000", "24x50000")
+DIA_PARAMS = "20;ppm;10;ppm;Trypsin;Carbamidomethyl (C);Oxidation (M)"
+# A stage is reported as a regression when its median time grows by more than this ratio
+REGRESSION_RATIO = 1.10
+# Stages faster than this, in seconds, are too noisy to be compared
+MIN_COMPARED_TIME = 0.05
+
+logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def cli():
+    pass
+
+
+@click.command("run")
+@click.option("--scales", "-s", multiple=True, default=DEFAULT_SCALES, show_default=True, help="runs x precursors")
+@click.option("--repeats", "-n", type=int, default=3, show_default=True)
+@click.option("--workdir", "-w", default="benchmark_work", show_default=True, help="Cache of the generated data")
+@click.option("--out", "-o", default="benchmark_diann_convert.json", show_default=True)
+@click.option("--script", default=str(DIANN_CONVERT), show_default=True, help="diann_convert.py to benchmark")
+@click.option("--protein_group_size", type=int, default=2, show_default=True)
+@click.option("--study_variables", type=int, default=3, show_default=True)
+@click.option("--table_format", default="text", show_default=True)
+def run(scales, repeats, workdir, out, script, protein_group_size, study_variables, table_format):
+    """
+    Benchmark the ``convert`` command at several scales.
+
+    The synthetic experiments are generated once in ``workdir`` and reused by later runs with the
+    same parameters. Every conversion runs in its own process, so its memory high-water mark is
+    measured alone; the stage times are read from the metrics file diann_convert.py writes.
+
+    :param scales: Sizes of the experiments, as "<runs>x<precursors>"
+    :type scales: list
+    :param repeats: Number of conversions of each experiment, the medians of which are reported
+    :type repeats: int
+    :param script: Path to the diann_convert.py to benchmark, e.g. of another checkout
+    :type script: str
+    """
+    results = {"environment": environment(Path(script)), "scales": []}
+    for scale in scales:
+        runs, precursors = (int(n) for n in scale.lower().split("x"))
+        experiment = SyntheticExperiment(
+            runs=runs,
+            precursors=precursors,
+            protein_group_size=protein_group_size,
+            study_variables=study_variables,
+        )
+        folder = synthetic_folder(Path(workdir), experiment)
+        logger.info(f"Benchmarking scale {scale}: {repeats} conversions")
+        measures = [convert(Path(script), folder, Path(workdir) / "out", table_format) for _ in range(repeats)]
+        results["scales"].append(
+            {
+                "scale": scale,
+                "experiment": asdict(experiment),
+                "table_format": table_format,
+                "report_rows": json.loads((folder / "synthetic.json").read_text())["report_rows"],
+                "measures": measures,
+                "median": median_measure(measures),
+            }
+        )
+        logger.info(f"Scale {scale}: {json.dumps(results['scales'][-1]['median']['total'])}")
+
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Benchmark results saved in {out}")
+
+
+@click.command("compare")
+@click.argument("baseline", type=click.Path(exists=True))
+@click.argument("candidate", type=click.Path(exists=True))
+@click.option("--ratio", type=float, default=REGRESSION_RATIO, show_default=True)
+def compare(baseline, candidate, ratio):
+    """
+    Compare two benchmark results, exiting with an error if the candidate regressed.
+
+    The median wall time of every stage and the end-to-end time and memory high-water mark of every
+    scale measured in both files are compared. Times below MIN_COMPARED_TIME are ignored.
+    """
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(candidate) as f:
+        candidate = json.load(f)
+    logger.info(f"Baseline at {baseline['environment']['commit']}, candidate at {candidate['environment']['commit']}")
+
+    regressions = []
+    candidate_scales = {s["scale"]: s for s in candidate["scales"]}
+    for expected in baseline["scales"]:
+        actual = candidate_scales.get(expected["scale"])
+        if actual is None:
+            logger.warning(f"Scale {expected['scale']} is not in {candidate}")
+            continue
+        for stage, metrics in expected["median"].items():
+            if stage not in actual["median"]:
+                continue
+            for metric in ("wall_time_s", "peak_rss_mb"):
+                before, after = metrics.get(metric), actual["median"][stage].get(metric)
+                if before is None or after is None or (metric == "wall_time_s" and before < MIN_COMPARED_TIME):
+                    continue
+                change = after / before if before else float("inf")
+                line = f"{expected['scale']:>10} {stage:<24} {metric:<12} {before:12.3f} {after:12.3f} {change:7.2f}x"
+                if change > ratio:
+                    regressions.append(line)
+                    line += " REGRESSION"
+                click.echo(line)
+
+    if regressions:
+        raise click.ClickException(f"{len(regressions)} regressions above {ratio}x")
+
+
+def synthetic_folder(workdir: Path, experiment: SyntheticExperiment) -> Path:
+    """Folder of a synthetic experiment, generated unless a previous run left it there."""
+    folder = workdir / f"synthetic_{experiment.runs}x{experiment.precursors}_{experiment.seed}"
+    expected = asdict(experiment)
+    parameters = folder / "synthetic.json"
+    if parameters.exists():
+        saved = json.loads(parameters.read_text())
+        if {k: saved.get(k) for k in expected} == expected:
+            return folder
+    logger.info(f"Generating {folder}")
+    shutil.rmtree(folder, ignore_errors=True)
+    experiment.generate(folder)
+    return folder
+
+
+def convert(script: Path, folder: Path, out: Path, table_format: str) -> Dict[str, Any]:
+    """Converts a synthetic experiment in a new process.
+
+    :return: The stage metrics of the conversion, and its end-to-end wall time, CPU time and memory
+        high-water mark under "total"
+    :rtype: dict
+    """
+    out.mkdir(parents=True, exist_ok=True)
+    command = [
+        sys.executable,
+        str(script.resolve()),
+        "convert",
+        "--folder",
+        str(folder.resolve()),
+        "--exp_design",
+        str((folder / "synthetic_design.tsv").resolve()),
+        "--diann_version",
+        str((folder / "version" / "versions.yml").resolve()),
+        "--dia_params",
+        DIA_PARAMS,
+        "--charge",
+        "4",
+        "--missed_cleavages",
+        "1",
+        "--qvalue_threshold",
+        "0.01",
+        "--table_format",
+        table_format,
+    ]
+    total = measure_process(command, cwd=out, log=out / "convert.log")
+    with open(out / "synthetic_design_metrics.json") as f:
+        stages = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+    stages["total"] = total
+    return stages
+
+
+def measure_process(command: List[str], cwd: Path, log: Path) -> Dict[str, float]:
+    """Runs a command in a new process, its output going to ``log``.
+
+    :return: The wall time, CPU time and memory high-water mark of the process
+    :rtype: dict
+    :raises RuntimeError: If the command fails
+    """
+    with open(log, "w") as f:
+        wall_time = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=f, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this process alone, unlike RUSAGE_CHILDREN
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - wall_time
+    # Set for Popen not to reap the process again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed, see {log}")
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    peak_rss = usage.ru_maxrss / 1024 / (1024 if platform.system() == "Darwin" else 1)
+    return {
+        "wall_time_s": round(wall_time, 6),
+        "cpu_time_s": round(usage.ru_utime + usage.ru_stime, 6),
+        "peak_rss_mb": round(peak_rss, 3),
+    }
+
+
+def median_measure(measures: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """Median of each metric of each stage over repeated conversions."""
+    median = {}
+    for stage in measures[0]:
+        median[stage] = {
+            metric: statistics.median(m[stage][metric] for m in measures)
+            for metric in ("wall_time_s", "cpu_time_s", "peak_rss_mb")
+        }
+        if measures[0][stage].get("rows") is not None:
+            median[stage]["rows"] = measures[0][stage]["rows"]
+    return median
+
+
+def environment(script: Path) -> Dict[str, Any]:
+    """What the results depend on besides the code: commit, interpreter, libraries and machine."""
+
+    def git(*args):
+        try:
+            return subprocess.run(
+                ["git", *args], cwd=script.resolve().parent, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    versions = {}
+    for package in ("numpy", "pandas", "pyarrow", "pyopenms"):
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+    return {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "script": str(script.resolve()),
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "packages": versions,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+cli.add_command(run)
+cli.add_command(compare)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+This script benchmarks mzml_statistics.py on synthetic mzML files and Bruker .d folders, recording the
+throughput in spectra and megabytes per second and the memory high-water mark of each parsing mode. The
+results have the layout of the ones of benchmark_diann_convert.py, and are compared the same way.
+License: Apache 2.0
+"""
+import json
+import logging
+import shutil
+import statistics
+import sys
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Dict
+
+import click
+
+from benchmark_diann_convert import REPO_DIR, compare, environment, measure_process
+from synthetic_spectra import SyntheticSpectra
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+MZML_STATISTICS = REPO_DIR / "bin" / "mzml_statistics.py"
+# Parsing modes benchmarked: file format and the parameters of the synthetic files that change the parsing
+CASES = {
+    "mzml_zlib": {"format": "mzml", "compression": "zlib", "cv_params": "full"},
+    "mzml_uncompressed": {"format": "mzml", "compression": "none", "cv_params": "full"},
+    "mzml_minimal_cv_params": {"format": "mzml", "compression": "zlib", "cv_params": "minimal"},
+    "tdf_dda": {"format": "tdf", "acquisition": "dda"},
+    "tdf_dia": {"format": "tdf", "acquisition": "dia"},
+}
+
+logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def cli():
+    pass
+
+
+@click.command("run")
+@click.option("--spectra", "-n", type=int, multiple=True, default=(10000, 100000), show_default=True)
+@click.option("--cases", "-c", type=click.Choice(list(CASES)), multiple=True, default=list(CASES))
+@click.option("--peaks", type=int, default=SyntheticSpectra.peaks, show_default=True)
+@click.option("--ms2_per_ms1", type=int, default=SyntheticSpectra.ms2_per_ms1, show_default=True)
+@click.option("--repeats", "-r", type=int, default=3, show_default=True)
+@click.option("--workdir", "-w", default="benchmark_work", show_default=True, help="Cache of the generated files")
+@click.option("--out", "-o", default="benchmark_mzml_statistics.json", show_default=True)
+@click.option("--script", default=str(MZML_STATISTICS), show_default=True, help="mzml_statistics.py to benchmark")
+def run(spectra, cases, peaks, ms2_per_ms1, repeats, workdir, out, script):
+    """
+    Benchmark mzml_statistics.py on every parsing mode at several sizes.
+
+    Each mode (see CASES) is run on synthetic files of every number of spectra, generated once in
+    ``workdir`` and reused by later runs with the same parameters. Every parsing runs in its own
+    process, so its memory high-water mark is measured alone.
+
+    :param spectra: Numbers of spectra, or of frames of the Bruker acquisitions, of the files
+    :type spectra: list
+    :param cases: Parsing modes benchmarked, keys of CASES
+    :type cases: list
+    """
+    workdir = Path(workdir)
+    results = {"environment": environment(Path(script)), "scales": []}
+    for n in spectra:
+        for case in cases:
+            parameters = {k: v for k, v in CASES[case].items() if k != "format"}
+            fmt = CASES[case]["format"]
+            synthetic = SyntheticSpectra(spectra=n, peaks=peaks, ms2_per_ms1=ms2_per_ms1, **parameters)
+            path = synthetic_file(workdir / f"{case}_{n}", synthetic, fmt)
+            size = sum(p.stat().st_size for p in ([path] if path.is_file() else path.iterdir())) / 1024**2
+            logger.info(f"Benchmarking {case} with {n} spectra ({size:.0f} MB): {repeats} runs")
+            measures = [parse(Path(script), path, workdir / "out", n, size) for _ in range(repeats)]
+            median = {m: statistics.median(r[m] for r in measures) for m in measures[0]}
+            results["scales"].append(
+                {
+                    "scale": f"{case}_{n}",
+                    "case": case,
+                    "synthetic": {**asdict(synthetic), "format": fmt},
+                    "size_mb": round(size, 3),
+                    "measures": measures,
+                    "median": {"total": median},
+                }
+            )
+            logger.info(f"{case} {n}: {median['spectra_per_s']:.0f} spectra/s, peak RSS {median['peak_rss_mb']:.0f} MB")
+
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Benchmark results saved in {out}")
+
+
+def synthetic_file(out: Path, synthetic: SyntheticSpectra, fmt: str) -> Path:
+    """Path of a synthetic file, generated unless a previous run left it there."""
+    parameters = Path(f"{out}.json")
+    expected = {**asdict(synthetic), "format": fmt}
+    if parameters.exists():
+        saved = json.loads(parameters.read_text())
+        path = out.parent / saved["path"]
+        if {k: saved.get(k) for k in expected} == expected and path.exists():
+            return path
+    return synthetic.write(out, fmt)
+
+
+def parse(script: Path, path: Path, out: Path, spectra: int, size: float) -> Dict[str, Any]:
+    """Runs mzml_statistics.py on a file in a new process, checking it wrote a row per spectrum."""
+    shutil.rmtree(out, ignore_errors=True)
+    out.mkdir(parents=True)
+    measure = measure_process(
+        [sys.executable, str(script.resolve()), str(path.resolve())], cwd=out, log=out / "mzml_statistics.log"
+    )
+    with open(out / f"{path.stem}_ms_info.tsv") as f:
+        rows = sum(1 for _ in f) - 1
+    if rows != spectra:
+        raise ValueError(f"{rows} rows in the statistics of {path}, expected {spectra}")
+    measure["spectra_per_s"] = round(spectra / measure["wall_time_s"], 3)
+    measure["mb_per_s"] = round(size / measure["wall_time_s"], 3)
+    return measure
+
+
+cli.add_command(run)
+cli.add_command(compare)
+
+if __name__ == "__main__":
+    cli()
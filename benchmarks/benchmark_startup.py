@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+This script measures the start-up of the scripts in bin/, from the import times Python reports with
+``-X importtime``. Every pipeline task starts an interpreter for one of them, so a heavy import at the top of
+a script is paid by each of the thousands of tasks of a large experiment. It exits with an error when a
+script imports one of HEAVY_MODULES on start-up, or takes longer than the start-up budget to import.
+License: Apache 2.0
+"""
+import json
+import logging
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import click
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+BIN_DIR = Path(__file__).resolve().parent.parent / "bin"
+# Modules only to be imported by the commands that need them
+HEAVY_MODULES = ("numpy", "pandas", "pyarrow", "pyopenms", "sdrf_pipelines", "zstandard")
+# Import time of a script, in milliseconds, over which its start-up is reported as too slow
+STARTUP_BUDGET_MS = 200
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@click.command("startup", context_settings=CONTEXT_SETTINGS)
+@click.option("--scripts", "-s", multiple=True, help="Scripts to measure  [default: bin/*.py]")
+@click.option("--repeats", "-n", type=int, default=5, show_default=True)
+@click.option("--budget_ms", type=float, default=STARTUP_BUDGET_MS, show_default=True)
+@click.option("--top", type=int, default=5, show_default=True, help="Slowest imports reported for each script")
+@click.option("--out", "-o", default=None, help="JSON file to save the measures in")
+def startup(scripts, repeats, budget_ms, top, out):
+    """
+    Measure the start-up import time of the bin/ scripts, and check it stays under the budget.
+
+    Each script is run in a new interpreter under another name than ``__main__``, so everything but its
+    ``__main__`` block runs, as when a task starts it. The modules the interpreter imports on its own are
+    left out, so the time is the one the script adds. The median over the repeats is compared with the budget.
+
+    :param scripts: Paths to the scripts, all of bin/*.py by default
+    :type scripts: list
+    :param budget_ms: Start-up budget of every script, in milliseconds
+    :type budget_ms: float
+    """
+    scripts = [Path(s) for s in scripts] or sorted(BIN_DIR.glob("*.py"))
+    interpreter = {m["module"] for m in import_times("import pkgutil, runpy")}
+    results, failures = {}, []
+    for script in scripts:
+        # The directory of a script comes first in its module search path, for it to import the modules next to it
+        code = (
+            f"import runpy, sys; sys.path.insert(0, {str(script.resolve().parent)!r}); "
+            f"runpy.run_path({str(script.resolve())!r}, run_name='startup')"
+        )
+        try:
+            runs = [[m for m in import_times(code) if m["module"] not in interpreter] for _ in range(repeats)]
+        except RuntimeError as e:
+            failures.append(str(e))
+            continue
+        total_ms = statistics.median(sum(m["cumulative_us"] for m in r if m["depth"] == 0) / 1000 for r in runs)
+        heavy = sorted({m["module"].split(".")[0] for m in runs[0]} & set(HEAVY_MODULES))
+        slowest = sorted((m for m in runs[0] if m["depth"] == 0), key=lambda m: m["cumulative_us"], reverse=True)
+        results[script.name] = {
+            "import_time_ms": round(total_ms, 3),
+            "modules": len(runs[0]),
+            "heavy_modules": heavy,
+            "slowest": [{"module": m["module"], "ms": m["cumulative_us"] / 1000} for m in slowest[:top]],
+        }
+        logger.info(
+            f"{script.name}: {total_ms:.1f} ms, {len(runs[0])} modules, slowest "
+            + ", ".join(f"{m['module']} {m['cumulative_us'] / 1000:.1f} ms" for m in slowest[:top])
+        )
+        if heavy:
+            failures.append(f"{script.name} imports {', '.join(heavy)} on start-up")
+        if total_ms > budget_ms:
+            failures.append(f"{script.name} takes {total_ms:.1f} ms to import, over the {budget_ms:g} ms budget")
+
+    if out:
+        with open(out, "w") as f:
+            json.dump({"python": sys.version, "budget_ms": budget_ms, "scripts": results}, f, indent=2)
+        logger.info(f"Start-up times saved in {out}")
+    if failures:
+        raise click.ClickException("\n".join(failures))
+
+
+def import_times(code: str) -> List[Dict]:
+    """Modules imported by running ``code`` in a new interpreter, from its ``-X importtime`` report.
+
+    :return: The self and cumulative import time of every module, in microseconds, and its depth in the
+        tree of imports, 0 for the modules imported by ``code`` itself
+    :rtype: list
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"{code} failed:\n{process.stderr.splitlines()[-1]}")
+    modules = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            modules.append(
+                {
+                    "module": module,
+                    "self_us": int(self_us),
+                    "cumulative_us": int(cumulative_us),
+                    "depth": (len(indent) - 1) // 2,
+                }
+            )
+    return modules
+
+
+if __name__ == "__main__":
+    startup()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+This script checks that an optimized diann_convert.py gives the same outputs as a reference one. Both
+convert the same DIA-NN experiments, and their MSstats, Triqler and mzTab outputs are compared cell by
+cell, numbers within a tolerance, into a JSON report of every divergence.
+License: Apache 2.0
+"""
+import json
+import logging
+import shlex
+import shutil
+import subprocess
+import sys
+from io import StringIO
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import click
+import numpy as np
+import pandas as pd
+
+from benchmark_diann_convert import DIA_PARAMS, DIANN_CONVERT, REPO_DIR, synthetic_folder
+from synthetic_diann import SyntheticExperiment
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+# Columns identifying the rows of each table, the rows with the same key are matched in order
+TABLE_KEYS = {
+    "msstats": ["ProteinName", "PeptideSequence", "PrecursorCharge", "Run"],
+    "triqler": ["proteins", "peptide", "charge", "run"],
+    "MTD": ["key"],
+    "PRT": ["accession"],
+    "PEP": ["opt_global_cv_MS:1000889_peptidoform_sequence", "charge"],
+    "PSM": ["opt_global_cv_MS:1000889_peptidoform_sequence", "charge", "opt_global_map_index"],
+}
+MZTAB_SECTIONS = {"MTD": "MTD", "PRH": "PRT", "PEH": "PEP", "PSH": "PSM"}
+# Values all taken as a missing value, whatever the writer
+MISSING_VALUES = ["", "null", "NA", "nan", "NaN", "None"]
+# Divergent cells or rows reported per column or table
+EXAMPLES = 5
+
+logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--reference", default="git:HEAD", show_default=True, help="diann_convert.py path, or git:<ref>")
+@click.option("--candidate", default=str(DIANN_CONVERT), show_default=True, help="diann_convert.py path, or git:<ref>")
+@click.option("--candidate_mode", type=click.Choice(["convert", "shard", "incremental"]), default="convert")
+@click.option("--shards", type=int, default=3, show_default=True, help="Shards of the shard mode")
+@click.option("--candidate_args", default="", help="Extra arguments of the candidate conversion")
+@click.option("--folder", "-f", help="Folder of a DIA-NN experiment to convert, instead of synthetic ones")
+@click.option("--exp_design", "-d", help="Experimental design of --folder")
+@click.option("--diann_version", "-v", help="Version file of --folder")
+@click.option("--scales", "-s", multiple=True, default=("4x2000",), show_default=True, help="runs x precursors")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--workdir", "-w", default="equivalence_work", show_default=True)
+@click.option("--rtol", type=float, default=1e-9, show_default=True)
+@click.option("--atol", type=float, default=1e-12, show_default=True)
+@click.option("--ignore_column", multiple=True, help="Column left out of the comparison, as <table>:<column>")
+@click.option("--out", "-o", default="equivalence_report.json", show_default=True)
+def equivalence(
+    reference,
+    candidate,
+    candidate_mode,
+    shards,
+    candidate_args,
+    folder,
+    exp_design,
+    diann_version,
+    scales,
+    seed,
+    workdir,
+    rtol,
+    atol,
+    ignore_column,
+    out,
+):
+    """
+    Compare the outputs of a reference and a candidate diann_convert.py.
+
+    The reference always runs the ``convert`` command, the candidate the ``convert`` command or the
+    ``shard`` and ``merge`` or ``incremental`` ones. Two cells are equivalent when their text is the
+    same, when both are missing values, or when both are numbers within the tolerance. The report
+    holds, for every input and table, the rows and columns found in only one output, and for every
+    column the number of divergent cells, the largest numeric differences and a few examples.
+    Exits with an error if any output diverges.
+
+    :param reference: Path to the reference diann_convert.py, or "git:<ref>" for the one of a commit
+    :type reference: str
+    :param candidate: Path to the candidate diann_convert.py, or "git:<ref>"
+    :type candidate: str
+    :param scales: Sizes of the synthetic experiments converted, as "<runs>x<precursors>"
+    :type scales: list
+    :param ignore_column: Columns not compared, e.g. "PSM:opt_global_spectrum_reference"
+    :type ignore_column: list
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    reference_script = resolve_script(reference, workdir)
+    candidate_script = resolve_script(candidate, workdir)
+
+    if folder:
+        inputs = [(Path(folder).name, Path(folder), Path(exp_design), Path(diann_version))]
+    else:
+        inputs = []
+        for scale in scales:
+            runs, precursors = (int(n) for n in scale.lower().split("x"))
+            experiment = SyntheticExperiment(runs=runs, precursors=precursors, protein_group_size=2, seed=seed)
+            path = synthetic_folder(workdir, experiment)
+            inputs.append((scale, path, path / "synthetic_design.tsv", path / "version" / "versions.yml"))
+
+    ignored = [c.split(":", 1) for c in ignore_column]
+    report = {
+        "reference": {"script": str(reference_script), "spec": reference, "mode": "convert"},
+        "candidate": {"script": str(candidate_script), "spec": candidate, "mode": candidate_mode},
+        "tolerance": {"rtol": rtol, "atol": atol},
+        "ignored_columns": ignore_column,
+        "inputs": [],
+    }
+    for name, path, design, version in inputs:
+        logger.info(f"Converting {name} with the reference and the candidate")
+        run_dir = workdir / "runs" / name
+        reference_out = convert(reference_script, "convert", path, design, version, run_dir / "reference")
+        candidate_out = convert(
+            candidate_script,
+            candidate_mode,
+            path,
+            design,
+            version,
+            run_dir / "candidate",
+            extra_args=shlex.split(candidate_args),
+            shards=shards,
+        )
+        expected, actual = read_outputs(reference_out, design.stem), read_outputs(candidate_out, design.stem)
+        tables = {}
+        for table in expected:
+            skip = [c for t, c in ignored if t == table]
+            tables[table] = diff_tables(expected[table], actual.get(table), TABLE_KEYS[table], rtol, atol, skip)
+            logger.info(f"{name} {table}: {'equivalent' if tables[table]['equivalent'] else 'DIVERGENT'}")
+        report["inputs"].append(
+            {"input": name, "equivalent": all(t["equivalent"] for t in tables.values()), "tables": tables}
+        )
+
+    report["equivalent"] = all(i["equivalent"] for i in report["inputs"])
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info(f"Equivalence report saved in {out}")
+    if not report["equivalent"]:
+        raise click.ClickException("The candidate outputs diverge from the reference ones")
+
+
+def resolve_script(spec: str, workdir: Path) -> Path:
+    """Path to a diann_convert.py, extracted from the repository with the modules next to it if given as
+    "git:<ref>"."""
+    if not spec.startswith("git:"):
+        return Path(spec).resolve()
+    ref = spec[len("git:") :]
+
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+
+    commit = git("rev-parse", "--short", ref).strip()
+    bin_dir = workdir / f"bin_{commit}"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for path in git("ls-tree", "--name-only", commit, "bin/").split():
+        if path.endswith(".py"):
+            (bin_dir / Path(path).name).write_text(git("show", f"{commit}:{path}"))
+    return (bin_dir / "diann_convert.py").resolve()
+
+
+def convert(
+    script: Path,
+    mode: str,
+    folder: Path,
+    exp_design: Path,
+    diann_version: Path,
+    out: Path,
+    extra_args: Optional[List[str]] = None,
+    shards: int = 1,
+) -> Path:
+    """Converts an experiment in ``out`` with the convert command, the shard and merge ones or the incremental one.
+
+    The folder is emptied first, so nothing, e.g. the state of an incremental conversion, is reused.
+    """
+    shutil.rmtree(out, ignore_errors=True)
+    out.mkdir(parents=True)
+    inputs = ["--folder", folder, "--exp_design", exp_design, "--diann_version", diann_version]
+    conversion = ["--dia_params", DIA_PARAMS, "--charge", "4", "--missed_cleavages", "1"]
+    if mode == "shard":
+        commands = [
+            ["shard", *inputs, "--qvalue_threshold", "0.01", "--shard_index", i, "--num_shards", shards]
+            for i in range(shards)
+        ]
+        commands.append(["merge", *inputs, *conversion, "--shards_folder", out, *(extra_args or [])])
+    elif mode == "incremental":
+        state = ["--state_dir", out / "state"]
+        commands = [["incremental", *inputs, *conversion, "--qvalue_threshold", "0.01", *state, *(extra_args or [])]]
+    else:
+        commands = [["convert", *inputs, *conversion, "--qvalue_threshold", "0.01", *(extra_args or [])]]
+
+    with open(out / "convert.log", "w") as log:
+        for command in commands:
+            command = [sys.executable, str(script)] + [
+                str(Path(a).resolve()) if isinstance(a, Path) else str(a) for a in command
+            ]
+            if subprocess.run(command, cwd=out, stdout=log, stderr=subprocess.STDOUT).returncode != 0:
+                raise RuntimeError(f"Conversion of {folder} by {script} failed, see {out / 'convert.log'}")
+    return out
+
+
+def read_outputs(folder: Path, prefix: str) -> Dict[str, pd.DataFrame]:
+    """MSstats and Triqler tables, in any of the formats of diann_convert.py, and mzTab sections, all as text."""
+    tables = {}
+    for name, pattern, sep in [("msstats", "_msstats_in.*", ","), ("triqler", "_triqler_in.*", "\t")]:
+        paths = sorted(folder.glob(prefix + pattern))
+        if not paths:
+            raise FileNotFoundError(f"No {name} table in {folder}")
+        path = paths[0]
+        if path.suffix == ".parquet":
+            tables[name] = pd.read_parquet(path).astype(str)
+        else:
+            tables[name] = pd.read_csv(path, sep=sep, dtype=str, keep_default_na=False)
+
+    lines: Dict[str, List[str]] = {}
+    with open(folder / f"{prefix}_out.mzTab") as f:
+        for line in f:
+            lines.setdefault(line[:3], []).append(line)
+    tables["MTD"] = pd.DataFrame(
+        [line.rstrip("\n").split("\t")[1:3] for line in lines.get("MTD", [])], columns=["key", "value"]
+    )
+    for header, section in MZTAB_SECTIONS.items():
+        if header == "MTD":
+            continue
+        text = "".join(lines.get(header, []) + lines.get(section, []))
+        table = pd.read_csv(StringIO(text), sep="\t", dtype=str, keep_default_na=False) if text else pd.DataFrame()
+        tables[section] = table.iloc[:, 1:]
+    return tables
+
+
+def diff_tables(
+    expected: pd.DataFrame,
+    actual: Optional[pd.DataFrame],
+    keys: List[str],
+    rtol: float,
+    atol: float,
+    ignore: List[str] = (),
+) -> Dict[str, Any]:
+    """Cell by cell differences of two tables, matching their rows by ``keys``.
+
+    The rows with the same key are matched in the order of their other values, so tables without a
+    usable key are compared row by row once sorted.
+
+    :return: Rows and columns found in one table only, and the divergent cells of each column
+    :rtype: dict
+    """
+    if actual is None:
+        return {"equivalent": False, "error": "missing from the candidate outputs"}
+    common = [c for c in expected.columns if c in actual.columns and c not in ignore]
+    keys = [k for k in keys if k in common]
+    result: Dict[str, Any] = {
+        "rows_reference": len(expected),
+        "rows_candidate": len(actual),
+        "key": keys,
+        "columns_only_in_reference": [c for c in expected.columns if c not in actual.columns],
+        "columns_only_in_candidate": [c for c in actual.columns if c not in expected.columns],
+    }
+    expected, actual = _with_occurrence(expected[common], keys), _with_occurrence(actual[common], keys)
+    index = keys + ["occurrence"]
+    merged = expected.merge(actual, on=index, how="outer", suffixes=("", " candidate"), indicator=True)
+    for side, label in [("left_only", "rows_only_in_reference"), ("right_only", "rows_only_in_candidate")]:
+        rows = merged.loc[merged["_merge"] == side, index]
+        result[label] = {"count": len(rows), "examples": rows.head(EXAMPLES).to_dict("records")}
+    merged = merged[merged["_merge"] == "both"]
+
+    columns = {}
+    for column in common:
+        if column in keys:
+            continue
+        divergence = diff_cells(merged[column], merged[f"{column} candidate"], rtol, atol)
+        if divergence["divergent_cells"] or divergence["max_abs_diff"]:
+            examples = merged.loc[divergence.pop("divergent_mask"), index + [column, f"{column} candidate"]]
+            divergence["examples"] = [
+                {
+                    "key": {k: row[k] for k in index},
+                    "reference": row[column],
+                    "candidate": row[f"{column} candidate"],
+                }
+                for _, row in examples.head(EXAMPLES).iterrows()
+            ]
+            columns[column] = divergence
+    result["columns"] = columns
+
+    result["equivalent"] = not (
+        result["columns_only_in_reference"]
+        or result["columns_only_in_candidate"]
+        or result["rows_only_in_reference"]["count"]
+        or result["rows_only_in_candidate"]["count"]
+        or any(c["divergent_cells"] for c in columns.values())
+    )
+    return result
+
+
+def _with_occurrence(table: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    table = table.sort_values(list(table.columns), kind="stable").reset_index(drop=True)
+    if keys:
+        table["occurrence"] = table.groupby(keys, sort=False).cumcount()
+    else:
+        table["occurrence"] = np.arange(len(table))
+    return table
+
+
+def diff_cells(expected: pd.Series, actual: pd.Series, rtol: float, atol: float) -> Dict[str, Any]:
+    """Compares two aligned columns of text cells.
+
+    :return: The number of divergent cells, their mask, and the largest absolute and relative
+        differences between the cells holding numbers in both columns, divergent or not
+    :rtype: dict
+    """
+    expected, actual = expected.astype(str).to_numpy(), actual.astype(str).to_numpy()
+    same = (expected == actual) | (np.isin(expected, MISSING_VALUES) & np.isin(actual, MISSING_VALUES))
+    expected_numbers = pd.to_numeric(pd.Series(expected), errors="coerce").to_numpy(dtype=float)
+    actual_numbers = pd.to_numeric(pd.Series(actual), errors="coerce").to_numpy(dtype=float)
+    numbers = ~np.isnan(expected_numbers) & ~np.isnan(actual_numbers)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        close = numbers & np.isclose(expected_numbers, actual_numbers, rtol=rtol, atol=atol)
+        abs_diff = np.abs(expected_numbers - actual_numbers)[numbers & ~same]
+        rel_diff = abs_diff / np.abs(expected_numbers[numbers & ~same])
+    divergent = ~(same | close)
+    return {
+        "divergent_cells": int(divergent.sum()),
+        "divergent_mask": divergent,
+        "max_abs_diff": float(np.nanmax(abs_diff)) if np.isfinite(abs_diff).any() else 0.0,
+        "max_rel_diff": float(np.nanmax(rel_diff[np.isfinite(rel_diff)])) if np.isfinite(rel_diff).any() else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    equivalence()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+This script generates a synthetic DIA-NN experiment: main report, protein group and precursor matrices,
+FASTA database, experimental design and the ms_info files of the runs, as consumed by diann_convert.py.
+The same parameters and seed always give the same files.
+License: Apache 2.0
+"""
+import json
+import logging
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List
+
+import click
+import numpy as np
+import pandas as pd
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+AMINO_ACIDS = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+PEPTIDE_LENGTHS = (7, 25)
+PROTEIN_LENGTHS = (150, 800)
+# Fraction of the residues of the leading protein of a group changed in the other members
+ISOFORM_MUTATION_RATE = 0.05
+# DIA windows of the ms_info files, covering the m/z of any generated precursor, and the time the
+# acquisition of one spectrum takes in seconds
+MZ_RANGE = (150.0, 2150.0)
+SCAN_TIME = 0.05
+DIANN_VERSION = "1.8.1"
+
+logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyntheticExperiment:
+    """Parameters of a synthetic DIA-NN experiment.
+
+    :param runs: Number of runs (mzML files)
+    :type runs: int
+    :param precursors: Number of distinct precursors
+    :type precursors: int
+    :param precursors_per_group: Average number of precursors of a protein group
+    :type precursors_per_group: int
+    :param protein_group_size: Number of proteins in each protein group
+    :type protein_group_size: int
+    :param study_variables: Number of MSstats conditions the samples are assigned to
+    :type study_variables: int
+    :param missing_rate: Probability of a precursor not being identified in a run
+    :type missing_rate: float
+    :param gradient_minutes: Length of the runs, which sets the number of spectra in the ms_info files
+    :type gradient_minutes: float
+    :param windows: Number of DIA isolation windows
+    :type windows: int
+    :param seed: Seed of the random generator
+    :type seed: int
+    """
+
+    runs: int = 4
+    precursors: int = 2000
+    precursors_per_group: int = 8
+    protein_group_size: int = 1
+    study_variables: int = 2
+    missing_rate: float = 0.2
+    gradient_minutes: float = 30.0
+    windows: int = 40
+    seed: int = 0
+
+    @property
+    def run_names(self) -> List[str]:
+        # Fixed width, so no run name is part of another one when diann_convert.py globs the ms_info files
+        return [f"run_{i:05d}" for i in range(self.runs)]
+
+    def generate(self, out: Path) -> None:
+        """Writes the experiment to ``out``, with its parameters in ``synthetic.json``.
+
+        :param out: Folder the files are written to, created if needed
+        :type out: pathlib.Path
+        """
+        out = Path(out)
+        out.mkdir(parents=True, exist_ok=True)
+        rng = np.random.default_rng(self.seed)
+
+        proteins = self.proteins(rng)
+        write_fasta(proteins, out / "synthetic.fasta")
+        precursors = self.precursor_table(rng, proteins)
+        logger.info(f"{len(precursors)} precursors in {precursors['Protein.Group'].nunique()} protein groups")
+        self.write_design(out / "synthetic_design.tsv")
+
+        files = [f"/data/{run}.mzML" for run in self.run_names]
+        reports, pr_matrix, pg_matrix = [], {}, {}
+        for run, file in zip(self.run_names, files):
+            report = self.run_report(rng, precursors, run, file)
+            pr_matrix[file] = report.set_index("Precursor.Id")["Precursor.Normalised"]
+            pg_matrix[file] = report.groupby("Protein.Group")["PG.MaxLFQ"].first()
+            self.ms_info(rng, report).to_csv(out / f"{run}_ms_info.tsv", sep="\t", index=False)
+            reports.append(report)
+        report = pd.concat(reports, ignore_index=True)
+
+        pg_columns = ["Protein.Group", "Protein.Ids", "Protein.Names", "Genes", "First.Protein.Description"]
+        pr_columns = pg_columns + ["Proteotypic", "Stripped.Sequence", "Modified.Sequence", "Precursor.Charge"]
+        pr = precursors[pr_columns + ["Precursor.Id"]].join(pd.DataFrame(pr_matrix), on="Precursor.Id")
+        pg = precursors[pg_columns].drop_duplicates("Protein.Group").join(pd.DataFrame(pg_matrix), on="Protein.Group")
+        report.to_csv(out / "diann_report.tsv", sep="\t", index=False)
+        pr.dropna(how="all", subset=files).to_csv(out / "diann_report.pr_matrix.tsv", sep="\t", index=False)
+        pg.dropna(how="all", subset=files).to_csv(out / "diann_report.pg_matrix.tsv", sep="\t", index=False)
+
+        (out / "version").mkdir(exist_ok=True)
+        (out / "version" / "versions.yml").write_text(f'"DIANNSUMMARY":\n    DIA-NN: {DIANN_VERSION}\n')
+        with open(out / "synthetic.json", "w") as f:
+            json.dump({**asdict(self), "report_rows": len(report)}, f, indent=2)
+        logger.info(f"Synthetic experiment with {len(report)} report rows written to {out}")
+
+    def proteins(self, rng: np.random.Generator) -> Dict[str, str]:
+        """Sequences of the proteins, by accession. The members of a group are isoforms of its leading protein."""
+        groups = max(1, -(-self.precursors // self.precursors_per_group))
+        proteins = {}
+        for group in range(groups):
+            sequence = rng.choice(AMINO_ACIDS, size=int(rng.integers(*PROTEIN_LENGTHS)))
+            proteins[f"P{group:06d}"] = "".join(sequence)
+            for member in range(1, self.protein_group_size):
+                mutated = rng.random(len(sequence)) < ISOFORM_MUTATION_RATE
+                isoform = np.where(mutated, rng.choice(AMINO_ACIDS, size=len(sequence)), sequence)
+                proteins[f"P{group:06d}-{member + 1}"] = "".join(isoform)
+        return proteins
+
+    def precursor_table(self, rng: np.random.Generator, proteins: Dict[str, str]) -> pd.DataFrame:
+        """Precursors identified in the experiment, with the columns of the report that do not depend on the run."""
+        leading = [accession for accession in proteins if "-" not in accession]
+        rows, seen = [], set()
+        while len(rows) < self.precursors:
+            accession = leading[len(rows) % len(leading)]
+            sequence = proteins[accession]
+            length = int(rng.integers(*PEPTIDE_LENGTHS))
+            start = int(rng.integers(0, len(sequence) - length))
+            peptide = sequence[start : start + length]
+            modified = peptide
+            if "M" in peptide and rng.random() < 0.5:
+                modified = modified.replace("M", "M(UniMod:35)", 1)
+            modified = modified.replace("C", "C(UniMod:4)")
+            charge = int(rng.integers(2, 5))
+            if (modified, charge) in seen:
+                continue
+            seen.add((modified, charge))
+            group = ";".join([accession] + [f"{accession}-{m + 1}" for m in range(1, self.protein_group_size)])
+            rows.append(
+                {
+                    "Protein.Group": group,
+                    "Protein.Ids": group,
+                    "Protein.Names": ";".join(f"{a}_HUMAN" for a in group.split(";")),
+                    "Genes": ";".join(f"G{a}" for a in group.split(";")),
+                    "First.Protein.Description": f"Synthetic protein {accession}",
+                    "Proteotypic": 1,
+                    "Stripped.Sequence": peptide,
+                    "Modified.Sequence": modified,
+                    "Precursor.Charge": charge,
+                    "Precursor.Id": f"{modified}{charge}",
+                    "RT": float(rng.uniform(1, self.gradient_minutes - 1)),
+                    "Abundance": float(rng.lognormal(12, 1.5)),
+                }
+            )
+        return pd.DataFrame(rows)
+
+    def run_report(self, rng: np.random.Generator, precursors: pd.DataFrame, run: str, file: str) -> pd.DataFrame:
+        """Rows of the main report of a run."""
+        report = precursors[rng.random(len(precursors)) >= self.missing_rate].copy()
+        n = len(report)
+        q_value = rng.random(n) * 0.0099
+        report.insert(0, "File.Name", file)
+        report.insert(1, "Run", run)
+        report["RT"] = report["RT"] + rng.normal(0, 0.05, n)
+        report["RT.Start"] = report["RT"] - 0.1
+        report["Precursor.Quantity"] = report["Abundance"] * rng.lognormal(0, 0.3, n)
+        report["Precursor.Normalised"] = report["Precursor.Quantity"] * rng.lognormal(0, 0.05)
+        report["Q.Value"] = q_value
+        report["PEP"] = q_value * 2
+        report["Global.Q.Value"] = q_value / 2
+        report["Lib.Q.Value"] = q_value / 3
+        report["Protein.Q.Value"] = q_value
+        report["PG.Q.Value"] = q_value
+        report["Global.PG.Q.Value"] = report.groupby("Protein.Group")["Q.Value"].transform("min") / 2
+        report["PG.Quantity"] = report.groupby("Protein.Group")["Precursor.Quantity"].transform("sum")
+        report["PG.Normalised"] = report.groupby("Protein.Group")["Precursor.Normalised"].transform("sum")
+        report["PG.MaxLFQ"] = report["PG.Normalised"] * rng.lognormal(0, 0.05)
+        report["Genes.Quantity"] = report["PG.Quantity"]
+        return report.drop(columns=["Abundance", "Proteotypic"]).reset_index(drop=True)
+
+    def ms_info(self, rng: np.random.Generator, report: pd.DataFrame) -> pd.DataFrame:
+        """Spectra of a run: cycles of an MS1 scan followed by one MS2 scan per DIA window."""
+        bounds = np.linspace(*MZ_RANGE, self.windows + 1)
+        cycles = int(self.gradient_minutes * 60 / (SCAN_TIME * (self.windows + 1)))
+        n = cycles * (self.windows + 1)
+        window = np.arange(n) % (self.windows + 1) - 1
+        ms2 = window >= 0
+        lower = np.where(ms2, bounds[window.clip(0)], np.nan)
+        upper = np.where(ms2, bounds[window.clip(0) + 1], np.nan)
+        return pd.DataFrame(
+            {
+                "SpectrumID": [f"controllerType=0 controllerNumber=1 scan={i + 1}" for i in range(n)],
+                "MSLevel": np.where(ms2, 2, 1),
+                "Charge": np.where(ms2, 0, np.nan),
+                "MS_peaks": rng.integers(50, 2000, n),
+                "Base_Peak_Intensity": rng.lognormal(14, 1, n),
+                "Summed_Peak_Intensities": rng.lognormal(17, 1, n),
+                "Retention_Time": np.arange(n) * SCAN_TIME,
+                "Exp_Mass_To_Charge": (lower + upper) / 2,
+                "AcquisitionDateTime": "",
+                "Isolation_Window_Lower": lower,
+                "Isolation_Window_Upper": upper,
+            }
+        )
+
+    def write_design(self, out: Path) -> None:
+        """Writes the two-table experimental design, one sample per run, samples spread over the conditions."""
+        with open(out, "w") as f:
+            f.write("Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample\n")
+            for i, run in enumerate(self.run_names):
+                f.write(f"{i + 1}\t1\t/data/{run}.mzML\t1\t{i + 1}\n")
+            f.write("\n")
+            f.write("Sample\tMSstats_Condition\tMSstats_BioReplicate\n")
+            for i in range(self.runs):
+                f.write(f"{i + 1}\tcondition_{i % self.study_variables + 1}\t{i // self.study_variables + 1}\n")
+
+
+def write_fasta(proteins: Dict[str, str], out: Path, line_width: int = 60) -> None:
+    with open(out, "w") as f:
+        for accession, sequence in proteins.items():
+            f.write(f">sp|{accession}|{accession}_HUMAN Synthetic protein {accession}\n")
+            for start in range(0, len(sequence), line_width):
+                f.write(sequence[start : start + line_width] + "\n")
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--out", "-o", required=True, help="Folder the experiment is written to")
+@click.option("--runs", "-r", type=int, default=SyntheticExperiment.runs, show_default=True)
+@click.option("--precursors", "-p", type=int, default=SyntheticExperiment.precursors, show_default=True)
+@click.option("--precursors_per_group", type=int, default=SyntheticExperiment.precursors_per_group, show_default=True)
+@click.option("--protein_group_size", type=int, default=SyntheticExperiment.protein_group_size, show_default=True)
+@click.option("--study_variables", type=int, default=SyntheticExperiment.study_variables, show_default=True)
+@click.option("--missing_rate", type=float, default=SyntheticExperiment.missing_rate, show_default=True)
+@click.option("--gradient_minutes", type=float, default=SyntheticExperiment.gradient_minutes, show_default=True)
+@click.option("--windows", type=int, default=SyntheticExperiment.windows, show_default=True)
+@click.option("--seed", type=int, default=SyntheticExperiment.seed, show_default=True)
+def generate(out, **parameters):
+    """
+    Generate a synthetic DIA-NN experiment.
+
+    The folder can be converted with ``diann_convert.py convert --folder <out> --exp_design
+    <out>/synthetic_design.tsv --diann_version <out>/version/versions.yml``.
+    """
+    SyntheticExperiment(**parameters).generate(Path(out))
+
+
+if __name__ == "__main__":
+    generate()
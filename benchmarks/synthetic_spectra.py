@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+This script generates synthetic mass spectrometry files to benchmark mzml_statistics.py: indexed mzML
+files, and Bruker .d folders holding the analysis.tdf SQLite database (the binary analysis.tdf_bin is not
+written, as mzml_statistics.py does not read it). The same parameters and seed always give the same files.
+License: Apache 2.0
+"""
+import base64
+import hashlib
+import json
+import logging
+import sqlite3
+import zlib
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+import click
+import numpy as np
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+MZ_RANGE = (150.0, 2000.0)
+# DIA isolation windows, and the isolation width of DDA precursors, in m/z
+DIA_WINDOWS = 32
+DDA_ISOLATION_WIDTH = 2.0
+# Time the acquisition of one spectrum, or one TIMS frame, takes in seconds
+SCAN_TIME = 0.05
+ACQUISITION_DATETIME = "2023-01-01T00:00:00Z"
+# Bruker MsMsType of the MS2 frames of each acquisition
+TDF_MSMS_TYPES = {"dda": 8, "dia": 9}
+
+logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyntheticSpectra:
+    """Parameters of a synthetic acquisition.
+
+    :param spectra: Number of spectra, or of frames of a Bruker acquisition
+    :type spectra: int
+    :param peaks: Average number of peaks of a spectrum
+    :type peaks: int
+    :param ms2_per_ms1: Number of MS2 spectra following each MS1 spectrum
+    :type ms2_per_ms1: int
+    :param acquisition: "dda" or "dia", which sets the isolation windows of the MS2 spectra
+    :type acquisition: str
+    :param compression: Compression of the mzML binary arrays, "zlib" or "none"
+    :type compression: str
+    :param cv_params: "full" to write the base peak, total ion current and isolation window cvParams
+        of the mzML spectra, "minimal" to leave them out, so they are computed from the peaks
+    :type cv_params: str
+    :param seed: Seed of the random generator
+    :type seed: int
+    """
+
+    spectra: int = 10000
+    peaks: int = 200
+    ms2_per_ms1: int = 10
+    acquisition: str = "dia"
+    compression: str = "zlib"
+    cv_params: str = "full"
+    seed: int = 0
+
+    def levels(self) -> np.ndarray:
+        return np.where(np.arange(self.spectra) % (self.ms2_per_ms1 + 1) == 0, 1, 2)
+
+    def isolation_windows(self, rng: np.random.Generator, levels: np.ndarray) -> np.ndarray:
+        """Target m/z and half width of the isolation window of each MS2 spectrum, NaN for the MS1 ones."""
+        cycle_position = np.arange(self.spectra) % (self.ms2_per_ms1 + 1) - 1
+        if self.acquisition == "dia":
+            width = (MZ_RANGE[1] - MZ_RANGE[0]) / DIA_WINDOWS
+            target = MZ_RANGE[0] + (cycle_position % DIA_WINDOWS + 0.5) * width
+            half_width = np.full(self.spectra, width / 2)
+        else:
+            target = rng.uniform(400, 1200, self.spectra)
+            half_width = np.full(self.spectra, DDA_ISOLATION_WIDTH / 2)
+        return np.where(levels == 2, target, np.nan), np.where(levels == 2, half_width, np.nan)
+
+    def write_mzml(self, out: Path) -> None:
+        """Writes an indexed mzML file, with the offsets of its spectra and its SHA-1 checksum."""
+        rng = np.random.default_rng(self.seed)
+        levels = self.levels()
+        targets, half_widths = self.isolation_windows(rng, levels)
+        with open(out, "wb") as f:
+            writer = _ChecksumWriter(f)
+            writer.write(MZML_HEADER.format(spectra=self.spectra, date=ACQUISITION_DATETIME))
+            offsets, ms1_id = [], None
+            for i in range(self.spectra):
+                native_id = f"controllerType=0 controllerNumber=1 scan={i + 1}"
+                if levels[i] == 1:
+                    ms1_id = native_id
+                writer.write("      ")
+                offsets.append((native_id, writer.offset))
+                writer.write(self.spectrum_xml(rng, i, native_id, levels[i], targets[i], half_widths[i], ms1_id))
+            writer.write("    </spectrumList>\n  </run>\n</mzML>\n")
+            index_offset = writer.offset
+            writer.write('<indexList count="1">\n  <index name="spectrum">\n')
+            for native_id, offset in offsets:
+                writer.write(f"    <offset idRef={quoteattr(native_id)}>{offset}</offset>\n")
+            writer.write(f"  </index>\n</indexList>\n<indexListOffset>{index_offset}</indexListOffset>\n")
+            # The checksum covers the file up to and including the opening fileChecksum tag
+            writer.write("<fileChecksum>")
+            f.write(f"{writer.sha1.hexdigest()}</fileChecksum>\n</indexedmzML>\n".encode())
+
+    def spectrum_xml(self, rng, index, native_id, level, target, half_width, ms1_id) -> str:
+        n = max(1, int(rng.poisson(self.peaks)))
+        mz = np.sort(rng.uniform(*MZ_RANGE, n))
+        intensity = rng.lognormal(8, 2, n).astype(np.float32)
+        params = [
+            _cv("MS:1000511", "ms level", level),
+            _cv("MS:1000579", "MS1 spectrum") if level == 1 else _cv("MS:1000580", "MSn spectrum"),
+            _cv("MS:1000130", "positive scan"),
+            _cv("MS:1000127", "centroid spectrum"),
+        ]
+        if self.cv_params == "full":
+            params += [
+                _cv("MS:1000504", "base peak m/z", mz[intensity.argmax()], "MS:1000040", "m/z"),
+                _cv("MS:1000505", "base peak intensity", intensity.max(), "MS:1000131", "number of detector counts"),
+                _cv("MS:1000285", "total ion current", intensity.sum()),
+            ]
+        xml = [f'<spectrum index="{index}" id={quoteattr(native_id)} defaultArrayLength="{n}">\n']
+        xml += [f"        {p}\n" for p in params]
+        rt = _cv("MS:1000016", "scan start time", round(index * SCAN_TIME, 4), "UO:0000010", "second", "UO")
+        xml.append(f'        <scanList count="1">\n          {_cv("MS:1000795", "no combination")}\n')
+        xml.append(f"          <scan>\n            {rt}\n          </scan>\n        </scanList>\n")
+        if level == 2:
+            xml.append(f'        <precursorList count="1">\n          <precursor spectrumRef={quoteattr(ms1_id)}>\n')
+            if self.cv_params == "full":
+                window = [
+                    _cv("MS:1000827", "isolation window target m/z", target, "MS:1000040", "m/z"),
+                    _cv("MS:1000828", "isolation window lower offset", half_width, "MS:1000040", "m/z"),
+                    _cv("MS:1000829", "isolation window upper offset", half_width, "MS:1000040", "m/z"),
+                ]
+                xml.append("            <isolationWindow>\n")
+                xml += [f"              {p}\n" for p in window]
+                xml.append("            </isolationWindow>\n")
+            xml.append('            <selectedIonList count="1">\n              <selectedIon>\n')
+            xml.append(f'                {_cv("MS:1000744", "selected ion m/z", target, "MS:1000040", "m/z")}\n')
+            xml.append(f'                {_cv("MS:1000041", "charge state", int(rng.integers(2, 5)))}\n')
+            xml.append("              </selectedIon>\n            </selectedIonList>\n")
+            xml.append(
+                f'            <activation>\n              {_cv("MS:1000133", "collision-induced dissociation")}\n'
+            )
+            xml.append("            </activation>\n          </precursor>\n        </precursorList>\n")
+        xml.append('        <binaryDataArrayList count="2">\n')
+        xml.append(self.binary_xml(mz.astype(np.float64), _cv("MS:1000523", "64-bit float"), "MS:1000514", "m/z array"))
+        xml.append(self.binary_xml(intensity, _cv("MS:1000521", "32-bit float"), "MS:1000515", "intensity array"))
+        xml.append("        </binaryDataArrayList>\n      </spectrum>\n")
+        return "".join(xml)
+
+    def binary_xml(self, array: np.ndarray, precision: str, accession: str, name: str) -> str:
+        data = array.astype(array.dtype.newbyteorder("<")).tobytes()
+        if self.compression == "zlib":
+            data, compression = zlib.compress(data), _cv("MS:1000574", "zlib compression")
+        else:
+            compression = _cv("MS:1000576", "no compression")
+        encoded = base64.b64encode(data).decode()
+        return (
+            f'          <binaryDataArray encodedLength="{len(encoded)}">\n'
+            f"            {precision}\n            {compression}\n            {_cv(accession, name)}\n"
+            f"            <binary>{encoded}</binary>\n          </binaryDataArray>\n"
+        )
+
+    def write_tdf(self, out: Path) -> None:
+        """Writes the Frames, Precursors (DDA) or DIA window tables and the global metadata of a .d folder."""
+        rng = np.random.default_rng(self.seed)
+        levels = self.levels()
+        out.mkdir(parents=True, exist_ok=True)
+        tdf = out / "analysis.tdf"
+        tdf.unlink(missing_ok=True)
+        with sqlite3.connect(tdf) as conn:
+            conn.executescript(TDF_SCHEMA)
+            conn.executemany(
+                "INSERT INTO GlobalMetadata VALUES (?, ?)",
+                [("AcquisitionDateTime", ACQUISITION_DATETIME), ("SchemaType", "TDF"), ("SchemaVersionMajor", "3")],
+            )
+            peaks = rng.poisson(self.peaks * 50, self.spectra)
+            max_intensity = rng.integers(1000, 100000, self.spectra)
+            conn.executemany(
+                "INSERT INTO Frames VALUES (?, ?, '+', ?, ?, ?, ?, ?, 927, ?)",
+                [
+                    (
+                        i + 1,
+                        round(i * SCAN_TIME, 4),
+                        9 if self.acquisition == "dia" else 8,
+                        0 if levels[i] == 1 else TDF_MSMS_TYPES[self.acquisition],
+                        i * 4096,
+                        int(max_intensity[i]),
+                        int(max_intensity[i] * peaks[i] // 10),
+                        int(peaks[i]),
+                    )
+                    for i in range(self.spectra)
+                ],
+            )
+            ms2_frames = np.flatnonzero(levels == 2) + 1
+            if self.acquisition == "dia":
+                width = (MZ_RANGE[1] - MZ_RANGE[0]) / DIA_WINDOWS
+                conn.execute("INSERT INTO DiaFrameMsMsWindowGroups VALUES (1)")
+                conn.executemany(
+                    "INSERT INTO DiaFrameMsMsWindows VALUES (1, ?, ?, ?, ?, 30)",
+                    [(w * 28, (w + 1) * 28, MZ_RANGE[0] + (w + 0.5) * width, width) for w in range(DIA_WINDOWS)],
+                )
+                conn.executemany("INSERT INTO DiaFrameMsMsInfo VALUES (?, 1)", [(int(f),) for f in ms2_frames])
+            else:
+                # A few precursors per PASEF frame, each from the previous MS1 frame
+                rows, pasef = [], []
+                for frame in ms2_frames:
+                    parent = int(frame - (frame - 1) % (self.ms2_per_ms1 + 1))
+                    # Precursors of a frame are isolated on disjoint scan ranges
+                    for slot in np.sort(rng.choice(30, int(rng.integers(1, 4)), replace=False)):
+                        mz = float(rng.uniform(400, 1200))
+                        rows.append((len(rows) + 1, mz, mz, mz, int(rng.integers(2, 5)), 400.0, 1e4, parent))
+                        scan = int(slot) * 30
+                        pasef.append((int(frame), scan, scan + 25, mz, DDA_ISOLATION_WIDTH, 30.0, len(rows)))
+                conn.executemany("INSERT INTO Precursors VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                conn.executemany("INSERT INTO PasefFrameMsMsInfo VALUES (?, ?, ?, ?, ?, ?, ?)", pasef)
+
+    def write(self, out: Path, fmt: str) -> Path:
+        """Writes the acquisition as ``<out>.mzML`` or ``<out>.d``, with its parameters in a JSON sidecar."""
+        path = Path(f"{out}.mzML" if fmt == "mzml" else f"{out}.d")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        (self.write_mzml if fmt == "mzml" else self.write_tdf)(path)
+        with open(f"{out}.json", "w") as f:
+            json.dump({**asdict(self), "format": fmt, "path": path.name}, f, indent=2)
+        logger.info(f"{self.spectra} synthetic spectra written to {path}")
+        return path
+
+
+class _ChecksumWriter:
+    """Writes text to a binary file, keeping its SHA-1 and the offset of the next byte."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+        self.offset = 0
+
+    def write(self, text: str) -> None:
+        data = text.encode()
+        self.f.write(data)
+        self.sha1.update(data)
+        self.offset += len(data)
+
+
+def _cv(accession, name, value=None, unit_accession=None, unit_name=None, unit_cv="MS") -> str:
+    cv = "UO" if accession.startswith("UO") else "MS"
+    param = f'<cvParam cvRef="{cv}" accession="{accession}" name="{name}"'
+    if value is not None:
+        param += f' value="{value}"'
+    if unit_accession is not None:
+        param += f' unitCvRef="{unit_cv}" unitAccession="{unit_accession}" unitName="{unit_name}"'
+    return param + "/>"
+
+
+MZML_HEADER = """<?xml version="1.0" encoding="utf-8"?>
+<indexedmzML xmlns="http://psi.hupo.org/ms/mzml" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" \
+xsi:schemaLocation="http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.2_idx.xsd">
+<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0" id="synthetic">
+  <cvList count="2">
+    <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" version="4.1.0" \
+URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>
+    <cv id="UO" fullName="Unit Ontology" version="09:04:2014" \
+URI="https://raw.githubusercontent.com/bio-ontology-research-group/unit-ontology/master/unit.obo"/>
+  </cvList>
+  <fileDescription>
+    <fileContent>
+      <cvParam cvRef="MS" accession="MS:1000579" name="MS1 spectrum"/>
+      <cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum"/>
+    </fileContent>
+  </fileDescription>
+  <softwareList count="1">
+    <software id="synthetic_spectra" version="1.0">
+      <cvParam cvRef="MS" accession="MS:1000799" name="custom unreleased software tool" value="synthetic_spectra.py"/>
+    </software>
+  </softwareList>
+  <instrumentConfigurationList count="1">
+    <instrumentConfiguration id="IC1">
+      <cvParam cvRef="MS" accession="MS:1000031" name="instrument model"/>
+    </instrumentConfiguration>
+  </instrumentConfigurationList>
+  <dataProcessingList count="1">
+    <dataProcessing id="DP1">
+      <processingMethod order="0" softwareRef="synthetic_spectra">
+        <cvParam cvRef="MS" accession="MS:1000544" name="Conversion to mzML"/>
+      </processingMethod>
+    </dataProcessing>
+  </dataProcessingList>
+  <run id="synthetic" defaultInstrumentConfigurationRef="IC1" startTimeStamp="{date}">
+    <spectrumList count="{spectra}" defaultDataProcessingRef="DP1">
+"""
+
+# Subset of the columns of the TDF schema, enough for the tools reading the metadata only
+TDF_SCHEMA = """
+CREATE TABLE GlobalMetadata (Key TEXT PRIMARY KEY, Value TEXT);
+CREATE TABLE Frames (
+    Id INTEGER PRIMARY KEY, Time REAL NOT NULL, Polarity CHAR(1) NOT NULL, ScanMode INTEGER NOT NULL,
+    MsMsType INTEGER NOT NULL, TimsId INTEGER, MaxIntensity INTEGER NOT NULL, SummedIntensities INTEGER NOT NULL,
+    NumScans INTEGER NOT NULL, NumPeaks INTEGER NOT NULL
+);
+CREATE TABLE Precursors (
+    Id INTEGER PRIMARY KEY, LargestPeakMz REAL NOT NULL, AverageMz REAL NOT NULL, MonoisotopicMz REAL,
+    Charge INTEGER, ScanNumber REAL NOT NULL, Intensity REAL NOT NULL, Parent INTEGER
+);
+CREATE TABLE PasefFrameMsMsInfo (
+    Frame INTEGER NOT NULL, ScanNumBegin INTEGER NOT NULL, ScanNumEnd INTEGER NOT NULL, IsolationMz REAL NOT NULL,
+    IsolationWidth REAL NOT NULL, CollisionEnergy REAL NOT NULL, Precursor INTEGER,
+    PRIMARY KEY (Frame, ScanNumBegin)
+);
+CREATE TABLE DiaFrameMsMsWindowGroups (Id INTEGER PRIMARY KEY);
+CREATE TABLE DiaFrameMsMsWindows (
+    WindowGroup INTEGER NOT NULL, ScanNumBegin INTEGER NOT NULL, ScanNumEnd INTEGER NOT NULL,
+    IsolationMz REAL NOT NULL, IsolationWidth REAL NOT NULL, CollisionEnergy REAL NOT NULL,
+    PRIMARY KEY (WindowGroup, ScanNumBegin)
+);
+CREATE TABLE DiaFrameMsMsInfo (Frame INTEGER PRIMARY KEY, WindowGroup INTEGER NOT NULL);
+"""
+
+
+def spectra_options(function):
+    for option in reversed(
+        [
+            click.option("--out", "-o", required=True, help="Path of the file, without extension"),
+            click.option("--spectra", "-n", type=int, default=SyntheticSpectra.spectra, show_default=True),
+            click.option("--peaks", type=int, default=SyntheticSpectra.peaks, show_default=True),
+            click.option("--ms2_per_ms1", type=int, default=SyntheticSpectra.ms2_per_ms1, show_default=True),
+            click.option("--acquisition", type=click.Choice(["dda", "dia"]), default=SyntheticSpectra.acquisition),
+            click.option("--seed", type=int, default=SyntheticSpectra.seed, show_default=True),
+        ]
+    ):
+        function = option(function)
+    return function
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def cli():
+    pass
+
+
+@click.command("mzml")
+@spectra_options
+@click.option("--compression", type=click.Choice(["zlib", "none"]), default=SyntheticSpectra.compression)
+@click.option("--cv_params", type=click.Choice(["full", "minimal"]), default=SyntheticSpectra.cv_params)
+def mzml(out, **parameters):
+    """Generate an indexed mzML file."""
+    SyntheticSpectra(**parameters).write(Path(out), "mzml")
+
+
+@click.command("tdf")
+@spectra_options
+def tdf(out, **parameters):
+    """Generate a Bruker .d folder with its analysis.tdf database, one frame per spectrum."""
+    SyntheticSpectra(**parameters).write(Path(out), "tdf")
+
+
+cli.add_command(mzml)
+cli.add_command(tdf)
+
+if __name__ == "__main__":
+    cli()
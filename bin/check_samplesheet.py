@@ -4,13 +4,28 @@
 # This script is based on the example at: https://raw.githubusercontent.com/nf-core/test-datasets/viralrecon/samplesheet/samplesheet_test_illumina_amplicon.csv
 
 import argparse
+import csv
 import errno
+import hashlib
 import os
 import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-import pandas as pd
-from sdrf_pipelines.sdrf.sdrf import SdrfDataFrame
-from sdrf_pipelines.sdrf.sdrf_schema import DEFAULT_TEMPLATE, MASS_SPECTROMETRY
+from expdesign_parser import read_expdesign
+from sdrf_validator import validate_sdrf
+
+# Columns of the manifest of the spectra files written by the pre-flight check, reused to plan the resources
+MANIFEST_COLUMNS = ("run", "path", "format", "size_bytes", "checksum", "status")
+# Spectra files checked at the same time, the checks mostly waiting on the file system
+PREFLIGHT_THREADS = 16
+# Bytes read at each end of a spectra file to check its format
+PREFLIGHT_PEEK_BYTES = 4096
+# Thermo RAW files start with 0xA101 then "Finnigan" in UTF-16
+THERMO_RAW_MAGIC = b"\x01\xa1" + "Finnigan".encode("utf-16-le")
+SQLITE_MAGIC = b"SQLite format 3\x00"
+# Checksum algorithms, by the length of their hexadecimal digests
+CHECKSUM_ALGORITHMS = {32: "md5", 40: "sha1", 64: "sha256"}
 
 
 def parse_args(args=None):
@@ -21,6 +36,30 @@ def parse_args(args=None):
     parser.add_argument("SDRF", help="SDRF/Expdesign file to be validated")
     parser.add_argument("ISSDRF", help="SDRF file or Expdesign file")
     parser.add_argument("--CHECK_MS", help="check mass spectrometry fields in SDRF.", action="store_true")
+    parser.add_argument(
+        "--CACHE_DIR", help="Directory of the SDRF validation cache, $QUANTMS_CACHE_DIR or ~/.cache/quantms by default."
+    )
+    parser.add_argument(
+        "--ONTOLOGY_STORE",
+        help="Ontology store built by ontology_store.py, to validate the SDRF without network access.",
+    )
+    parser.add_argument(
+        "--PREFLIGHT",
+        help="check that the spectra files exist and have the content of their format.",
+        action="store_true",
+    )
+    parser.add_argument("--ROOT_FOLDER", help="Root folder of the spectra files, as the root_folder parameter.")
+    parser.add_argument("--LOCAL_INPUT_TYPE", help="Extension of the spectra files in the root folder, e.g. mzML.")
+    parser.add_argument("--CHECKSUMS", help="Checksums of the spectra files, as written by md5sum or sha256sum.")
+    parser.add_argument(
+        "--REMOTE_ONLY",
+        help="only check the remote spectra files, e.g. in a container that does not mount the local ones.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--THREADS", help="Spectra files checked at the same time.", type=int, default=PREFLIGHT_THREADS
+    )
+    parser.add_argument("--MANIFEST", help="Manifest of the spectra files.", default="spectra_manifest.tsv")
 
     return parser.parse_args(args)
 
@@ -44,82 +83,275 @@ def print_error(error, context="Line", context_str=""):
     sys.exit(1)
 
 
-def check_sdrf(check_ms, sdrf):
+def check_sdrf(check_ms, sdrf, cache_dir=None, ontology_store=None):
+    # Imported here rather than at the top, so only the validation that needs it pays for its import
+    from sdrf_pipelines.sdrf.sdrf import SdrfDataFrame
+    from sdrf_pipelines.sdrf.sdrf_schema import DEFAULT_TEMPLATE, MASS_SPECTROMETRY
+
+    if ontology_store is not None:
+        from ontology_store import OntologyStore
+
+        ontology_store = OntologyStore(ontology_store)
     df = SdrfDataFrame.parse(sdrf)
-    errors = df.validate(DEFAULT_TEMPLATE)
+    # Only the rows changed since the last validation of the file are checked again
+    errors = validate_sdrf(df, DEFAULT_TEMPLATE, cache_dir, ontology_store)
     if check_ms:
-        errors = errors + df.validate(MASS_SPECTROMETRY)
+        errors = errors + validate_sdrf(df, MASS_SPECTROMETRY, cache_dir, ontology_store)
     for error in errors:
         print(error)
     if not errors:
         print("Everying seems to be fine. Well done.")
     else:
         print("There were validation errors!")
-    sys.exit(bool(errors))
+        sys.exit(1)
 
 
 def check_expdesign(expdesign):
-    data = pd.read_csv(expdesign, sep="\t", header=0, dtype=str)
-    data = data.dropna()
-    schema_file = ["Fraction_Group", "Fraction", "Spectra_Filepath", "Label", "Sample"]
-    schema_sample = ["Sample", "MSstats_Condition", "MSstats_BioReplicate"]
-
-    # check table format: two table
-    with open(expdesign, "r") as f:
-        lines = f.readlines()
-        try:
-            empty_row = lines.index("\n")
-        except ValueError:
-            print("the one-table format parser is broken in OpenMS2.5, please use one-table or sdrf")
-            sys.exit(1)
-        if lines.index("\n") >= len(lines):
-            print("the one-table format parser is broken in OpenMS2.5, please use one-table or sdrf")
-            sys.exit(1)
-
-        s_table = [i.replace("\n", "").split("\t") for i in lines[empty_row + 1 :]][1:]
-        s_header = lines[empty_row + 1].replace("\n", "").split("\t")
-        s_DataFrame = pd.DataFrame(s_table, columns=s_header)
-
-    # check missed mandatory column
-    missed_columns = set(schema_file) - set(data.columns)
-    if len(missed_columns) != 0:
-        print("{0} column missed".format(" ".join(missed_columns)))
+    design = read_expdesign(expdesign, validate=True)
+    for error in design.errors:
+        print(error)
+    if design.errors:
         sys.exit(1)
 
-    missed_columns = set(schema_sample) - set(s_DataFrame.columns)
-    if len(missed_columns) != 0:
-        print("{0} column missed".format(" ".join(missed_columns)))
-        sys.exit(1)
 
-    if len(set(data.Label)) != 1 and "MSstats_Mixture" not in s_DataFrame.columns:
-        print("MSstats_Mixture column missed in ISO experiments")
-        sys.exit(1)
+def check_spectra_files(
+    design, is_sdrf, root_folder, local_input_type, checksums, threads, manifest, remote_only=False
+):
+    """Checks that every spectra file of a design exists and looks like a complete file of its format, and writes
+    their sizes to a manifest. The files are checked concurrently, and all the problems reported at once.
 
-    # check logical problem: may be improved
-    check_expdesign_logic(data, s_DataFrame)
+    Local files are checked in full, unless ``remote_only`` is set, and are then listed in the manifest as local.
+    HTTP(S) and FTP files are only checked to exist, with their size, and the others are listed in the manifest as
+    remote.
 
+    :param design: Path to the SDRF or experimental design
+    :type design: str
+    :param is_sdrf: Whether the design is an SDRF
+    :type is_sdrf: bool
+    :param root_folder: Folder of the spectra files, None to use their URIs
+    :type root_folder: str
+    :param local_input_type: Extension replacing the one of the spectra files in the root folder, e.g. "mzML"
+    :type local_input_type: str
+    :param checksums: Path to the checksums of the spectra files, by file name, None to skip them
+    :type checksums: str
+    :param threads: Spectra files checked at the same time
+    :type threads: int
+    :param manifest: Path to the manifest
+    :type manifest: str
+    :param remote_only: Whether to leave the local files unchecked, e.g. in a container where their host paths are
+        not mounted
+    :type remote_only: bool
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-def check_expdesign_logic(fTable, sTable):
-    if int(max(fTable.Fraction_Group)) > len(set(fTable.Fraction_Group)):
-        print("Fraction_Group discontinuous!")
-        sys.exit(1)
-    fTable_D = fTable.drop_duplicates(["Fraction_Group", "Fraction", "Label", "Sample"])
-    if fTable_D.shape[0] < fTable.shape[0]:
-        print("Existing duplicate entries in Fraction_Group, Fraction, Label and Sample")
-        sys.exit(1)
-    if len(set(sTable.Sample)) < sTable.shape[0]:
-        print("Existing duplicate Sample in sample table!")
+    files = spectra_files(design, is_sdrf, root_folder, local_input_type)
+    expected = read_checksums(checksums) if checksums else {}
+    paths = list(dict.fromkeys(path for _, path in files))
+
+    def check(path):
+        return check_spectra_file(path, expected.get(path.rsplit("/", 1)[-1]), remote_only)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        checked = dict(zip(paths, pool.map(check, paths)))
+
+    with open(manifest, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(MANIFEST_COLUMNS)
+        for run, path in files:
+            writer.writerow([run, path, *checked[path]])
+
+    errors = [f"{path}: {status}" for path, (*_, status) in checked.items() if status not in ("ok", "remote", "local")]
+    for error in errors:
+        print(f"ERROR: Please check spectra file -> {error}")
+    total = sum(size for _, size, _, _ in checked.values() if size != "")
+    unchecked = sum(status == "local" for *_, status in checked.values())
+    print(
+        f"{len(paths) - unchecked} spectra files checked, {total / 1024**3:.1f} GiB, {len(errors)} with errors"
+        + (f", {unchecked} local files left unchecked" if unchecked else "")
+    )
+    if errors:
         sys.exit(1)
 
 
+def spectra_files(design, is_sdrf, root_folder=None, local_input_type=None) -> List[Tuple[str, str]]:
+    """The run names and paths of the spectra files of a design, resolved as the pipeline does.
+
+    :return: A (run, path) pair for each row of the design
+    :rtype: list
+    """
+    if is_sdrf:
+        # Read as is, the parsing of sdrf-pipelines lowercasing the file names
+        with open(design, newline="") as f:
+            rows = list(csv.reader(f, delimiter="\t"))
+        header = [c.strip().lower() for c in rows[0]]
+        column = "comment[data file]" if root_folder else "comment[file uri]"
+        if column not in header:
+            raise ValueError(f"{column} column missed in the SDRF {design}")
+        names = [row[header.index(column)] for row in rows[1:] if any(row)]
+    else:
+        names = list(read_expdesign(design).file_table["Spectra_Filepath"])
+
+    files = []
+    for name in names:
+        file_name = name.rsplit("/", 1)[-1]
+        run = file_name[: file_name.rfind(".")] if "." in file_name else file_name
+        path = name
+        if root_folder:
+            path = f"{root_folder}/{name}"
+            if local_input_type:
+                path = f"{path[: path.rfind('.')]}.{local_input_type}"
+        files.append((run, path))
+    return files
+
+
+def read_checksums(path) -> Dict[str, str]:
+    """Reads checksums written by md5sum, sha1sum or sha256sum, by file name."""
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                digest, name = line.strip().split(maxsplit=1)
+                checksums[name.lstrip("*").rsplit("/", 1)[-1]] = digest.lower()
+    return checksums
+
+
+def check_spectra_file(path, checksum=None, remote_only=False) -> Tuple[str, object, str, str]:
+    """Checks a spectra file exists and has the leading and trailing bytes of its format, and its checksum if one
+    is given.
+
+    :return: The format, size, checksum and status of the file, the status being "ok", "remote", "local" for the
+        local files left unchecked with ``remote_only``, or the problem
+    :rtype: tuple
+    """
+    if "://" in path and not path.startswith("file://"):
+        # Checked from their metadata only, never downloaded
+        fmt = path.rstrip("/").rsplit(".", 1)[-1]
+        try:
+            size = remote_file_size(path)
+        except FileNotFoundError:
+            return fmt, "", "", "missing"
+        except OSError as e:
+            return fmt, "", "", f"not reachable ({e})"
+        return fmt, "" if size is None else size, "", "remote" if size is None else "ok"
+    file = Path(path[len("file://") :] if path.startswith("file://") else path)
+    fmt = file.suffix.lstrip(".")
+    if remote_only:
+        return fmt, "", "", "local"
+    if not file.exists():
+        return fmt, "", "", "missing"
+    try:
+        if file.is_dir():
+            size = sum(f.stat().st_size for f in file.rglob("*") if f.is_file())
+        else:
+            size = file.stat().st_size
+        error = spectra_format_error(file, size)
+        if error:
+            return fmt, size, "", error
+        if checksum:
+            algorithm = CHECKSUM_ALGORITHMS.get(len(checksum))
+            if algorithm is None:
+                return fmt, size, "", f"unknown checksum {checksum}"
+            digest = hashlib.new(algorithm)
+            with open(file, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            if digest.hexdigest() != checksum:
+                return fmt, size, digest.hexdigest(), f"{algorithm} checksum {digest.hexdigest()} instead of {checksum}"
+            checksum = digest.hexdigest()
+    except OSError as e:
+        return fmt, "", "", f"not readable ({e.strerror})"
+    return fmt, size, checksum or "", "ok"
+
+
+def remote_file_size(path) -> Optional[int]:
+    """The size of an HTTP(S) or FTP file, from a HEAD request or the SIZE command, None for other schemes or when
+    the server does not give it.
+
+    :raises FileNotFoundError: If the server has no such file
+    """
+    import ftplib
+    import urllib.error
+    import urllib.request
+    from urllib.parse import urlparse
+
+    url = urlparse(path)
+    if url.scheme in ("http", "https"):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(path, method="HEAD"), timeout=60) as response:
+                length = response.headers.get("Content-Length")
+        except urllib.error.HTTPError as e:
+            if e.code in (404, 410):
+                raise FileNotFoundError(path) from e
+            raise
+        return int(length) if length is not None else None
+    if url.scheme == "ftp":
+        with ftplib.FTP(url.hostname, timeout=60) as ftp:
+            ftp.login()
+            ftp.voidcmd("TYPE I")
+            try:
+                return ftp.size(url.path)
+            except ftplib.error_perm as e:
+                raise FileNotFoundError(path) from e
+    return None
+
+
+def spectra_format_error(file: Path, size: int) -> Optional[str]:
+    """The problem of the content of a spectra file given its extension, None if it looks like a complete file."""
+    suffix = file.suffix.lower()
+    if suffix == ".d":
+        if not (file / "analysis.tdf").is_file() or not (file / "analysis.tdf_bin").is_file():
+            return "Bruker .d folder without analysis.tdf and analysis.tdf_bin"
+        with open(file / "analysis.tdf", "rb") as f:
+            if f.read(len(SQLITE_MAGIC)) != SQLITE_MAGIC:
+                return "analysis.tdf is not an SQLite database"
+        return None
+    if size == 0:
+        return "empty file"
+    with open(file, "rb") as f:
+        head = f.read(PREFLIGHT_PEEK_BYTES)
+        f.seek(max(0, size - PREFLIGHT_PEEK_BYTES))
+        tail = f.read()
+    if suffix == ".mzml":
+        if b"<mzML" not in head and b"<indexedmzML" not in head:
+            return "not an mzML file"
+        if b"</mzML>" not in tail and b"</indexedmzML>" not in tail:
+            return "truncated mzML file, its closing tag is missing"
+    elif suffix == ".raw" and not head.startswith(THERMO_RAW_MAGIC):
+        return "not a Thermo RAW file"
+    elif suffix == ".gz" and not head.startswith(b"\x1f\x8b"):
+        return "not a gzip file"
+    elif suffix == ".zip":
+        if not head.startswith(b"PK\x03\x04"):
+            return "not a zip file"
+        if b"PK\x05\x06" not in tail:
+            return "truncated zip file, its central directory is missing"
+    elif suffix == ".tar":
+        if head[257:262] != b"ustar":
+            return "not a tar file"
+        if size % 512:
+            return "truncated tar file, its size is not a multiple of 512 bytes"
+    return None
+
+
 def main(args=None):
     # TODO validate expdesign file
     args = parse_args(args)
 
     if args.ISSDRF == "true":
-        check_sdrf(args.CHECK_MS, args.SDRF)
+        check_sdrf(args.CHECK_MS, args.SDRF, args.CACHE_DIR, args.ONTOLOGY_STORE)
     else:
         check_expdesign(args.SDRF)
+    if args.PREFLIGHT:
+        check_spectra_files(
+            args.SDRF,
+            args.ISSDRF == "true",
+            args.ROOT_FOLDER,
+            args.LOCAL_INPUT_TYPE,
+            args.CHECKSUMS,
+            args.THREADS,
+            args.MANIFEST,
+            args.REMOTE_ONLY,
+        )
 
 
 if __name__ == "__main__":
@@ -6,33 +6,73 @@ Authors: Hong Wong, Yasset Perez-Riverol
 Revisions:
     2023-Aug-05: J. Sebastian Paez
 """
+from __future__ import annotations
+
+import cProfile
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
 import logging
+import mmap
 import os
 import re
-from dataclasses import dataclass
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
 from pathlib import Path
-from typing import Any, List, Tuple, Dict, Set, Union
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import click
-import numpy as np
-import pandas as pd
-from pyopenms import AASequence, FASTAFile, ModificationsDB
-from pyopenms.Constants import PROTON_MASS_U
+from expdesign_parser import read_expdesign
+from unimod_resolver import UnimodResolver, split_modification
 
-pd.set_option("display.max_rows", 500)
-pd.set_option("display.max_columns", 500)
-pd.set_option("display.width", 1000)
+
+def lazy_import(name: str):
+    """Imports a module on the first access to one of its attributes, so ``--help`` and commands that do not
+    need it start without paying for its import. pyOpenMS is instead imported in the functions using it."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
-REVISION = "0.1.1"
+REVISION = "0.1.2"
+# Rows of the main report read at a time when only some runs are converted
+REPORT_CHUNKSIZE = 1_000_000
+# Maximum difference in retention time between a precursor and the MS2 spectrum it is matched to, in minutes
+SPECTRUM_RT_TOLERANCE = 0.5
+# Output formats of the MSstats and Triqler tables, with the suffix of their files
+TABLE_FORMATS = {"text": "", "gzip": ".gz", "zstd": ".zst", "parquet": ".parquet"}
+# Uncompressed bytes per gzip member, each of them compressed by a thread
+GZIP_BLOCKSIZE = 16 * 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+PARQUET_COMPRESSION = "zstd"
 
-logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
 @click.group(context_settings=CONTEXT_SETTINGS)
 def cli():
-    pass
+    # Configured when a command runs rather than on import, and only this script logs its progress at DEBUG level
+    logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+    logger.setLevel(logging.DEBUG)
 
 
 @click.command("convert")
@@ -43,8 +83,29 @@ def cli():
 @click.option("--charge", "-c")
 @click.option("--missed_cleavages", "-m")
 @click.option("--qvalue_threshold", "-q", type=float)
+@click.option(
+    "--spectrum_rt_tolerance",
+    type=float,
+    default=SPECTRUM_RT_TOLERANCE,
+    show_default=True,
+    help="Maximum difference in retention time between a precursor and its MS2 spectrum, in minutes",
+)
+@click.option("--table_format", type=click.Choice(list(TABLE_FORMATS)), default="text", show_default=True)
+@click.option("--profile", is_flag=True, help="Profile every stage with cProfile")
 @click.pass_context
-def convert(ctx, folder, exp_design, dia_params, diann_version, charge, missed_cleavages, qvalue_threshold):
+def convert(
+    ctx,
+    folder,
+    exp_design,
+    dia_params,
+    diann_version,
+    charge,
+    missed_cleavages,
+    qvalue_threshold,
+    spectrum_rt_tolerance,
+    table_format,
+    profile,
+):
     """
     Convert DIA-NN output to MSstats, Triqler or mzTab.
      The output formats are
@@ -64,14 +125,496 @@ def convert(ctx, folder, exp_design, dia_params, diann_version, charge, missed_c
     :type missed_cleavages: int
     :param qvalue_threshold: Threshold for filtering q value
     :type qvalue_threshold: float
+    :param spectrum_rt_tolerance: Maximum difference in retention time between a precursor and the MS2
+        spectrum it is matched to, in minutes. The spectra_ref of precursors without one is null
+    :type spectrum_rt_tolerance: float
+    :param table_format: Format of the MSstats and Triqler tables, one of TABLE_FORMATS. The "gzip" and
+        "zstd" ones compress the text tables, "parquet" writes them as Parquet files
+    :type table_format: str
+    :param profile: If set, every stage is profiled with cProfile, see StageMetrics
+    :type profile: bool
     """
     logger.debug(f"Revision {REVISION}")
     logger.debug("Reading input files...")
+    exp_out_prefix = Path(exp_design).stem
+    METRICS.start(ctx.info_name, exp_out_prefix, profile=profile)
+    diann_directory = DiannDirectory(folder, diann_version_file=diann_version)
+    report = diann_directory.main_report_df(qvalue_threshold=qvalue_threshold)
+    s_DataFrame, f_table = get_exp_design_dfs(exp_design)
+
+    convert_report(
+        diann_directory,
+        report=report,
+        s_DataFrame=s_DataFrame,
+        f_table=f_table,
+        charge=charge,
+        missed_cleavages=missed_cleavages,
+        dia_params=dia_params,
+        exp_out_prefix=exp_out_prefix,
+        table_format=table_format,
+        spectrum_rt_tolerance=spectrum_rt_tolerance,
+    )
+    METRICS.save(f"{exp_out_prefix}_metrics.json")
+
+
+@click.command("shard")
+@click.option("--folder", "-f")
+@click.option("--exp_design", "-d")
+@click.option("--diann_version", "-v")
+@click.option("--qvalue_threshold", "-q", type=float)
+@click.option("--shard_index", "-i", type=int, default=0)
+@click.option("--num_shards", "-n", type=int, default=1)
+@click.option(
+    "--spectrum_rt_tolerance",
+    type=float,
+    default=SPECTRUM_RT_TOLERANCE,
+    show_default=True,
+    help="Maximum difference in retention time between a precursor and its MS2 spectrum, in minutes",
+)
+@click.option("--profile", is_flag=True, help="Profile every stage with cProfile")
+@click.pass_context
+def shard(
+    ctx, folder, exp_design, diann_version, qvalue_threshold, shard_index, num_shards, spectrum_rt_tolerance, profile
+):
+    """
+    Convert the runs of one shard of a DIA-NN experiment.
+
+    The runs in the experimental design are split in ``num_shards`` contiguous chunks and only
+    the rows of the report belonging to the runs of chunk ``shard_index`` are read. The MSstats,
+    Triqler and PSH rows of those runs are written, together with the partial aggregates needed
+    to build the PRH and PEH sub-tables, to a ``<exp_design>_shard_<shard_index>`` directory
+    that is consumed by the ``merge`` command.
+
+    :param folder: Folder containing the DiaNN main report, the ms_info TSVs and the protein
+        sequence FASTA file
+    :type folder: str
+    :param exp_design: Path to the experimental design file
+    :type exp_design: str
+    :param diann_version: Path to a version file of DIA-NN
+    :type diann_version: str
+    :param qvalue_threshold: Threshold for filtering q value
+    :type qvalue_threshold: float
+    :param shard_index: Index of the shard to convert, starting at 0
+    :type shard_index: int
+    :param num_shards: Total number of shards the runs are split in
+    :type num_shards: int
+    :param spectrum_rt_tolerance: Maximum difference in retention time between a precursor and the MS2
+        spectrum it is matched to, in minutes
+    :type spectrum_rt_tolerance: float
+    :param profile: If set, every stage is profiled with cProfile, see StageMetrics
+    :type profile: bool
+    """
+    logger.debug(f"Revision {REVISION}")
+    shard_directory = ShardDirectory(f"{Path(exp_design).stem}_shard_{shard_index}")
+    METRICS.start(ctx.info_name, shard_directory.base_path / "metrics", profile=profile)
+    diann_directory = DiannDirectory(folder, diann_version_file=diann_version)
+    s_DataFrame, f_table = get_exp_design_dfs(exp_design)
+    runs = shard_runs(f_table, shard_index=shard_index, num_shards=num_shards)
+    logger.info(f"Converting shard {shard_index + 1}/{num_shards} with {len(runs)} runs")
+    report = diann_directory.main_report_df(qvalue_threshold=qvalue_threshold, runs=runs)
+
+    converted = convert_shard(diann_directory, report, s_DataFrame, f_table, spectrum_rt_tolerance)
+    with METRICS.stage("write"):
+        shard_directory.write(shard_index=shard_index, num_shards=num_shards, runs=runs, **converted)
+    METRICS.save(shard_directory.base_path / "metrics.json")
+    logger.info(f"Shard {shard_index} saved in {shard_directory.base_path}")
+
+
+@click.command("merge")
+@click.option("--folder", "-f")
+@click.option("--exp_design", "-d")
+@click.option("--diann_version", "-v")
+@click.option("--dia_params", "-p")
+@click.option("--charge", "-c")
+@click.option("--missed_cleavages", "-m")
+@click.option("--shards_folder", "-s", default=None)
+@click.option("--table_format", type=click.Choice(list(TABLE_FORMATS)), default="text", show_default=True)
+@click.option("--profile", is_flag=True, help="Profile every stage with cProfile")
+@click.pass_context
+def merge(
+    ctx, folder, exp_design, diann_version, dia_params, charge, missed_cleavages, shards_folder, table_format, profile
+):
+    """
+    Merge the shards written by the ``shard`` command into the MSstats, Triqler and mzTab outputs.
+
+    The MSstats, Triqler and PSH rows of the shards are concatenated as they are, the partial
+    aggregates are combined to build the PRH and PEH sub-tables, so the main report is never read.
+
+    :param folder: Folder containing the protein matrix, precursor matrix and protein sequence
+        FASTA file of DiaNN
+    :type folder: str
+    :param exp_design: Path to the experimental design file
+    :type exp_design: str
+    :param diann_version: Path to a version file of DIA-NN
+    :type diann_version: str
+    :param dia_params: A list contains DIA parameters
+    :type dia_params: list
+    :param charge: The charge assigned by DIA-NN(max_precursor_charge)
+    :type charge: int
+    :param missed_cleavages: Allowed missed cleavages assigned by DIA-NN
+    :type missed_cleavages: int
+    :param shards_folder: Folder in which the shard directories are searched, defaults to ``folder``
+    :type shards_folder: str
+    :param profile: If set, every stage is profiled with cProfile, see StageMetrics
+    :type profile: bool
+    """
+    logger.debug(f"Revision {REVISION}")
+    exp_out_prefix = Path(exp_design).stem
+    METRICS.start(ctx.info_name, exp_out_prefix, profile=profile)
+    diann_directory = DiannDirectory(folder, diann_version_file=diann_version)
+    _, f_table = get_exp_design_dfs(exp_design)
+    shards = ShardDirectory.find_all(shards_folder or folder)
+    logger.info(f"Merging {len(shards)} shards")
+
+    merge_shards(
+        diann_directory,
+        shards=shards,
+        f_table=f_table,
+        charge=charge,
+        missed_cleavages=missed_cleavages,
+        dia_params=dia_params,
+        exp_out_prefix=exp_out_prefix,
+        table_format=table_format,
+    )
+    METRICS.save(f"{exp_out_prefix}_metrics.json")
+
+
+@click.command("incremental")
+@click.option("--folder", "-f")
+@click.option("--exp_design", "-d")
+@click.option("--diann_version", "-v")
+@click.option("--dia_params", "-p")
+@click.option("--charge", "-c")
+@click.option("--missed_cleavages", "-m")
+@click.option("--qvalue_threshold", "-q", type=float)
+@click.option("--state_dir", "-s", help="Directory with the state of the previous conversion, updated in place")
+@click.option("--self_check", is_flag=True, help="Check the outputs against a conversion from scratch")
+@click.option(
+    "--spectrum_rt_tolerance",
+    type=float,
+    default=SPECTRUM_RT_TOLERANCE,
+    show_default=True,
+    help="Maximum difference in retention time between a precursor and its MS2 spectrum, in minutes",
+)
+@click.option("--table_format", type=click.Choice(list(TABLE_FORMATS)), default="text", show_default=True)
+@click.option("--profile", is_flag=True, help="Profile every stage with cProfile")
+@click.pass_context
+def incremental(
+    ctx,
+    folder,
+    exp_design,
+    diann_version,
+    dia_params,
+    charge,
+    missed_cleavages,
+    qvalue_threshold,
+    state_dir,
+    self_check,
+    spectrum_rt_tolerance,
+    table_format,
+    profile,
+):
+    """
+    Convert DIA-NN output to MSstats, Triqler or mzTab, reusing the state of a previous conversion.
+
+    The state directory keeps the converted rows and report aggregates of every run (as written by
+    the ``shard`` command), with a fingerprint of the report rows, design entries and ms_info file
+    of the run. Only the runs whose fingerprint changed, or that are new, are converted again; the
+    aggregates of the untouched runs are reused as stored and combined with the new ones into the
+    PRH and PEH sub-tables. Runs no longer in the report are dropped from the state.
+
+    :param folder: DiannConvert specifies the folder where the required file resides. The folder contains
+        the DiaNN main report, protein matrix, precursor matrix, experimental design file, protein sequence
+        FASTA file, version file of DiaNN and ms_info TSVs
+    :type folder: str
+    :param state_dir: Directory with the state of the previous conversion, created if it does not exist
+    :type state_dir: str
+    :param self_check: If set, the outputs are compared to the ones of a conversion from scratch, and
+        a ValueError is raised if they are not equivalent
+    :type self_check: bool
+    :param spectrum_rt_tolerance: Maximum difference in retention time between a precursor and the MS2
+        spectrum it is matched to, in minutes
+    :type spectrum_rt_tolerance: float
+    :param profile: If set, every stage is profiled with cProfile, see StageMetrics
+    :type profile: bool
+    """
+    logger.debug(f"Revision {REVISION}")
+    exp_out_prefix = Path(exp_design).stem
+    METRICS.start(ctx.info_name, exp_out_prefix, profile=profile)
     diann_directory = DiannDirectory(folder, diann_version_file=diann_version)
     report = diann_directory.main_report_df(qvalue_threshold=qvalue_threshold)
     s_DataFrame, f_table = get_exp_design_dfs(exp_design)
+    state = ConversionState(state_dir)
+
+    with METRICS.stage("fingerprints") as stage:
+        fingerprints = run_fingerprints(
+            diann_directory, report, s_DataFrame, f_table, qvalue_threshold, spectrum_rt_tolerance
+        )
+        stage["rows"] = len(fingerprints)
+    previous = state.fingerprints()
+    changed = sorted(run for run, fingerprint in fingerprints.items() if previous.get(run) != fingerprint)
+    removed = sorted(set(previous) - set(fingerprints))
+    changed_precursors = report.loc[report["Run"].isin(changed), "Precursor.Id"].nunique()
+    logger.info(
+        f"{len(changed)} of {len(fingerprints)} runs changed ({changed_precursors} precursors),"
+        f" {len(removed)} runs removed"
+    )
+
+    for run in removed:
+        state.remove(run)
+    run_rows = report.groupby("Run").indices
+    for run in changed:
+        logger.info(f"Converting run {run}")
+        with METRICS.stage(run):
+            converted = convert_shard(
+                diann_directory, report.iloc[run_rows[run]], s_DataFrame, f_table, spectrum_rt_tolerance
+            )
+            with METRICS.stage("write"):
+                state.shard(run).write(
+                    shard_index=0, num_shards=1, runs=[run], fingerprint=fingerprints[run], **converted
+                )
+
+    merge_shards(
+        diann_directory,
+        shards=[state.shard(run) for run in sorted(fingerprints)],
+        f_table=f_table,
+        charge=charge,
+        missed_cleavages=missed_cleavages,
+        dia_params=dia_params,
+        exp_out_prefix=exp_out_prefix,
+        table_format=table_format,
+    )
+
+    if self_check:
+        logger.info("Checking the outputs against a conversion from scratch")
+        with tempfile.TemporaryDirectory() as tmp_dir, METRICS.stage("self check"):
+            reference_prefix = os.path.join(tmp_dir, exp_out_prefix)
+            convert_report(
+                diann_directory,
+                report=report,
+                s_DataFrame=s_DataFrame,
+                f_table=f_table,
+                charge=charge,
+                missed_cleavages=missed_cleavages,
+                dia_params=dia_params,
+                exp_out_prefix=reference_prefix,
+                table_format=table_format,
+                spectrum_rt_tolerance=spectrum_rt_tolerance,
+            )
+            differences = compare_outputs(reference_prefix, exp_out_prefix, table_format=table_format)
+        if differences:
+            for difference in differences:
+                logger.error(difference)
+            raise ValueError("The incremental conversion differs from a conversion from scratch")
+        logger.info("The incremental conversion is equivalent to a conversion from scratch")
+    METRICS.save(f"{exp_out_prefix}_metrics.json")
+
+
+def convert_report(
+    diann_directory: "DiannDirectory",
+    report: pd.DataFrame,
+    s_DataFrame: pd.DataFrame,
+    f_table: pd.DataFrame,
+    charge: int,
+    missed_cleavages: int,
+    dia_params: List[Any],
+    exp_out_prefix: str,
+    table_format: str = "text",
+    spectrum_rt_tolerance: float = SPECTRUM_RT_TOLERANCE,
+) -> None:
+    """Converts a whole report to the MSstats, Triqler and mzTab files starting with ``exp_out_prefix``."""
+    logger.debug("Converting to MSstats format...")
+    with METRICS.stage("MSstats") as stage:
+        out_msstats = msstats_table(report, s_DataFrame, f_table)
+        path = write_table(out_msstats.drop(columns=["Q.Value"]), exp_out_prefix + "_msstats_in.csv", table_format)
+        stage["rows"] = len(out_msstats)
+    logger.info(f"MSstats input file is saved as {path}")
+
+    # Convert to Triqler
+    with METRICS.stage("Triqler") as stage:
+        out_triqler = triqler_table(out_msstats)
+        del out_msstats
+        path = write_table(out_triqler, exp_out_prefix + "_triqler_in.tsv", table_format)
+        stage["rows"] = len(out_triqler)
+    logger.info(f"Triqler input file is saved as {path}")
+    del out_triqler
+
+    # Convert to mzTab
+    diann_directory.convert_to_mztab(
+        report=report,
+        f_table=f_table,
+        charge=charge,
+        missed_cleavages=missed_cleavages,
+        dia_params=dia_params,
+        out=f"{exp_out_prefix}_out.mzTab",
+        spectrum_rt_tolerance=spectrum_rt_tolerance,
+    )
+
+
+def convert_shard(
+    diann_directory: "DiannDirectory",
+    report: pd.DataFrame,
+    s_DataFrame: pd.DataFrame,
+    f_table: pd.DataFrame,
+    spectrum_rt_tolerance: float = SPECTRUM_RT_TOLERANCE,
+) -> Dict[str, Any]:
+    """Converts the rows of the report of a subset of the runs.
+
+    :return: The MSstats, Triqler and PSH tables and the report aggregates, as keyword arguments
+        of ShardDirectory.write
+    :rtype: dict
+    """
+    with METRICS.stage("MSstats") as stage:
+        out_msstats = msstats_table(report, s_DataFrame, f_table)
+        stage["rows"] = len(out_msstats)
+    with METRICS.stage("Triqler") as stage:
+        out_triqler = triqler_table(out_msstats)
+        stage["rows"] = len(out_triqler)
+    out_msstats.drop(columns=["Q.Value"], inplace=True)
+
+    index_ref = mztab_index_ref(f_table)
+    report = report.merge(index_ref[["ms_run", "Run", "study_variable"]], on="Run", validate="many_to_one")
+    with METRICS.stage("aggregates") as stage:
+        aggregates = ReportAggregates.from_report(report)
+        stage["rows"] = len(report)
+    with METRICS.stage("PSH") as stage, FastaIndex(diann_directory.fasta) as fasta:
+        PSH = mztab_PSH(
+            report,
+            str(diann_directory.base_path),
+            fasta_database_name(str(fasta.fasta)),
+            fasta,
+            rt_tolerance=spectrum_rt_tolerance,
+        )
+        stage["rows"] = len(PSH)
+
+    return dict(out_msstats=out_msstats, out_triqler=out_triqler, PSH=PSH, aggregates=aggregates)
+
+
+def merge_shards(
+    diann_directory: "DiannDirectory",
+    shards: List["ShardDirectory"],
+    f_table: pd.DataFrame,
+    charge: int,
+    missed_cleavages: int,
+    dia_params: List[Any],
+    exp_out_prefix: str,
+    table_format: str = "text",
+) -> None:
+    """Writes the MSstats, Triqler and mzTab files starting with ``exp_out_prefix`` from converted shards."""
+    with METRICS.stage("MSstats"):
+        path = concat_tables([s.msstats for s in shards], exp_out_prefix + "_msstats_in.csv", table_format)
+    logger.info(f"MSstats input file is saved as {path}")
+    with METRICS.stage("Triqler"):
+        path = concat_tables([s.triqler for s in shards], exp_out_prefix + "_triqler_in.tsv", table_format)
+    logger.info(f"Triqler input file is saved as {path}")
+
+    with METRICS.stage("aggregates"):
+        aggregates = ReportAggregates.combine([s.aggregates() for s in shards])
+    diann_directory.write_mztab(
+        index_ref=mztab_index_ref(f_table),
+        aggregates=aggregates,
+        PSH=[s.psh for s in shards],
+        charge=charge,
+        missed_cleavages=missed_cleavages,
+        dia_params=dia_params,
+        out=f"{exp_out_prefix}_out.mzTab",
+    )
+
+
+class StageMetrics:
+    """Resources used by the stages of a conversion, saved as JSON next to its outputs.
+
+    Every stage records its wall and CPU time, the peak resident set size of the process at its end,
+    how much the stage raised it, and the number of rows it produced. Stages can be nested, the name
+    of a nested stage is then prefixed by the ones of its parents (e.g. ``PRH/coverage``) and its
+    resources are also counted in theirs.
+
+    With profiling on, the outermost stages run under cProfile and their profiles are dumped to a
+    ``<prefix>_profiles`` directory, one ``.prof`` file per stage, to be read with pstats or snakeviz.
+    """
+
+    def __init__(self):
+        self.command: Optional[str] = None
+        self.stages: List[Dict[str, Any]] = []
+        self.profile_dir: Optional[Path] = None
+        self._names: List[str] = []
+        self._profiling = False
+
+    def start(self, command: str, prefix: os.PathLike, profile: bool = False) -> None:
+        """Clears the recorded stages, profiling them in ``<prefix>_profiles`` if ``profile`` is set."""
+        self.command = command
+        self.stages = []
+        self.profile_dir = None
+        if profile:
+            self.profile_dir = Path(f"{prefix}_profiles")
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def peak_rss_mb() -> float:
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / (1024 if os.uname().sysname == "Darwin" else 1)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, Any]]:
+        """Measures the code run in the context, which can set the "rows" of the yielded record."""
+        self._names.append(name)
+        record: Dict[str, Any] = {"stage": "/".join(self._names), "rows": None}
+        self.stages.append(record)
+        profiler = None
+        if self.profile_dir is not None and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+        peak_rss = self.peak_rss_mb()
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall_time_s"] = round(time.perf_counter() - wall_time, 6)
+            record["cpu_time_s"] = round(time.process_time() - cpu_time, 6)
+            end_peak_rss = self.peak_rss_mb()
+            record["peak_rss_mb"] = round(end_peak_rss, 3)
+            record["peak_rss_delta_mb"] = round(end_peak_rss - peak_rss, 3)
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                record["profile"] = str(self.profile_dir / (re.sub(r"\W+", "_", record["stage"]) + ".prof"))
+                profiler.dump_stats(record["profile"])
+            self._names.pop()
+            logger.debug(
+                f"Stage {record['stage']}: {record['wall_time_s']:.2f} s wall, {record['cpu_time_s']:.2f} s CPU,"
+                f" peak RSS {record['peak_rss_mb']:.0f} MB (+{record['peak_rss_delta_mb']:.0f} MB)"
+            )
+
+    def save(self, out: os.PathLike) -> None:
+        with open(out, "w") as f:
+            json.dump({"revision": REVISION, "command": self.command, "stages": self.stages}, f, indent=2)
+        logger.info(f"Stage metrics saved in {out}")
+
+
+METRICS = StageMetrics()
+
+
+def msstats_table(report: pd.DataFrame, s_DataFrame: pd.DataFrame, f_table: pd.DataFrame) -> pd.DataFrame:
+    """
+    Construct the MSstats input table.
+
+    The precursor "Q.Value" is kept as the last column of the table, since it is needed for the
+    Triqler search score; it has to be dropped before writing the MSstats input file.
+
+    :param report: Dataframe for Dia-NN main report
+    :type report: pandas.core.frame.DataFrame
+    :param s_DataFrame: Sample table of the experimental design
+    :type s_DataFrame: pandas.core.frame.DataFrame
+    :param f_table: File table of the experimental design
+    :type f_table: pandas.core.frame.DataFrame
+    :return: MSstats input table
+    :rtype: pandas.core.frame.DataFrame
+    """
+    from pyopenms import AASequence
 
-    # Convert to MSstats
     msstats_columns_keep = [
         "Protein.Names",
         "Modified.Sequence",
@@ -79,11 +622,19 @@ def convert(ctx, folder, exp_design, dia_params, diann_version, charge, missed_c
         "Precursor.Quantity",
         "File.Name",
         "Run",
+        "Q.Value",
     ]
 
-    logger.debug("Converting to MSstats format...")
     out_msstats = report[msstats_columns_keep]
-    out_msstats.columns = ["ProteinName", "PeptideSequence", "PrecursorCharge", "Intensity", "Reference", "Run"]
+    out_msstats.columns = [
+        "ProteinName",
+        "PeptideSequence",
+        "PrecursorCharge",
+        "Intensity",
+        "Reference",
+        "Run",
+        "Q.Value",
+    ]
     out_msstats = out_msstats[out_msstats["Intensity"] != 0]
 
     # Q: What is this line doing?
@@ -122,33 +673,320 @@ def convert(ctx, folder, exp_design, dia_params, diann_version, charge, missed_c
         on="Run",
         validate="many_to_one",
     )
-    exp_out_prefix = Path(exp_design).stem
-    out_msstats.to_csv(exp_out_prefix + "_msstats_in.csv", sep=",", index=False)
-    logger.info(f"MSstats input file is saved as {exp_out_prefix}_msstats_in.csv")
 
-    # Convert to Triqler
-    triqler_cols = ["ProteinName", "PeptideSequence", "PrecursorCharge", "Intensity", "Run", "Condition"]
+    return out_msstats[[c for c in out_msstats.columns if c != "Q.Value"] + ["Q.Value"]]
+
+
+def triqler_table(out_msstats: pd.DataFrame) -> pd.DataFrame:
+    """
+    Construct the Triqler input table from the MSstats one.
+
+    The search score is taken from the "Q.Value" kept in the MSstats table, this used to be
+    assigned from the report by index, which did not line up anymore after the merge with the
+    experimental design.
+
+    :param out_msstats: MSstats input table, as returned by msstats_table
+    :type out_msstats: pandas.core.frame.DataFrame
+    :return: Triqler input table
+    :rtype: pandas.core.frame.DataFrame
+    """
+    triqler_cols = ["ProteinName", "PeptideSequence", "PrecursorCharge", "Intensity", "Run", "Condition", "Q.Value"]
     out_triqler = out_msstats[triqler_cols]
-    del out_msstats
-    out_triqler.columns = ["proteins", "peptide", "charge", "intensity", "run", "condition"]
+    out_triqler.columns = ["proteins", "peptide", "charge", "intensity", "run", "condition", "searchScore"]
     out_triqler = out_triqler[out_triqler["intensity"] != 0]
 
-    out_triqler.loc[:, "searchScore"] = report["Q.Value"]
     out_triqler.loc[:, "searchScore"] = 1 - out_triqler["searchScore"]
-    out_triqler.to_csv(exp_out_prefix + "_triqler_in.tsv", sep="\t", index=False)
-    logger.info(f"Triqler input file is saved as {exp_out_prefix}_triqler_in.tsv")
-    del out_triqler
+    return out_triqler
 
-    mztab_out = f"{Path(exp_design).stem}_out.mzTab"
-    # Convert to mzTab
-    diann_directory.convert_to_mztab(
-        report=report,
-        f_table=f_table,
-        charge=charge,
-        missed_cleavages=missed_cleavages,
-        dia_params=dia_params,
-        out=mztab_out,
-    )
+
+def shard_runs(f_table: pd.DataFrame, shard_index: int, num_shards: int) -> List[str]:
+    """
+    Returns the runs converted by a shard.
+
+    The sorted runs of the experimental design are split in ``num_shards`` contiguous chunks,
+    so concatenating the PSH rows of the shards in order gives the same order as converting
+    all the runs at once.
+
+    Examples:
+    >>> f_table = pd.DataFrame({"run": ["c", "a", "d", "b", "e"]})
+    >>> shard_runs(f_table, 0, 2)
+    ['a', 'b', 'c']
+    >>> shard_runs(f_table, 1, 2)
+    ['d', 'e']
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} out of range for {num_shards} shards")
+    runs = sorted(f_table["run"].unique())
+    return [str(r) for r in np.array_split(np.array(runs, dtype=object), num_shards)[shard_index]]
+
+
+def concat_tables(tables: List[os.PathLike], out: os.PathLike, table_format: str = "text") -> str:
+    """
+    Concatenates text tables sharing the same header, keeping the header of the first one.
+
+    The tables are copied line by line, so they never have to fit in memory. For the Parquet
+    format they are parsed in chunks of REPORT_CHUNKSIZE rows instead.
+
+    :param tables: Paths to the tables to concatenate
+    :type tables: list
+    :param out: Path of the concatenated table, in the text format, see table_path
+    :type out: str
+    :param table_format: Format of the concatenated table, one of TABLE_FORMATS
+    :type table_format: str
+    :return: Path of the concatenated table
+    :rtype: str
+    """
+    sep = table_separator(out)
+    path = table_path(out, table_format)
+    # The types of the columns are read over every chunk first, as a Parquet file has a single schema
+    dtypes = table_dtypes(tables, sep) if table_format == "parquet" else None
+    with TableWriter(path, sep=sep, table_format=table_format, dtypes=dtypes) as writer:
+        for i, table in enumerate(tables):
+            if table_format == "parquet":
+                for chunk in read_table_chunks(table, sep):
+                    writer.write_frame(chunk)
+            else:
+                append_table(table, writer, header=(i == 0))
+    return path
+
+
+def read_table_chunks(table: os.PathLike, sep: str) -> Iterator[pd.DataFrame]:
+    """Reads a text table in chunks of REPORT_CHUNKSIZE rows."""
+    # Only empty fields are missing, so strings such as the "NA" fragment ions are kept as written
+    return pd.read_csv(table, sep=sep, chunksize=REPORT_CHUNKSIZE, keep_default_na=False, na_values=[""])
+
+
+def table_dtypes(tables: List[os.PathLike], sep: str) -> Dict[str, Any]:
+    """The types of the columns of text tables read in chunks, each promoted to hold the values of every chunk."""
+    dtypes: Dict[str, Any] = {}
+    for table in tables:
+        for chunk in read_table_chunks(table, sep):
+            dtypes = promote_dtypes(dtypes, infer_numeric_columns(chunk))
+    return dtypes
+
+
+def promote_dtypes(dtypes: Dict[str, Any], df: pd.DataFrame) -> Dict[str, Any]:
+    """The types of the columns holding both the values of ``dtypes`` and those of a data frame: integers are widened
+    to floats when values are missing, and columns mixing numbers and strings hold strings."""
+    from pandas.core.dtypes.cast import find_common_type
+
+    return {c: find_common_type([dtypes[c], df[c].dtype]) if c in dtypes else df[c].dtype for c in df.columns}
+
+
+def conform_dtypes(df: pd.DataFrame, dtypes: Dict[str, Any]) -> pd.DataFrame:
+    """Casts the columns of a data frame to the given types, numbers in string columns becoming strings.
+
+    :raises ValueError: If a column can not hold its values in its type, e.g. missing values in integers
+    """
+    df = df.copy()
+    for column, dtype in dtypes.items():
+        if df[column].dtype == dtype:
+            continue
+        if dtype == object:
+            df[column] = df[column].astype(object).where(df[column].isna(), df[column].astype(str))
+            continue
+        try:
+            df[column] = df[column].astype(dtype)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Column {column} of type {df[column].dtype} does not fit the type {dtype}: {e}")
+    return df
+
+
+def write_table(table: pd.DataFrame, out: os.PathLike, table_format: str = "text") -> str:
+    """
+    Writes a MSstats or Triqler table in one of TABLE_FORMATS.
+
+    :param table: Table to write
+    :type table: pandas.core.frame.DataFrame
+    :param out: Path of the table in the text format, the suffix of the format is added, see table_path
+    :type out: str
+    :param table_format: Format of the table, one of TABLE_FORMATS
+    :type table_format: str
+    :return: Path of the written table
+    :rtype: str
+    """
+    path = table_path(out, table_format)
+    with TableWriter(path, sep=table_separator(out), table_format=table_format) as writer:
+        writer.write_frame(table)
+    return path
+
+
+def read_table(path: os.PathLike) -> pd.DataFrame:
+    """Reads a MSstats or Triqler table written in any of TABLE_FORMATS, see write_table."""
+    path = str(path)
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    # The compression is inferred by pandas from the extension
+    return pd.read_csv(path, sep=table_separator(path))
+
+
+def table_path(path: os.PathLike, table_format: str) -> str:
+    """Path of a table in a format, from its path in the text format.
+
+    >>> table_path("design_msstats_in.csv", "zstd")
+    'design_msstats_in.csv.zst'
+    >>> table_path("design_msstats_in.csv", "parquet")
+    'design_msstats_in.parquet'
+    """
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format {table_format}, expected one of {list(TABLE_FORMATS)}")
+    if table_format == "parquet":
+        return str(Path(path).with_suffix(TABLE_FORMATS[table_format]))
+    return str(path) + TABLE_FORMATS[table_format]
+
+
+def table_separator(path: os.PathLike) -> str:
+    return "\t" if ".tsv" in Path(path).suffixes else ","
+
+
+def append_table(table: os.PathLike, out_f, header: bool) -> None:
+    """Copies a text table to an open file, with or without its header line."""
+    with open(table, "r", newline="") as in_f:
+        first_line = in_f.readline()
+        if header:
+            out_f.write(first_line)
+        shutil.copyfileobj(in_f, out_f)
+
+
+class TableWriter:
+    """
+    Streaming writer of a table in one of TABLE_FORMATS.
+
+    Text is written with ``write``, so the writer can stand in for an open text file, and data
+    frames with ``write_frame``. The gzip format is compressed by blocks of GZIP_BLOCKSIZE bytes
+    in a thread pool, each block as a gzip member of its own (the concatenation of the members is
+    a valid gzip file), the zstd one with the threads of the zstandard compressor. The Parquet
+    format is written with dictionary encoding, one row group per frame, the column types being
+    ``dtypes`` if given, those of the first frame otherwise.
+    """
+
+    def __init__(
+        self,
+        path: os.PathLike,
+        sep: str,
+        table_format: str = "text",
+        threads: Optional[int] = None,
+        dtypes: Optional[Dict[str, Any]] = None,
+    ):
+        self.path = path
+        self.sep = sep
+        self.table_format = table_format
+        self.threads = threads or available_cpus()
+        self._header = True
+        self._dtypes = dtypes
+        self._parquet_writer = None
+        self._buffer = []
+        self._buffered = 0
+        self._pending = []
+        self._executor = None
+
+        if table_format == "parquet":
+            self._out = None
+        elif table_format == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("The zstandard package is required to write zstd compressed tables")
+            self._raw = open(path, "wb")
+            self._out = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=self.threads).stream_writer(self._raw)
+        elif table_format == "gzip":
+            self._out = open(path, "wb")
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        elif table_format == "text":
+            self._out = open(path, "wb")
+        else:
+            raise ValueError(f"Unknown table format {table_format}, expected one of {list(TABLE_FORMATS)}")
+
+    def __enter__(self) -> "TableWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def write(self, data: str) -> None:
+        """Writes text, which has to follow the lines already written, header included."""
+        if self.table_format == "parquet":
+            raise ValueError("Text can not be written to a Parquet table, use write_frame")
+        self._header = False
+        data = data.encode()
+        if self._executor is None:
+            self._out.write(data)
+            return
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= GZIP_BLOCKSIZE:
+            self._submit_block()
+
+    def write_frame(self, df: pd.DataFrame) -> None:
+        """Writes the rows of a data frame, with the header if nothing was written yet."""
+        if self.table_format == "parquet":
+            df = infer_numeric_columns(df)
+        if self._dtypes is None:
+            self._dtypes = df.dtypes.to_dict()
+        else:
+            df = conform_dtypes(df, self._dtypes)
+
+        if self.table_format != "parquet":
+            for start in range(0, max(len(df), 1), REPORT_CHUNKSIZE):
+                chunk = df.iloc[start : start + REPORT_CHUNKSIZE]
+                self.write(chunk.to_csv(sep=self.sep, index=False, header=self._header, lineterminator="\n"))
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(
+                self.path, table.schema, use_dictionary=True, compression=PARQUET_COMPRESSION
+            )
+        self._parquet_writer.write_table(table.cast(self._parquet_writer.schema))
+
+    def _submit_block(self) -> None:
+        block = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._executor.submit(gzip.compress, block, GZIP_LEVEL))
+        # Write the compressed blocks in order, keeping a bounded number of them in flight
+        while self._pending and (self._pending[0].done() or len(self._pending) > 2 * self.threads):
+            self._out.write(self._pending.pop(0).result())
+
+    def close(self) -> None:
+        if self.table_format == "parquet":
+            if self._parquet_writer is not None:
+                self._parquet_writer.close()
+            return
+
+        if self._executor is not None:
+            if self._buffered:
+                self._submit_block()
+            for future in self._pending:
+                self._out.write(future.result())
+            self._pending = []
+            self._executor.shutdown()
+        self._out.close()
+        if self.table_format == "zstd":
+            self._raw.close()
+
+
+def available_cpus() -> int:
+    """The CPUs this process may run on, all the CPUs where its affinity can not be read, e.g. on macOS."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def infer_numeric_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Converts the string columns holding only numbers to numbers, as they would be read from a text table."""
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        try:
+            df[column] = pd.to_numeric(df[column])
+        except (ValueError, TypeError):
+            pass
+    return df
 
 
 def _true_stem(x):
@@ -180,20 +1018,36 @@ def _true_stem(x):
 
 
 def get_exp_design_dfs(exp_design_file):
+    """
+    Read the sample and file tables of an experimental design.
+
+    :param exp_design_file: Path to the two-table experimental design
+    :type exp_design_file: str
+    :return: The sample table and the file table, with the run name of each file in "run"
+    :rtype: tuple
+    :raises ValueError: If the design cannot be read, e.g. it lacks a table or a column
+    """
     logger.info(f"Reading experimental design file: {exp_design_file}")
-    with open(exp_design_file, "r") as f:
-        data = f.readlines()
-        empty_row = data.index("\n")
-        f_table = [i.replace("\n", "").split("\t") for i in data[1:empty_row]]
-        f_header = data[0].replace("\n", "").split("\t")
-        f_table = pd.DataFrame(f_table, columns=f_header)
-        f_table.loc[:, "run"] = f_table.apply(lambda x: _true_stem(x["Spectra_Filepath"]), axis=1)
+    design = read_expdesign(exp_design_file)
+    if design.errors:
+        raise ValueError(f"Invalid experimental design {exp_design_file}: " + "; ".join(design.errors))
+    return design.sample_table, design.file_table
 
-        s_table = [i.replace("\n", "").split("\t") for i in data[empty_row + 1 :]][1:]
-        s_header = data[empty_row + 1].replace("\n", "").split("\t")
-        s_DataFrame = pd.DataFrame(s_table, columns=s_header)
 
-    return s_DataFrame, f_table
+def mztab_index_ref(f_table: pd.DataFrame) -> pd.DataFrame:
+    """
+    On the basis of f_table, two columns "ms_run" and "study_variable" are added for matching.
+
+    :param f_table: File table of the experimental design
+    :type f_table: pandas.core.frame.DataFrame
+    :return: f_table with "Fraction_Group", "Sample" and "run" renamed to "ms_run", "study_variable" and "Run"
+    :rtype: pandas.core.frame.DataFrame
+    """
+    index_ref = f_table.copy()
+    index_ref.rename(columns={"Fraction_Group": "ms_run", "Sample": "study_variable", "run": "Run"}, inplace=True)
+    index_ref["ms_run"] = index_ref["ms_run"].astype("int")
+    index_ref["study_variable"] = index_ref["study_variable"].astype("int")
+    return index_ref
 
 
 class DiannDirectory:
@@ -262,7 +1116,14 @@ class DiannDirectory:
             raise ValueError(f"Unsupported DIANN version {self.diann_version}")
 
     def convert_to_mztab(
-        self, report, f_table, charge: int, missed_cleavages: int, dia_params: List[Any], out: os.PathLike
+        self,
+        report,
+        f_table,
+        charge: int,
+        missed_cleavages: int,
+        dia_params: List[Any],
+        out: os.PathLike,
+        spectrum_rt_tolerance: float = SPECTRUM_RT_TOLERANCE,
     ) -> None:
         logger.info("Converting to mzTab")
         self.validate_diann_version()
@@ -274,50 +1135,100 @@ class DiannDirectory:
         # else:
         #     raise ValueError(f"Unsupported DIANN version {diann_version_id}, supported versions are 1.8.1 ...")
 
-        logger.info(f"Reading fasta file: {self.fasta}")
-        entries: list = []
-        f = FASTAFile()
-        f.load(str(self.fasta), entries)
-        fasta_entries = [(e.identifier, e.sequence, len(e.sequence)) for e in entries]
-        fasta_df = pd.DataFrame(fasta_entries, columns=["id", "seq", "len"])
-
         logger.info("Mapping run information to report")
-        index_ref = f_table.copy()
-        index_ref.rename(columns={"Fraction_Group": "ms_run", "Sample": "study_variable", "run": "Run"}, inplace=True)
-        index_ref["ms_run"] = index_ref["ms_run"].astype("int")
-        index_ref["study_variable"] = index_ref["study_variable"].astype("int")
+        index_ref = mztab_index_ref(f_table)
         report = report.merge(index_ref[["ms_run", "Run", "study_variable"]], on="Run", validate="many_to_one")
 
-        MTD, database = mztab_MTD(index_ref, dia_params, str(self.fasta), charge, missed_cleavages)
-        pg = pd.read_csv(
-            self.pg_matrix,
-            sep="\t",
-            header=0,
-        )
-        PRH = mztab_PRH(report, pg, index_ref, database, fasta_df)
-        del pg
-        pr = pd.read_csv(
-            self.pr_matrix,
-            sep="\t",
-            header=0,
-        )
-        precursor_list = list(report["Precursor.Id"].unique())
-        PEH = mztab_PEH(report, pr, precursor_list, index_ref, database)
-        del pr
-        PSH = mztab_PSH(report, str(self.base_path), database)
+        with METRICS.stage("aggregates") as stage:
+            aggregates = ReportAggregates.from_report(report)
+            stage["rows"] = len(report)
+        with METRICS.stage("PSH") as stage, FastaIndex(self.fasta) as fasta:
+            PSH = mztab_PSH(
+                report,
+                str(self.base_path),
+                fasta_database_name(str(fasta.fasta)),
+                fasta,
+                rt_tolerance=spectrum_rt_tolerance,
+            )
+            stage["rows"] = len(PSH)
         del report
+        self.write_mztab(
+            index_ref=index_ref,
+            aggregates=aggregates,
+            PSH=[PSH],
+            charge=charge,
+            missed_cleavages=missed_cleavages,
+            dia_params=dia_params,
+            out=out,
+        )
+
+    def write_mztab(
+        self,
+        index_ref: pd.DataFrame,
+        aggregates: "ReportAggregates",
+        PSH: List[Union[pd.DataFrame, os.PathLike]],
+        charge: int,
+        missed_cleavages: int,
+        dia_params: List[Any],
+        out: os.PathLike,
+    ) -> None:
+        """Builds the MTD, PRH and PEH sub-tables and writes them, followed by the PSH ones, to the mzTab file.
+
+        :param index_ref: f_table with the "ms_run" and "study_variable" columns, see mztab_index_ref
+        :type index_ref: pandas.core.frame.DataFrame
+        :param aggregates: Aggregates of the main report the PRH and PEH sub-tables are built from
+        :type aggregates: ReportAggregates
+        :param PSH: PSH sub-tables, or paths to the tables written by the shard command, in output order
+        :type PSH: list
+        """
+        self.validate_diann_version()
+
+        with METRICS.stage("MTD") as stage:
+            MTD, database = mztab_MTD(index_ref, dia_params, str(self.fasta), charge, missed_cleavages)
+            stage["rows"] = len(MTD)
+        with METRICS.stage("PRH") as stage:
+            pg = pd.read_csv(self.pg_matrix, sep="\t", header=0)
+            logger.info(f"Indexing fasta file: {self.fasta}")
+            with FastaIndex(self.fasta) as fasta:
+                PRH = mztab_PRH(aggregates, pg, index_ref, database, fasta)
+            del pg
+            stage["rows"] = len(PRH)
+        with METRICS.stage("PEH") as stage:
+            pr = pd.read_csv(self.pr_matrix, sep="\t", header=0)
+            PEH = mztab_PEH(aggregates, pr, index_ref, database)
+            del pr
+            stage["rows"] = len(PEH)
         MTD.loc["", :] = ""
         PRH.loc[len(PRH) + 1, :] = ""
         PEH.loc[len(PEH) + 1, :] = ""
-        with open(out, "w", newline="") as f:
-            MTD.to_csv(f, mode="w", sep="\t", index=False, header=False)
-            PRH.to_csv(f, mode="w", sep="\t", index=False, header=True)
-            PEH.to_csv(f, mode="w", sep="\t", index=False, header=True)
-            PSH.to_csv(f, mode="w", sep="\t", index=False, header=True)
+        index = MzTabIndex()
+        with METRICS.stage("write") as stage:
+            with open(out, "wb") as f:
+                index.write_table(f, "MTD", MTD, header=False)
+                index.write_table(f, "PRT", PRH, header=True)
+                index.write_table(f, "PEP", PEH, header=True)
+                for i, table in enumerate(PSH):
+                    if isinstance(table, pd.DataFrame):
+                        index.write_psm_table(f, table, header=(i == 0))
+                    else:
+                        index.append_psm_table(f, table, header=(i == 0))
+            index.save(out)
+            stage["rows"] = sum(block["rows"] for blocks in index.psm_runs.values() for block in blocks)
 
         logger.info(f"mzTab file generated successfully! at {out}_out.mzTab")
 
-    def main_report_df(self, qvalue_threshold: float) -> pd.DataFrame:
+    def main_report_df(self, qvalue_threshold: float, runs: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads the main report, filtered by q-value.
+
+        :param qvalue_threshold: Threshold for filtering q value
+        :type qvalue_threshold: float
+        :param runs: If given, only the rows of these runs are kept. The report is then read in chunks,
+            so only the rows of the requested runs are ever held in memory.
+        :type runs: list
+        """
+        from pyopenms import AASequence
+        from pyopenms.Constants import PROTON_MASS_U
+
         remain_cols = [
             "File.Name",
             "Run",
@@ -339,26 +1250,36 @@ class DiannDirectory:
             "Precursor.Quantity",
             "Global.PG.Q.Value",
         ]
-        report = pd.read_csv(self.report, sep="\t", header=0, usecols=remain_cols)
-
-        # filter based on qvalue parameter for downstream analysiss
-        logger.debug(f"Filtering report based on qvalue threshold: {qvalue_threshold}, {len(report)} rows")
-        report = report[report["Q.Value"] < qvalue_threshold]
-        logger.debug(f"Report filtered, {len(report)} rows remaining")
-
-        logger.debug("Calculating Precursor.Mz")
-        # Making the map is 10x faster, and includes the mass of
-        # the modification. with respect to the previous implementation.
-        uniq_masses = {k: AASequence.fromString(k).getMonoWeight() for k in report["Modified.Sequence"].unique()}
-        mass_vector = report["Modified.Sequence"].map(uniq_masses)
-        report["Calculate.Precursor.Mz"] = (mass_vector + (PROTON_MASS_U * report["Precursor.Charge"])) / report[
-            "Precursor.Charge"
-        ]
-
-        logger.debug("Indexing Precursors")
-        # Making the map is 1500x faster
-        precursor_index_map = {k: i for i, k in enumerate(report["Precursor.Id"].unique())}
-        report["precursor.Index"] = report["Precursor.Id"].map(precursor_index_map)
+        with METRICS.stage("read report") as stage:
+            if runs is None:
+                report = pd.read_csv(self.report, sep="\t", header=0, usecols=remain_cols)
+            else:
+                logger.debug(f"Reading report rows of {len(runs)} runs")
+                runs = set(runs)
+                chunks = pd.read_csv(self.report, sep="\t", header=0, usecols=remain_cols, chunksize=REPORT_CHUNKSIZE)
+                report = pd.concat([chunk[chunk["Run"].isin(runs)] for chunk in chunks], ignore_index=True)
+
+            # filter based on qvalue parameter for downstream analysiss
+            logger.debug(f"Filtering report based on qvalue threshold: {qvalue_threshold}, {len(report)} rows")
+            report = report[report["Q.Value"] < qvalue_threshold]
+            logger.debug(f"Report filtered, {len(report)} rows remaining")
+            stage["rows"] = len(report)
+
+        with METRICS.stage("masses") as stage:
+            logger.debug("Calculating Precursor.Mz")
+            # Making the map is 10x faster, and includes the mass of
+            # the modification. with respect to the previous implementation.
+            uniq_masses = {k: AASequence.fromString(k).getMonoWeight() for k in report["Modified.Sequence"].unique()}
+            mass_vector = report["Modified.Sequence"].map(uniq_masses)
+            report["Calculate.Precursor.Mz"] = (mass_vector + (PROTON_MASS_U * report["Precursor.Charge"])) / report[
+                "Precursor.Charge"
+            ]
+
+            logger.debug("Indexing Precursors")
+            # Making the map is 1500x faster
+            precursor_index_map = {k: i for i, k in enumerate(report["Precursor.Id"].unique())}
+            report["precursor.Index"] = report["Precursor.Id"].map(precursor_index_map)
+            stage["rows"] = len(uniq_masses)
 
         logger.debug(f"Shape of main report {report.shape}")
         logger.debug(str(report.head()))
@@ -366,6 +1287,619 @@ class DiannDirectory:
         return report
 
 
+@dataclass
+class ReportAggregates:
+    """
+    Partial aggregates of the Dia-NN main report, from which the PRH and PEH sub-tables are built.
+
+    The statistics are kept as counts, sums, sums of squared deviations and minima (see
+    group_moments), so the aggregates of disjoint subsets of runs can be combined into the ones of
+    the whole experiment without going back to the report. The columns of the tables are named
+    "<report column>::<statistic>".
+
+    :param precursor_run: Minimum "Q.Value" per precursor and ms_run
+    :param precursor_study: Moments of "Precursor.Normalised", "RT.Start" and "Calculate.Precursor.Mz"
+        per precursor and study_variable
+    :param precursor: Minimum "Q.Value", "Global.Q.Value" and "Lib.Q.Value" and moments of "RT.Start"
+        and "Calculate.Precursor.Mz" per precursor
+    :param protein_study: Moments of "PG.MaxLFQ" per "Protein.Ids" and study_variable
+    :param protein_best: Modified sequence with the best "Global.PG.Q.Value", then "Q.Value", per "Protein.Ids"
+    :param protein_sequences: Unique "Stripped.Sequence" per "Protein.Ids"
+    """
+
+    precursor_run: pd.DataFrame
+    precursor_study: pd.DataFrame
+    precursor: pd.DataFrame
+    protein_study: pd.DataFrame
+    protein_best: pd.DataFrame
+    protein_sequences: pd.DataFrame
+
+    PRECURSOR_STUDY_MOMENTS = ["Precursor.Normalised", "RT.Start", "Calculate.Precursor.Mz"]
+    PRECURSOR_MOMENTS = ["RT.Start", "Calculate.Precursor.Mz"]
+    PRECURSOR_MINIMA = ["Q.Value", "Global.Q.Value", "Lib.Q.Value"]
+
+    @classmethod
+    def from_report(cls, report: pd.DataFrame) -> "ReportAggregates":
+        """Aggregates a report that has been merged with the "ms_run" and "study_variable" columns."""
+        logger.debug("Aggregating report")
+        precursor_run = report.groupby(["Precursor.Id", "ms_run"], as_index=False).agg(
+            **{"Q.Value::min": ("Q.Value", "min")}
+        )
+        precursor = group_moments(report, ["Precursor.Id"], cls.PRECURSOR_MOMENTS).merge(
+            report.groupby("Precursor.Id", as_index=False).agg(
+                **{f"{col}::min": (col, "min") for col in cls.PRECURSOR_MINIMA}
+            ),
+            on="Precursor.Id",
+            validate="one_to_one",
+        )
+
+        return cls(
+            precursor_run=precursor_run,
+            precursor_study=group_moments(report, ["Precursor.Id", "study_variable"], cls.PRECURSOR_STUDY_MOMENTS),
+            precursor=precursor,
+            protein_study=group_moments(report, ["Protein.Ids", "study_variable"], ["PG.MaxLFQ"]),
+            protein_best=cls._best_protein_scores(
+                report[["Modified.Sequence", "Protein.Ids", "Global.PG.Q.Value", "Q.Value"]]
+            ),
+            protein_sequences=report[["Protein.Ids", "Stripped.Sequence"]].drop_duplicates(ignore_index=True),
+        )
+
+    @classmethod
+    def combine(cls, parts: List["ReportAggregates"]) -> "ReportAggregates":
+        """Combines the aggregates of reports with disjoint runs."""
+        logger.debug(f"Combining {len(parts)} report aggregates")
+        tables = {f.name: pd.concat([getattr(p, f.name) for p in parts], ignore_index=True) for f in fields(cls)}
+
+        precursor_minima = (
+            tables["precursor"]
+            .groupby("Precursor.Id", as_index=False)
+            .agg({f"{col}::min": "min" for col in cls.PRECURSOR_MINIMA})
+        )
+        precursor = combine_moments(tables["precursor"], ["Precursor.Id"], cls.PRECURSOR_MOMENTS).merge(
+            precursor_minima, on="Precursor.Id", validate="one_to_one"
+        )
+
+        return cls(
+            precursor_run=tables["precursor_run"].groupby(["Precursor.Id", "ms_run"], as_index=False).min(),
+            precursor_study=combine_moments(
+                tables["precursor_study"], ["Precursor.Id", "study_variable"], cls.PRECURSOR_STUDY_MOMENTS
+            ),
+            precursor=precursor,
+            protein_study=combine_moments(tables["protein_study"], ["Protein.Ids", "study_variable"], ["PG.MaxLFQ"]),
+            protein_best=cls._best_protein_scores(tables["protein_best"]),
+            protein_sequences=tables["protein_sequences"].drop_duplicates(ignore_index=True),
+        )
+
+    @staticmethod
+    def _best_protein_scores(df: pd.DataFrame) -> pd.DataFrame:
+        # Global.PG.Q.Value is the same for all the rows of a protein group, so the precursor is the one of them with
+        # the best Q.Value, then the first in the order of the report, for the choice not to depend on the shards
+        return (
+            df.sort_values(["Global.PG.Q.Value", "Q.Value"], ascending=True, kind="mergesort")
+            .groupby(["Protein.Ids"])
+            .head(1)
+            .reset_index(drop=True)
+        )
+
+    def to_directory(self, path: os.PathLike) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for f in fields(self):
+            getattr(self, f.name).to_csv(path / f"{f.name}.tsv", sep="\t", index=False)
+
+    @classmethod
+    def from_directory(cls, path: os.PathLike) -> "ReportAggregates":
+        path = Path(path)
+        return cls(**{f.name: pd.read_csv(path / f"{f.name}.tsv", sep="\t") for f in fields(cls)})
+
+
+class ShardDirectory:
+    """
+    Directory written by the shard command, holding the converted rows of a subset of the runs
+    and the aggregates of their part of the report.
+    """
+
+    MANIFEST = "shard.json"
+
+    def __init__(self, base_path):
+        self.base_path = Path(base_path)
+
+    @property
+    def msstats(self) -> os.PathLike:
+        return self.base_path / "msstats_in.csv"
+
+    @property
+    def triqler(self) -> os.PathLike:
+        return self.base_path / "triqler_in.tsv"
+
+    @property
+    def psh(self) -> os.PathLike:
+        return self.base_path / "psh.tsv"
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        with open(self.base_path / self.MANIFEST) as f:
+            return json.load(f)
+
+    def aggregates(self) -> ReportAggregates:
+        return ReportAggregates.from_directory(self.base_path / "aggregates")
+
+    def write(
+        self,
+        shard_index: int,
+        num_shards: int,
+        runs: List[str],
+        out_msstats: pd.DataFrame,
+        out_triqler: pd.DataFrame,
+        PSH: pd.DataFrame,
+        aggregates: ReportAggregates,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        manifest = self.base_path / self.MANIFEST
+        if manifest.exists():
+            manifest.unlink()
+        out_msstats.to_csv(self.msstats, sep=",", index=False)
+        out_triqler.to_csv(self.triqler, sep="\t", index=False)
+        PSH.to_csv(self.psh, sep="\t", index=False)
+        aggregates.to_directory(self.base_path / "aggregates")
+        # The manifest is written last, so a directory with one holds a complete shard
+        with open(manifest, "w") as f:
+            json.dump(
+                {
+                    "revision": REVISION,
+                    "shard_index": shard_index,
+                    "num_shards": num_shards,
+                    "runs": runs,
+                    "fingerprint": fingerprint,
+                },
+                f,
+                indent=2,
+            )
+
+    @classmethod
+    def find_all(cls, folder: os.PathLike) -> List["ShardDirectory"]:
+        """Finds the shard directories in a folder, sorted by shard index.
+
+        :raises ValueError: If no shards are found, or some of the shards are missing
+        """
+        shards = [cls(p.parent) for p in Path(folder).glob(f"**/{cls.MANIFEST}")]
+        if not shards:
+            raise ValueError(f"Could not find any shard in {folder}")
+        shards.sort(key=lambda s: s.manifest["shard_index"])
+
+        indices = [s.manifest["shard_index"] for s in shards]
+        num_shards = shards[0].manifest["num_shards"]
+        if indices != list(range(num_shards)):
+            missing = sorted(set(range(num_shards)) - set(indices))
+            raise ValueError(f"Expected shards 0..{num_shards - 1} in {folder}, missing {missing} or duplicated")
+        return shards
+
+
+class ConversionState:
+    """
+    State directory of the incremental command, holding a shard directory per converted run
+    under ``runs/<run>``, each with the fingerprint of its inputs in the manifest.
+    """
+
+    def __init__(self, base_path):
+        self.base_path = Path(base_path)
+
+    def shard(self, run: str) -> ShardDirectory:
+        return ShardDirectory(self.base_path / "runs" / run)
+
+    def fingerprints(self) -> Dict[str, str]:
+        """Fingerprints of the runs converted by a previous call, by run.
+
+        Shards written by another revision of this script are ignored, so their runs are converted again.
+        """
+        fingerprints = {}
+        for manifest in (self.base_path / "runs").glob(f"*/{ShardDirectory.MANIFEST}"):
+            shard = ShardDirectory(manifest.parent)
+            if shard.manifest.get("revision") == REVISION and shard.manifest.get("fingerprint"):
+                fingerprints[manifest.parent.name] = shard.manifest["fingerprint"]
+        return fingerprints
+
+    def remove(self, run: str) -> None:
+        logger.info(f"Removing run {run} from the conversion state")
+        shutil.rmtree(self.shard(run).base_path)
+
+
+def run_fingerprints(
+    diann_directory: "DiannDirectory",
+    report: pd.DataFrame,
+    s_DataFrame: pd.DataFrame,
+    f_table: pd.DataFrame,
+    qvalue_threshold: float,
+    spectrum_rt_tolerance: float = SPECTRUM_RT_TOLERANCE,
+) -> Dict[str, str]:
+    """Fingerprints the inputs of the conversion of each run in the report.
+
+    A fingerprint covers the revision of this script, the q-value threshold, the retention time
+    tolerance of the spectrum matching, the name of the protein database, the experimental design
+    entries of the run, its rows in the report and its ms_info file, so it changes whenever the
+    converted rows of the run could.
+
+    :return: Hex digest of the fingerprint of each run, by run
+    :rtype: dict
+    """
+    # Order independent hash of the report rows of each run. The columns computed when reading
+    # the report are left out: the precursor index is numbered across all runs, and the m/z is
+    # derived from the sequence and charge, but may vary in the last bits between processes.
+    # Columns are sorted, as their order in the report is not fixed.
+    rows = report.drop(columns=["precursor.Index", "Calculate.Precursor.Mz"], errors="ignore")
+    rows = rows[sorted(rows.columns)]
+    row_hashes = pd.Series(pd.util.hash_pandas_object(rows, index=False).values, index=report["Run"].values)
+    report_hashes = row_hashes.groupby(level=0).sum()
+
+    database = fasta_database_name(str(diann_directory.fasta))
+    f_table = f_table.set_index("run")
+    s_DataFrame = s_DataFrame.set_index("Sample")
+    fingerprints = {}
+    for run, report_hash in report_hashes.items():
+        run_design = f_table.loc[run]
+        sample_design = s_DataFrame.loc[run_design["Sample"]]
+        fingerprint = hashlib.sha256()
+        fingerprint.update(
+            json.dumps(
+                [
+                    REVISION,
+                    qvalue_threshold,
+                    spectrum_rt_tolerance,
+                    database,
+                    run_design.astype(str).to_dict(),
+                    sample_design.astype(str).to_dict(),
+                    int(report_hash),
+                ]
+            ).encode()
+        )
+        with open(find_ms_info(diann_directory.base_path, run), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                fingerprint.update(block)
+        fingerprints[run] = fingerprint.hexdigest()
+    return fingerprints
+
+
+def compare_outputs(
+    expected_prefix: str, actual_prefix: str, table_format: str = "text", rtol: float = 1e-9
+) -> List[str]:
+    """Compares the MSstats, Triqler and mzTab files of two conversions.
+
+    Rows are compared regardless of their order, and numbers within a relative tolerance.
+
+    :return: Description of each difference found, empty if the outputs are equivalent
+    :rtype: list
+    """
+    differences = []
+    for suffix in ("_msstats_in.csv", "_triqler_in.tsv"):
+        differences += compare_tables(
+            read_table(table_path(expected_prefix + suffix, table_format)),
+            read_table(table_path(actual_prefix + suffix, table_format)),
+            name=suffix.lstrip("_"),
+            rtol=rtol,
+        )
+
+    expected = read_mztab_sections(expected_prefix + "_out.mzTab")
+    actual = read_mztab_sections(actual_prefix + "_out.mzTab")
+    if not expected["MTD"].equals(actual["MTD"]):
+        differences.append("mzTab MTD: metadata differs")
+    for section in ("PRT", "PEP", "PSM"):
+        differences += compare_tables(expected[section], actual[section], name=f"mzTab {section}", rtol=rtol)
+    return differences
+
+
+def compare_tables(expected: pd.DataFrame, actual: pd.DataFrame, name: str, rtol: float = 1e-9) -> List[str]:
+    """Compares two tables regardless of the order of their rows, numbers within a relative tolerance."""
+    if list(expected.columns) != list(actual.columns):
+        return [f"{name}: columns differ, {list(expected.columns)} != {list(actual.columns)}"]
+    if expected.shape != actual.shape:
+        return [f"{name}: shapes differ, {expected.shape} != {actual.shape}"]
+
+    columns = list(expected.columns)
+    expected = expected.astype(str).sort_values(columns).reset_index(drop=True)
+    actual = actual.astype(str).sort_values(columns).reset_index(drop=True)
+    differences = []
+    for column in columns:
+        unequal = expected[column] != actual[column]
+        if not unequal.any():
+            continue
+        expected_values = pd.to_numeric(expected.loc[unequal, column], errors="coerce")
+        actual_values = pd.to_numeric(actual.loc[unequal, column], errors="coerce")
+        close = np.isclose(expected_values, actual_values, rtol=rtol, atol=0)
+        if not close.all():
+            differences.append(f"{name}: {(~close).sum()} values of {column} differ")
+    return differences
+
+
+def read_mztab_sections(path: os.PathLike) -> Dict[str, pd.DataFrame]:
+    """Reads the sub-tables of a mzTab file as strings, by line prefix (MTD, PRT, PEP and PSM)."""
+    lines = {"MTD": [], "PRH": [], "PRT": [], "PEH": [], "PEP": [], "PSH": [], "PSM": []}
+    with open(path) as f:
+        for line in f:
+            if line[:3] in lines:
+                lines[line[:3]].append(line)
+
+    sections = {"MTD": pd.DataFrame([line.rstrip("\n").split("\t") for line in lines["MTD"]])}
+    for header, section in (("PRH", "PRT"), ("PEH", "PEP"), ("PSH", "PSM")):
+        sections[section] = pd.read_csv(
+            io.StringIO("".join(lines[header] + lines[section])), sep="\t", dtype=str, keep_default_na=False
+        )
+    return sections
+
+
+class FastaIndex:
+    """
+    Index of the entries of a FASTA file, with the columns of the samtools ``.fai`` files: name, number of
+    residues, offset of the sequence, and residues and bytes per line. It is built in a single pass over
+    the file and cached next to it, sequences are then read on demand from a memory map of the file, so
+    only the entries looked up are held in memory.
+
+    Entries whose lines do not all have the same width, which samtools does not support, are indexed with
+    0 residues per line and the size in bytes of their sequence lines instead of the line width. The cache
+    is therefore not a ``.fai`` file, and starts with a line holding the size of the FASTA file it indexes,
+    since staged or copied files can keep the modification time of a previous version.
+    """
+
+    SUFFIX = ".quantms.idx"
+    COLUMNS = ["name", "length", "offset", "linebases", "linewidth"]
+
+    def __init__(self, fasta: os.PathLike):
+        self.fasta = Path(fasta)
+        index_path = Path(str(fasta) + self.SUFFIX)
+        stat = self.fasta.stat()
+        if self.cached_size(index_path, stat.st_mtime) == stat.st_size:
+            logger.debug(f"Reading fasta index {index_path}")
+            index = pd.read_csv(
+                index_path,
+                sep="\t",
+                header=None,
+                skiprows=1,
+                names=self.COLUMNS,
+                dtype={"name": str},
+                keep_default_na=False,
+            )
+        else:
+            index = self.build(self.fasta)
+            try:
+                with open(index_path, "w", newline="") as f:
+                    f.write(f"#size\t{stat.st_size}\n")
+                    index.to_csv(f, sep="\t", header=False, index=False)
+            except OSError as e:
+                logger.warning(f"Could not cache the fasta index as {index_path}: {e}")
+
+        self.names: List[str] = index["name"].tolist()
+        # As with a dict built from the entries, the last of entries with the same name is used
+        self._entries = {name: i for i, name in enumerate(self.names)}
+        self._spans = index[["offset", "length", "linebases", "linewidth"]].to_numpy(dtype=np.int64)
+        self._tokens: Optional[Dict[str, List[str]]] = None
+
+        self._file = open(self.fasta, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __enter__(self) -> "FastaIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    @staticmethod
+    def cached_size(index_path: Path, mtime: float) -> Optional[int]:
+        """Reads the size of the FASTA file recorded in a cached index, if it is not older than the FASTA file.
+
+        :return: Size in bytes, or None if there is no such cached index
+        :rtype: int
+        """
+        try:
+            if index_path.stat().st_mtime < mtime:
+                return None
+            with open(index_path) as f:
+                tag, _, size = f.readline().rstrip("\n").partition("\t")
+            return int(size) if tag == "#size" else None
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def build(cls, fasta: os.PathLike) -> pd.DataFrame:
+        logger.debug(f"Building fasta index of {fasta}")
+        rows = []
+        entry = None
+        offset = 0
+
+        def finish(entry):
+            name, seq_offset, length, linebases, linewidth, uniform, _, end = entry
+            if not uniform or linebases is None:
+                linebases, linewidth = 0, end - seq_offset
+            return name, length, seq_offset, linebases, linewidth
+
+        with open(fasta, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    if entry is not None:
+                        rows.append(finish(entry))
+                    header = line[1:].split(None, 1)
+                    # name, offset, length, linebases, linewidth, uniform, short line seen, end
+                    seq_offset = offset + len(line)
+                    entry = [header[0].decode() if header else "", seq_offset, 0, None, None, True, False, seq_offset]
+                elif entry is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    if entry[6]:
+                        # Only the last line of an entry can be shorter than the others
+                        entry[5] = False
+                    if entry[3] is None:
+                        entry[3], entry[4] = bases, len(line)
+                    elif bases != entry[3] or len(line) != entry[4]:
+                        if bases > entry[3] or len(line) - bases != entry[4] - entry[3]:
+                            entry[5] = False
+                        entry[6] = True
+                    entry[2] += bases
+                    entry[7] = offset + len(line)
+                offset += len(line)
+            if entry is not None:
+                rows.append(finish(entry))
+        return pd.DataFrame(rows, columns=cls.COLUMNS)
+
+    def sequence(self, name: str) -> str:
+        """Reads the sequence of an entry.
+
+        :raises KeyError: If there is no entry with the name
+        """
+        offset, length, linebases, linewidth = self._spans[self._entries[name]]
+        if linebases:
+            end = offset + (length // linebases) * linewidth + length % linebases
+        else:
+            end = offset + linewidth
+        return bytes(self._map[offset:end]).translate(None, b"\r\n").decode()
+
+    def find_accession(self, accession: str) -> Optional[str]:
+        """Finds the entry of a protein accession, the one with the shortest name among those containing it.
+
+        Names having the accession as one of their "|" separated fields are looked up in a hash map, the other
+        names containing it are only searched if there is none, e.g. Q9Y6V7 is found as sp|Q9Y6V7|PNPT1_HUMAN,
+        rather than sp|Q9Y6V7-2|PNPT1_HUMAN.
+
+        :return: Name of the entry, or None if no name contains the accession
+        :rtype: str
+        """
+        if self._tokens is None:
+            self._tokens = {}
+            for name in self.names:
+                for token in set(name.split("|")):
+                    self._tokens.setdefault(token, []).append(name)
+        matches = self._tokens.get(accession) or [name for name in self.names if accession in name]
+        return min(matches, key=len) if matches else None
+
+
+class MzTabIndex:
+    """
+    Byte offsets of the sections, proteins and ms_runs of a mzTab file, built while it is written and
+    saved next to it as a JSON sidecar (``<mzTab>.index.json``), so readers can seek to the part they need
+    instead of parsing the whole file.
+
+    All offsets are [start, end) byte ranges. Sections are keyed by the prefix of their rows (MTD, PRT,
+    PEP and PSM) and include their header line. PRT rows are indexed by accession, PSM rows by ms_run,
+    with the range of their row numbers in the PSM section. The rows of a ms_run are only contiguous
+    within a block, so each ms_run maps to a list of blocks.
+    """
+
+    SUFFIX = ".index.json"
+
+    def __init__(self):
+        self.sections: Dict[str, List[int]] = {}
+        self.proteins: Dict[str, List[List[int]]] = {}
+        self.psm_runs: Dict[str, List[Dict[str, int]]] = {}
+        self._psm_rows = 0
+
+    def write_table(self, f, section: str, table: pd.DataFrame, header: bool) -> None:
+        """Writes a sub-table to a binary file, indexing it. Rows not starting with the section prefix,
+        such as the empty row separating sub-tables, are written but left out of the section."""
+        start = f.tell()
+        lines = table.to_csv(sep="\t", index=False, header=header, lineterminator="\n").encode().splitlines(True)
+        offsets = np.concatenate([[start], start + np.cumsum([len(line) for line in lines])]).tolist()
+        f.write(b"".join(lines))
+
+        rows = offsets[1:] if header else offsets
+        in_section = (
+            (table.iloc[:, 0] == section).to_numpy() if section != "MTD" else table.iloc[:, 0].ne("").to_numpy()
+        )
+        last = int(np.flatnonzero(in_section)[-1]) if in_section.any() else -1
+        self.sections[section] = [start, rows[last + 1]]
+        if section == "PRT":
+            for accession, row_start, row_end, keep in zip(table["accession"], rows[:-1], rows[1:], in_section):
+                if keep:
+                    self.proteins.setdefault(str(accession), []).append([row_start, row_end])
+
+    def write_psm_table(self, f, table: pd.DataFrame, header: bool) -> None:
+        """Writes PSM rows to a binary file, by blocks of rows of the same ms_run."""
+        if header:
+            self.sections["PSM"] = [f.tell(), f.tell()]
+            f.write(table.iloc[:0].to_csv(sep="\t", index=False, lineterminator="\n").encode())
+        runs = table["spectra_ref"].str.split(":", n=1).str[0].to_numpy()
+        boundaries = (np.flatnonzero(runs[1:] != runs[:-1]) + 1).tolist()
+        for block_start, block_end in zip([0] + boundaries, boundaries + [len(table)]):
+            start = f.tell()
+            block = table.iloc[block_start:block_end]
+            f.write(block.to_csv(sep="\t", index=False, header=False, lineterminator="\n").encode())
+            self._add_psm_block(runs[block_start], start, f.tell(), block_end - block_start)
+
+    def append_psm_table(self, f, path: os.PathLike, header: bool) -> None:
+        """Copies the PSM rows of a TSV file, as written by the shard command, to a binary file."""
+        with open(path, "rb") as in_f:
+            header_line = in_f.readline()
+            spectra_ref = header_line.rstrip(b"\r\n").split(b"\t").index(b"spectra_ref")
+            if header:
+                self.sections["PSM"] = [f.tell(), f.tell()]
+                f.write(header_line)
+
+            run, start, rows = None, f.tell(), 0
+            for line in in_f:
+                line_run = line.split(b"\t", spectra_ref + 1)[spectra_ref].split(b":", 1)[0]
+                if line_run != run:
+                    if rows:
+                        self._add_psm_block(run.decode(), start, f.tell(), rows)
+                    run, start, rows = line_run, f.tell(), 0
+                f.write(line)
+                rows += 1
+            if rows:
+                self._add_psm_block(run.decode(), start, f.tell(), rows)
+
+    def _add_psm_block(self, run: str, start: int, end: int, rows: int) -> None:
+        blocks = self.psm_runs.setdefault(run, [])
+        if blocks and blocks[-1]["end"] == start:
+            blocks[-1]["end"] = end
+            blocks[-1]["rows"] += rows
+        else:
+            blocks.append({"start": start, "end": end, "first_row": self._psm_rows, "rows": rows})
+        self._psm_rows += rows
+        self.sections["PSM"][1] = end
+
+    def save(self, mztab: os.PathLike) -> None:
+        with open(str(mztab) + self.SUFFIX, "w") as f:
+            json.dump(
+                {
+                    "revision": REVISION,
+                    "mztab": os.path.basename(mztab),
+                    "size": os.path.getsize(mztab),
+                    "sections": self.sections,
+                    "proteins": self.proteins,
+                    "psm_runs": self.psm_runs,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, mztab: os.PathLike) -> "MzTabIndex":
+        """Loads the index of a mzTab file.
+
+        :raises ValueError: If the mzTab file changed since the index was written
+        """
+        with open(str(mztab) + cls.SUFFIX) as f:
+            saved = json.load(f)
+        if saved["size"] != os.path.getsize(mztab):
+            raise ValueError(f"The index of {mztab} is outdated")
+        index = cls()
+        index.sections = saved["sections"]
+        index.proteins = saved["proteins"]
+        index.psm_runs = saved["psm_runs"]
+        return index
+
+    @staticmethod
+    def read_range(mztab: os.PathLike, start: int, end: int) -> bytes:
+        with open(mztab, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def read_section(self, mztab: os.PathLike, section: str) -> pd.DataFrame:
+        """Reads a sub-table (PRT, PEP or PSM) of the mzTab file, with its header, as strings."""
+        data = self.read_range(mztab, *self.sections[section])
+        return pd.read_csv(io.BytesIO(data), sep="\t", dtype=str, keep_default_na=False)
+
+
 def MTD_mod_info(fix_mod, var_mod):
     """
     Convert fixed and variable modifications to the format required by the MTD sub-table.
@@ -377,33 +1911,31 @@ def MTD_mod_info(fix_mod, var_mod):
     :return: A tuple contains fixed and variable modifications, and flags indicating whether they are null
     :rtype: tuple
     """
-    var_ptm = []
-    fix_ptm = []
-    mods_db = ModificationsDB()
+    unimod_resolver = UnimodResolver.load()
+
+    def mod_info(mod: str) -> Tuple[str, str]:
+        name, site = split_modification(mod)
+        modification = unimod_resolver.resolve(name)
+        if modification is None:
+            raise ValueError(f"Modification {mod} not found in Unimod")
+        # The residue of the modification, as the origin OpenMS gives it: "X" for any residue at a terminus
+        if site is None or site.endswith("term"):
+            site = "X"
+        return "[UNIMOD, " + modification.accession.upper() + ", " + modification.name + ", ]", site.split(" ")[-1]
 
     if fix_mod != "null":
         fix_flag = 1
-        for mod in fix_mod.split(","):
-            mod_obj = mods_db.getModification(mod)
-            mod_name = mod_obj.getId()
-            mod_accession = mod_obj.getUniModAccession()
-            site = mod_obj.getOrigin()
-            fix_ptm.append(("[UNIMOD, " + mod_accession.upper() + ", " + mod_name + ", ]", site))
+        fix_ptm = [mod_info(mod) for mod in fix_mod.split(",")]
     else:
         fix_flag = 0
-        fix_ptm.append("[MS, MS:1002453, No fixed modifications searched, ]")
+        fix_ptm = ["[MS, MS:1002453, No fixed modifications searched, ]"]
 
     if var_mod != "null":
         var_flag = 1
-        for mod in var_mod.split(","):
-            mod_obj = mods_db.getModification(mod)
-            mod_name = mod_obj.getId()
-            mod_accession = mod_obj.getUniModAccession()
-            site = mod_obj.getOrigin()
-            var_ptm.append(("[UNIMOD, " + mod_accession.upper() + ", " + mod_name + ", ]", site))
+        var_ptm = [mod_info(mod) for mod in var_mod.split(",")]
     else:
         var_flag = 0
-        var_ptm.append("[MS, MS:1002454, No variable modifications searched, ]")
+        var_ptm = ["[MS, MS:1002454, No variable modifications searched, ]"]
 
     return fix_ptm, var_ptm, fix_flag, var_flag
 
@@ -510,34 +2042,45 @@ def mztab_MTD(index_ref, dia_params, fasta, charge, missed_cleavages):
     index = out_mztab_MTD_T.loc[:, "index"]
     out_mztab_MTD_T.drop(labels=["index"], axis=1, inplace=True)
     out_mztab_MTD_T.insert(0, "index", index)
-    database = os.path.basename(fasta.split(".")[-2])
+    database = fasta_database_name(fasta)
 
     return out_mztab_MTD_T, database
 
 
-def mztab_PRH(report, pg, index_ref, database, fasta_df):
+def fasta_database_name(fasta: str) -> str:
+    """
+    Returns the database name reported in the mzTab sub-tables for a fasta file.
+
+    Examples:
+    >>> fasta_database_name("./uniprot_human.fasta")
+    'uniprot_human'
+    """
+    return os.path.basename(fasta.split(".")[-2])
+
+
+def mztab_PRH(aggregates, pg, index_ref, database, fasta):
     """
     Construct PRH sub-table.
 
-    :param report: Dataframe for Dia-NN main report
-    :type report: pandas.core.frame.DataFrame
+    :param aggregates: Aggregates of the Dia-NN main report
+    :type aggregates: ReportAggregates
     :param pg: Dataframe for Dia-NN protein groups matrix
     :type pg: pandas.core.frame.DataFrame
     :param index_ref: On the basis of f_table, two columns "ms_run" and "study_variable" are added for matching
     :type index_ref: pandas.core.frame.DataFrame
     :param database: Path to fasta file
     :type database: str
-    :param fasta_df: A dataframe contains protein IDs, sequences and lengths
-    :type fasta_df: pandas.core.frame.DataFrame
+    :param fasta: Index of the protein sequences of the fasta file
+    :type fasta: FastaIndex
     :return: PRH sub-table
     :rtype: pandas.core.frame.DataFrame
     """
     logger.info("Constructing PRH sub-table...")
     logger.debug(
-        f"Input report shape: {report.shape},"
+        f"Input protein aggregates shape: {aggregates.protein_study.shape},"
         f" input pg shape: {pg.shape},"
         f" input index_ref shape: {index_ref.shape},"
-        f" input fasta_df shape: {fasta_df.shape}"
+        f" input fasta entries: {len(fasta.names)}"
     )
     file = list(pg.columns[5:])
     col = {}
@@ -587,9 +2130,11 @@ def mztab_PRH(report, pg, index_ref, database, fasta_df):
     logger.debug("Calculating protein coverage (bottleneck)...")
     # This is a bottleneck
     # reimplementation runs in 67s vs 137s (old) in my data
-    out_mztab_PRH.loc[:, "protein_coverage"] = calculate_protein_coverages(
-        report=report, out_mztab_PRH=out_mztab_PRH, fasta_df=fasta_df
-    )
+    with METRICS.stage("coverage") as stage:
+        out_mztab_PRH.loc[:, "protein_coverage"] = calculate_protein_coverages(
+            report=aggregates.protein_sequences, out_mztab_PRH=out_mztab_PRH, fasta=fasta
+        )
+        stage["rows"] = len(out_mztab_PRH)
 
     logger.debug("Getting ambiguity members...")
     # IN THEORY this should be the same as
@@ -602,7 +2147,7 @@ def mztab_PRH(report, pg, index_ref, database, fasta_df):
     )
 
     logger.debug("Matching PRH to best search engine score...")
-    score_looker = ModScoreLooker(report)
+    score_looker = ModScoreLooker(aggregates.protein_best)
     out_mztab_PRH[["modifiedSequence", "best_search_engine_score[1]"]] = out_mztab_PRH.apply(
         lambda x: score_looker.get_score(x["Protein.Ids"]), axis=1, result_type="expand"
     )
@@ -616,23 +2161,16 @@ def mztab_PRH(report, pg, index_ref, database, fasta_df):
     ## quantity at protein level: PG.MaxLFQ
     # This used to be a bottleneck in performance
     # This implementation drops the run time from 57s to 25ms
-    protein_agg_report = (
-        report[["PG.MaxLFQ", "Protein.Ids", "study_variable"]]
-        .groupby(["study_variable", "Protein.Ids"])
-        .agg({"PG.MaxLFQ": ["mean", "std", "sem"]})
-        .reset_index()
-        .pivot(columns=["study_variable"], index="Protein.Ids")
-        .reset_index()
+    protein_agg_report = pivot_study_variables(
+        finalize_moments(aggregates.protein_study, ["PG.MaxLFQ"]),
+        key="Protein.Ids",
+        by="study_variable",
+        subname_mapper={
+            "PG.MaxLFQ::mean": "protein_abundance_study_variable",
+            "PG.MaxLFQ::std": "protein_abundance_stdev_study_variable",
+            "PG.MaxLFQ::sem": "protein_abundance_std_error_study_variable",
+        },
     )
-    protein_agg_report.columns = ["::".join([str(s) for s in col]).strip() for col in protein_agg_report.columns.values]
-    subname_mapper = {
-        "Protein.Ids::::": "Protein.Ids",
-        "PG.MaxLFQ::mean": "protein_abundance_study_variable",
-        "PG.MaxLFQ::std": "protein_abundance_stdev_study_variable",
-        "PG.MaxLFQ::sem": "protein_abundance_std_error_study_variable",
-    }
-    name_mapper = name_mapper_builder(subname_mapper)
-    protein_agg_report.rename(columns=name_mapper, inplace=True)
     # out_mztab_PRH has columns accession and Protein.Ids; 'Q9NZJ9', 'A0A024RBG1;Q9NZJ9;Q9NZJ9-2']
     # the report table has 'Protein.Group' and 'Protein.Ids': 'Q9NZJ9', 'A0A024RBG1;Q9NZJ9;Q9NZJ9-2'
     # Oddly enough the last implementation mapped the the accession (Q9NZJ9) in the mztab
@@ -640,8 +2178,6 @@ def mztab_PRH(report, pg, index_ref, database, fasta_df):
     out_mztab_PRH = out_mztab_PRH.merge(
         protein_agg_report, on="Protein.Ids", how="left", validate="many_to_one", copy=True
     )
-    del name_mapper
-    del subname_mapper
     del protein_agg_report
     # end of (former) bottleneck
 
@@ -659,17 +2195,15 @@ def mztab_PRH(report, pg, index_ref, database, fasta_df):
 
 
 def mztab_PEH(
-    report: pd.DataFrame, pr: pd.DataFrame, precursor_list: List[str], index_ref: pd.DataFrame, database: os.PathLike
+    aggregates: "ReportAggregates", pr: pd.DataFrame, index_ref: pd.DataFrame, database: os.PathLike
 ) -> pd.DataFrame:
     """
     Construct PEH sub-table.
 
-    :param report: Dataframe for Dia-NN main report
-    :type report: pandas.core.frame.DataFrame
+    :param aggregates: Aggregates of the Dia-NN main report
+    :type aggregates: ReportAggregates
     :param pr: Dataframe for Dia-NN precursors matrix
     :type pr: pandas.core.frame.DataFrame
-    :param precursor_list: A list contains all precursor IDs
-    :type precursor_list: list
     :param index_ref: On the basis of f_table, two columns "ms_run" and "study_variable" are added for matching
     :type index_ref: pandas.core.frame.DataFrame
     :param database: Path to fasta file
@@ -677,11 +2211,12 @@ def mztab_PEH(
     :return: PEH sub-table
     :rtype: pandas.core.frame.DataFrame
     """
+    from pyopenms import AASequence
+
     logger.info("Constructing PEH sub-table...")
     logger.debug(
-        f"report.shape: {report.shape}, "
+        f"precursor aggregates shape: {aggregates.precursor.shape}, "
         f" pr.shape: {pr.shape},"
-        f" len(precursor_list): {len(precursor_list)},"
         f" index_ref.shape: {index_ref.shape}"
     )
     out_mztab_PEH = pd.DataFrame()
@@ -719,40 +2254,22 @@ def mztab_PEH(
         out_mztab_PEH.loc[:, i] = "null"
     out_mztab_PEH.loc[:, "opt_global_cv_MS:1002217_decoy_peptide"] = "0"
 
-    logger.debug("Matching precursor IDs...")
-    # Pre-calculating the indices and using a lookup table drops run time from
-    # ~6.5s to 11ms
-    precursor_indices = {k: i for i, k in enumerate(precursor_list)}
-    pr_ids = out_mztab_PEH["Precursor.Id"].map(precursor_indices)
-    out_mztab_PEH["pr_id"] = pr_ids
-    del precursor_indices
-
     logger.debug("Getting scores per run")
     # This implementation is 422-700x faster than the apply-based one
-    tmp = (
-        report.groupby(["precursor.Index", "ms_run"])
-        .agg({"Q.Value": ["min"]})
-        .reset_index()
-        .pivot(columns=["ms_run"], index="precursor.Index")
-        .reset_index()
-    )
-    tmp.columns = pd.Index(["::".join([str(s) for s in col]).strip() for col in tmp.columns.values])
-    subname_mapper = {
-        "precursor.Index::::": "precursor.Index",
-        "Q.Value::min": "search_engine_score[1]_ms_run",
-    }
-    name_mapper = name_mapper_builder(subname_mapper)
-    tmp.rename(columns=name_mapper, inplace=True)
-    out_mztab_PEH = out_mztab_PEH.merge(
-        tmp.rename(columns={"precursor.Index": "pr_id"}), on="pr_id", validate="one_to_one"
+    tmp = pivot_study_variables(
+        aggregates.precursor_run,
+        key="Precursor.Id",
+        by="ms_run",
+        subname_mapper={"Q.Value::min": "search_engine_score[1]_ms_run"},
     )
+    out_mztab_PEH = out_mztab_PEH.merge(tmp, on="Precursor.Id", validate="one_to_one")
     del tmp
-    del subname_mapper
-    del name_mapper
 
     logger.debug("Getting peptide abundances per study variable")
-    pep_study_report = per_peptide_study_report(report)
-    out_mztab_PEH = out_mztab_PEH.merge(pep_study_report, on="pr_id", how="left", validate="one_to_one", copy=True)
+    pep_study_report = per_peptide_study_report(aggregates.precursor_study)
+    out_mztab_PEH = out_mztab_PEH.merge(
+        pep_study_report, on="Precursor.Id", how="left", validate="one_to_one", copy=True
+    )
     del pep_study_report
 
     logger.debug("Getting peptide properties...")
@@ -763,38 +2280,34 @@ def mztab_PEH(
     # "opt_global_SpecEValue_score" was the FIRST "Lib.Q.Value" now its the min
     # I believe picking the first is inconsistent because no sorting is checked
     # and the first is arbitrary.
-
-    aggtable = (
-        report.groupby(["precursor.Index"])
-        .agg(
-            {
-                "Q.Value": "min",
-                "RT.Start": "mean",
-                "Global.Q.Value": "min",
-                "Lib.Q.Value": "min",
-                "Calculate.Precursor.Mz": "mean",
-            }
-        )
-        .reset_index()
-        .rename(
-            columns={
-                "precursor.Index": "pr_id",
-                "Q.Value": "best_search_engine_score[1]",
-                "RT.Start": "retention_time",
-                "Global.Q.Value": "opt_global_q-value",
-                "Lib.Q.Value": "opt_global_SpecEValue_score",
-                "Calculate.Precursor.Mz": "mass_to_charge",
-            }
-        )
+    precursor_moments = finalize_moments(aggregates.precursor, ["RT.Start", "Calculate.Precursor.Mz"])
+    aggtable = precursor_moments[
+        [
+            "Precursor.Id",
+            "Q.Value::min",
+            "RT.Start::mean",
+            "Global.Q.Value::min",
+            "Lib.Q.Value::min",
+            "Calculate.Precursor.Mz::mean",
+        ]
+    ].rename(
+        columns={
+            "Q.Value::min": "best_search_engine_score[1]",
+            "RT.Start::mean": "retention_time",
+            "Global.Q.Value::min": "opt_global_q-value",
+            "Lib.Q.Value::min": "opt_global_SpecEValue_score",
+            "Calculate.Precursor.Mz::mean": "mass_to_charge",
+        }
     )
+    del precursor_moments
     del out_mztab_PEH["mass_to_charge"]
-    out_mztab_PEH = out_mztab_PEH.merge(aggtable, on="pr_id", validate="one_to_one")
+    out_mztab_PEH = out_mztab_PEH.merge(aggtable, on="Precursor.Id", validate="one_to_one")
 
     logger.debug("Re-ordering columns...")
     out_mztab_PEH.loc[:, "PEH"] = "PEP"
     out_mztab_PEH.loc[:, "database"] = str(database)
     index = out_mztab_PEH.loc[:, "PEH"]
-    out_mztab_PEH.drop(["PEH", "Precursor.Id", "Genes", "pr_id"], axis=1, inplace=True)
+    out_mztab_PEH.drop(["PEH", "Precursor.Id", "Genes"], axis=1, inplace=True)
     out_mztab_PEH.insert(0, "PEH", index)
     out_mztab_PEH.fillna("null", inplace=True)
     new_cols = [col for col in out_mztab_PEH.columns if not col.startswith("opt_")] + [
@@ -805,7 +2318,105 @@ def mztab_PEH(
     return out_mztab_PEH
 
 
-def mztab_PSH(report, folder, database):
+class SpectrumIndex:
+    """
+    Index of the MS2 spectra of a run, from its ms_info table, matching precursors to the spectrum nearest
+    in retention time, within a tolerance, whose isolation window contains their m/z.
+
+    Spectra are grouped by isolation window, with their retention times (in minutes) sorted in each group.
+    A batch of precursors is matched with a searchsorted per window on the retention times, for the
+    precursors whose m/z falls in the window, found with a searchsorted on their sorted m/z. Spectra
+    without isolation window (ms_info tables written before it was recorded, or Bruker data) are in a
+    group accepting any m/z.
+    """
+
+    def __init__(self, ms_info: pd.DataFrame):
+        ms2 = np.flatnonzero(ms_info["MSLevel"].to_numpy() == 2)
+        rt = ms_info["Retention_Time"].to_numpy(dtype=float)[ms2] / 60
+        if "Isolation_Window_Lower" in ms_info.columns:
+            lower = ms_info["Isolation_Window_Lower"].to_numpy(dtype=float)[ms2]
+            upper = ms_info["Isolation_Window_Upper"].to_numpy(dtype=float)[ms2]
+            unknown = np.isnan(lower) | np.isnan(upper)
+            lower = np.where(unknown, -np.inf, lower)
+            upper = np.where(unknown, np.inf, upper)
+        else:
+            lower = np.full(len(ms2), -np.inf)
+            upper = np.full(len(ms2), np.inf)
+
+        windows, group = np.unique(np.stack([lower, upper], axis=1), axis=0, return_inverse=True)
+        group = group.reshape(-1)
+        order = np.lexsort((rt, group))
+        self.rows = ms2[order]
+        self.rt = rt[order]
+        self.lower = windows[:, 0]
+        self.upper = windows[:, 1]
+        self.starts = np.searchsorted(group[order], np.arange(len(windows) + 1))
+
+    def match(self, rt: np.ndarray, mz: np.ndarray, tolerance: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Matches precursors to spectra.
+
+        :param rt: Retention times of the precursors, in minutes
+        :type rt: numpy.ndarray
+        :param mz: m/z of the precursors
+        :type mz: numpy.ndarray
+        :param tolerance: Maximum difference in retention time between a precursor and its spectrum, in minutes
+        :type tolerance: float
+        :return: Row of the matched spectrum in the ms_info table for each precursor, -1 if none is within
+            the tolerance, and whether spectra of more than one isolation window were within it
+        :rtype: tuple
+        """
+        best = np.full(len(rt), -1)
+        best_delta = np.full(len(rt), np.inf)
+        candidates = np.zeros(len(rt), dtype=int)
+        mz_order = np.argsort(mz, kind="stable")
+        sorted_mz = mz[mz_order]
+        for window, (start, end) in enumerate(zip(self.starts[:-1], self.starts[1:])):
+            queries = mz_order[
+                np.searchsorted(sorted_mz, self.lower[window], side="left") : np.searchsorted(
+                    sorted_mz, self.upper[window], side="right"
+                )
+            ]
+            if not len(queries) or start == end:
+                continue
+
+            window_rt = self.rt[start:end]
+            position = np.searchsorted(window_rt, rt[queries])
+            before = np.clip(position - 1, 0, len(window_rt) - 1)
+            after = np.clip(position, 0, len(window_rt) - 1)
+            delta_before = np.abs(rt[queries] - window_rt[before])
+            delta_after = np.abs(window_rt[after] - rt[queries])
+            nearest = np.where(delta_after < delta_before, after, before)
+            delta = np.minimum(delta_before, delta_after)
+
+            within = delta <= tolerance
+            queries, nearest, delta = queries[within], nearest[within], delta[within]
+            candidates[queries] += 1
+            better = delta < best_delta[queries]
+            best[queries[better]] = start + nearest[better]
+            best_delta[queries[better]] = delta[better]
+
+        matched = best >= 0
+        return np.where(matched, self.rows[np.maximum(best, 0)], -1), candidates > 1
+
+
+def find_ms_info(directory: os.PathLike, run: str) -> Path:
+    """Finds the ms_info TSV of a run.
+
+    :raises ValueError: If no file, or more than one file, matches the run
+    """
+    # This line matches n="220101_myfile", folder="." to
+    # "myfolder/220101_myfile_ms_info.tsv"
+    files = list(Path(directory).glob(f"*{run}*_info.tsv"))
+    # Check that it matches one and only one file
+    if not files:
+        raise ValueError(f"Could not find {run} info file in {directory}")
+    if len(files) > 1:
+        raise ValueError(f"Found multiple {run} info files in {directory}: {files}")
+
+    return files[0]
+
+
+def mztab_PSH(report, folder, database, fasta=None, rt_tolerance=SPECTRUM_RT_TOLERANCE):
     """
     Construct PSH sub-table.
 
@@ -817,22 +2428,18 @@ def mztab_PSH(report, folder, database):
     :type folder: str
     :param database: Path to fasta file
     :type database: str
+    :param fasta: Index of the protein sequences of the fasta file, to locate the peptides in their
+        proteins. If not given, the "pre", "post", "start" and "end" columns are null
+    :type fasta: FastaIndex
+    :param rt_tolerance: Maximum difference in retention time between a precursor and the MS2 spectrum it
+        is matched to, in minutes. The spectra_ref of precursors matching no spectrum is null
+    :type rt_tolerance: float
     :return: PSH sub-table
     :rtype: pandas.core.frame.DataFrame
     """
-    logger.info("Constructing PSH sub-table")
+    from pyopenms import AASequence
 
-    def __find_info(directory, n):
-        # This line matches n="220101_myfile", folder="." to
-        # "myfolder/220101_myfile_ms_info.tsv"
-        files = list(Path(directory).glob(f"*{n}*_info.tsv"))
-        # Check that it matches one and only one file
-        if not files:
-            raise ValueError(f"Could not find {n} info file in {directory}")
-        if len(files) > 1:
-            raise ValueError(f"Found multiple {n} info files in {directory}: {files}")
-
-        return files[0]
+    logger.info("Constructing PSH sub-table")
 
     out_mztab_PSH = pd.DataFrame()
     for n, group in report.groupby(["Run"]):
@@ -842,20 +2449,26 @@ def mztab_PSH(report, folder, database):
             # related: https://github.com/pandas-dev/pandas/pull/51817
             n = n[0]
 
-        file = __find_info(folder, n)
+        file = find_ms_info(folder, n)
         target = pd.read_csv(file, sep="\t")
-        group.sort_values(by="RT.Start", inplace=True)
-        target = target[["Retention_Time", "SpectrumID", "Exp_Mass_To_Charge"]]
-        target.columns = ["RT.Start", "opt_global_spectrum_reference", "exp_mass_to_charge"]
+        group = group.sort_values(by="RT.Start").reset_index(drop=True)
         # Standardize spectrum identifier format for bruker data
-        if type(target.loc[0, "opt_global_spectrum_reference"]) != str:
-            target.loc[:, "opt_global_spectrum_reference"] = "scan=" + target.loc[
-                :, "opt_global_spectrum_reference"
-            ].astype(str)
-
-        # TODO seconds returned from precursor.getRT()
-        target.loc[:, "RT.Start"] = target.apply(lambda x: x["RT.Start"] / 60, axis=1)
-        out_mztab_PSH = pd.concat([out_mztab_PSH, pd.merge_asof(group, target, on="RT.Start", direction="nearest")])
+        if type(target.loc[0, "SpectrumID"]) != str:
+            target.loc[:, "SpectrumID"] = "scan=" + target.loc[:, "SpectrumID"].astype(str)
+
+        spectra = SpectrumIndex(target)
+        matches, ambiguous = spectra.match(
+            group["RT.Start"].to_numpy(), group["Calculate.Precursor.Mz"].to_numpy(), rt_tolerance
+        )
+        matched = matches >= 0
+        if not matched.all() or ambiguous.any():
+            logger.warning(
+                f"Run {n}: {(~matched).sum()} of {len(group)} precursors matched no MS2 spectrum within"
+                f" {rt_tolerance} min, {ambiguous.sum()} matched spectra of overlapping isolation windows"
+            )
+        group["opt_global_spectrum_reference"] = np.where(matched, target["SpectrumID"].to_numpy()[matches], np.nan)
+        group["exp_mass_to_charge"] = np.where(matched, target["Exp_Mass_To_Charge"].to_numpy()[matches], np.nan)
+        out_mztab_PSH = pd.concat([out_mztab_PSH, group])
     del report
 
     ## Score at PSM level: Q.Value
@@ -912,13 +2525,27 @@ def mztab_PSH(report, folder, database):
     for i in null_col:
         out_mztab_PSH.loc[:, i] = "null"
 
+    if fasta is not None:
+        logger.info("Locating peptides in proteins ...")
+        locations = peptide_locations(out_mztab_PSH[["sequence", "accession"]], fasta)
+        located = out_mztab_PSH[["sequence", "accession"]].merge(locations, on=["sequence", "accession"], how="left")
+        for i in ["pre", "post", "start", "end"]:
+            out_mztab_PSH.loc[:, i] = located[i].to_numpy()
+
     logger.info("Finding Modifications ...")
     out_mztab_PSH.loc[:, "modifications"] = out_mztab_PSH.apply(
         lambda x: find_modification(x["opt_global_cv_MS:1000889_peptidoform_sequence"]), axis=1, result_type="expand"
     )
 
+    # There is no valid reference to the spectrum of precursors matching none
     out_mztab_PSH.loc[:, "spectra_ref"] = out_mztab_PSH.apply(
-        lambda x: "ms_run[{}]:".format(x["ms_run"]) + x["opt_global_spectrum_reference"], axis=1, result_type="expand"
+        lambda x: (
+            "ms_run[{}]:".format(x["ms_run"]) + str(x["opt_global_spectrum_reference"])
+            if pd.notna(x["opt_global_spectrum_reference"])
+            else "null"
+        ),
+        axis=1,
+        result_type="expand",
     )
 
     out_mztab_PSH.loc[:, "opt_global_cv_MS:1000889_peptidoform_sequence"] = out_mztab_PSH.apply(
@@ -1080,6 +2707,68 @@ class ModScoreLooker:
 MODIFICATION_PATTERN = re.compile(r"\((.*?)\)")
 
 
+def peptide_locations(peptides: pd.DataFrame, fasta: FastaIndex) -> pd.DataFrame:
+    """
+    Locates peptides in the proteins they are assigned to, I and L being equivalent.
+
+    Every unique pair of peptide and proteins is located once, by searching the first occurrence of the
+    peptide in the sequence of each protein, so rows can then be joined to their location.
+
+    :param peptides: Table with the "sequence" (stripped) and "accession" (protein ids separated by ";")
+        of the peptides
+    :type peptides: pandas.core.frame.DataFrame
+    :param fasta: Index of the protein sequences of the fasta file
+    :type fasta: FastaIndex
+    :return: The unique pairs of "sequence" and "accession", with the "pre" and "post" residues ("-" at the
+        protein termini) and the 1-based "start" and "end" of the peptide in each protein, separated by ";"
+        as the proteins are. These are "null" if any of the proteins is not found, or does not contain the
+        peptide, rather than mixing locations and nulls
+    :rtype: pandas.core.frame.DataFrame
+    """
+    pairs = peptides[["sequence", "accession"]].drop_duplicates(ignore_index=True)
+    # Sequence of each protein, as read and with I replaced by L
+    proteins: Dict[str, Optional[Tuple[str, str]]] = {}
+    missing = set()
+    locations = []
+    for peptide, accessions in zip(pairs["sequence"], pairs["accession"]):
+        searched = peptide.replace("I", "L")
+        location = []
+        for accession in str(accessions).split(";"):
+            if accession not in proteins:
+                name = fasta.find_accession(accession)
+                sequence = fasta.sequence(name) if name is not None else None
+                proteins[accession] = None if sequence is None else (sequence, sequence.replace("I", "L"))
+            if proteins[accession] is None:
+                missing.add(accession)
+                location.append(("null", "null", "null", "null"))
+                continue
+
+            sequence, searchable = proteins[accession]
+            start = searchable.find(searched)
+            if start < 0:
+                location.append(("null", "null", "null", "null"))
+                continue
+            end = start + len(peptide)
+            location.append(
+                (
+                    sequence[start - 1] if start > 0 else "-",
+                    sequence[end] if end < len(sequence) else "-",
+                    str(start + 1),
+                    str(end),
+                )
+            )
+        if any(loc[0] == "null" for loc in location):
+            locations.append(("null", "null", "null", "null"))
+        else:
+            locations.append(tuple(";".join(values) for values in zip(*location)))
+
+    if missing:
+        logger.warning(f"Could not find {len(missing)} proteins in the fasta file to locate their peptides")
+    located = pd.DataFrame(locations, columns=["pre", "post", "start", "end"])
+    logger.debug(f"Located {(located['start'] != 'null').sum()} of {len(located)} peptides in their proteins")
+    return pd.concat([pairs, located], axis=1)
+
+
 def find_modification(peptide):
     """
     Identify the modification site based on the peptide containing modifications.
@@ -1151,7 +2840,7 @@ def name_mapper_builder(subname_mapper):
     return name_mapper
 
 
-def per_peptide_study_report(report: pd.DataFrame) -> pd.DataFrame:
+def per_peptide_study_report(precursor_study: pd.DataFrame) -> pd.DataFrame:
     """Summarizes the report at peptide/study level and flattens the columns.
 
     This function was implemented to replace an 'apply -> filter' approach.
@@ -1167,14 +2856,15 @@ def per_peptide_study_report(report: pd.DataFrame) -> pd.DataFrame:
        study variables > calculated value, this one is calculated value > study variables.
 
     Calculates the mean, standard deviation and std error of the precursor
-    abundances, as well as the mean retention time and m/z.
+    abundances, as well as the mean retention time and m/z, from the per
+    precursor/study variable moments of ReportAggregates.precursor_study.
 
     The names in the end are called "peptide" but thechnically the are at the
     precursor level. (peptide+charge combinations).
 
     The columns will look like this in the end:
     [
-        'pr_id',
+        'Precursor.Id',
         'peptide_abundance_study_variable[1]',
         ...
         'peptide_abundance_stdev_study_variable[1]',
@@ -1187,19 +2877,12 @@ def per_peptide_study_report(report: pd.DataFrame) -> pd.DataFrame:
         ...
     ]
     """
-    pep_study_grouped = (
-        report.groupby(["study_variable", "precursor.Index"])
-        .agg({"Precursor.Normalised": ["mean", "std", "sem"], "RT.Start": ["mean"], "Calculate.Precursor.Mz": ["mean"]})
-        .reset_index()
-        .pivot(columns=["study_variable"], index="precursor.Index")
-        .reset_index()
-    )
-    pep_study_grouped.columns = pd.Index(
-        ["::".join([str(s) for s in col]).strip() for col in pep_study_grouped.columns.values]
+    pep_study_grouped = finalize_moments(
+        precursor_study, ["Precursor.Normalised", "RT.Start", "Calculate.Precursor.Mz"]
     )
     # Columns here would be like:
     # [
-    #     "precursor.Index::::",
+    #     "Precursor.Id::",
     #     "Precursor.Normalised::mean::1",
     #     "Precursor.Normalised::mean::2",
     #     "Precursor.Normalised::std::1",
@@ -1211,21 +2894,107 @@ def per_peptide_study_report(report: pd.DataFrame) -> pd.DataFrame:
     # ]
     # So the right names need to be given and the table can be joined with the other one
     subname_mapper = {
-        "precursor.Index::::": "pr_id",
         "Precursor.Normalised::mean": "peptide_abundance_study_variable",
         "Precursor.Normalised::std": "peptide_abundance_stdev_study_variable",
         "Precursor.Normalised::sem": "peptide_abundance_std_error_study_variable",
-        "Calculate.Precursor.Mz::mean": "opt_global_mass_to_charge_study_variable",
         "RT.Start::mean": "opt_global_retention_time_study_variable",
+        "Calculate.Precursor.Mz::mean": "opt_global_mass_to_charge_study_variable",
     }
-    name_mapper = name_mapper_builder(subname_mapper)
 
-    pep_study_grouped.rename(
-        columns=name_mapper,
-        inplace=True,
+    return pivot_study_variables(
+        pep_study_grouped, key="Precursor.Id", by="study_variable", subname_mapper=subname_mapper
     )
 
-    return pep_study_grouped
+
+def pivot_study_variables(df: pd.DataFrame, key: str, by: str, subname_mapper: Dict[str, str]) -> pd.DataFrame:
+    """Pivots a long table of statistics per ``key`` and ``by`` (ms_run or study_variable) to one
+    row per ``key``, with one column per statistic and value of ``by``.
+
+    The statistics (keys of ``subname_mapper``) are kept in the given order and renamed with
+    their value in the mapper, suffixed by the value of ``by`` in brackets.
+
+    Examples:
+        >>> df = pd.DataFrame({"Protein.Ids": ["P1", "P1", "P2"], "study_variable": [1, 2, 1],
+        ...                    "PG.MaxLFQ::mean": [1.0, 2.0, 3.0]})
+        >>> pivot_study_variables(df, "Protein.Ids", "study_variable",
+        ...                       {"PG.MaxLFQ::mean": "protein_abundance_study_variable"}).columns.tolist()
+        ['Protein.Ids', 'protein_abundance_study_variable[1]', 'protein_abundance_study_variable[2]']
+    """
+    pivoted = df.pivot(index=key, columns=by, values=list(subname_mapper)).reset_index()
+    pivoted.columns = pd.Index(["::".join([str(s) for s in col]) for col in pivoted.columns.values])
+    name_mapper = name_mapper_builder({f"{key}::": key, **subname_mapper})
+    pivoted.rename(columns=name_mapper, inplace=True)
+    return pivoted
+
+
+def group_moments(df: pd.DataFrame, keys: List[str], columns: List[str]) -> pd.DataFrame:
+    """Computes the count, sum and sum of squared deviations from the mean of ``columns``
+    for each group of ``keys``.
+
+    Unlike means and standard deviations, these can be combined across disjoint subsets of
+    the groups (see combine_moments), missing values are not counted.
+
+    Examples:
+        >>> df = pd.DataFrame({"k": ["a", "a", "b"], "x": [1.0, 3.0, 5.0]})
+        >>> group_moments(df, ["k"], ["x"]).values.tolist()
+        [['a', 2, 4.0, 2.0], ['b', 1, 5.0, 0.0]]
+    """
+    grouped = df.groupby(keys)[columns]
+    deviations = df[keys].copy()
+    deviations[columns] = (df[columns] - grouped.transform("mean")) ** 2
+
+    out = pd.concat({"n": grouped.count(), "sum": grouped.sum(), "m2": deviations.groupby(keys)[columns].sum()}, axis=1)
+    out = out[[(stat, col) for col in columns for stat in ("n", "sum", "m2")]]
+    out.columns = pd.Index([f"{col}::{stat}" for stat, col in out.columns.values])
+    return out.reset_index()
+
+
+def combine_moments(df: pd.DataFrame, keys: List[str], columns: List[str]) -> pd.DataFrame:
+    """Combines the rows of group_moments computed on disjoint subsets of a table.
+
+    The sums of squared deviations are combined with the pairwise update of Chan et al.,
+    which is numerically stable, unlike going through the sums of squares.
+
+    Examples:
+        >>> df = pd.DataFrame({"k": ["a", "a", "b"], "x": [1.0, 3.0, 5.0]})
+        >>> parts = [group_moments(df.iloc[:1], ["k"], ["x"]), group_moments(df.iloc[1:], ["k"], ["x"])]
+        >>> combine_moments(pd.concat(parts), ["k"], ["x"]).values.tolist()
+        [['a', 2, 4.0, 2.0], ['b', 1, 5.0, 0.0]]
+    """
+    df = df.copy()
+    totals = df.groupby(keys)[[f"{col}::{stat}" for col in columns for stat in ("n", "sum")]].transform("sum")
+    for col in columns:
+        n, total, m2 = f"{col}::n", f"{col}::sum", f"{col}::m2"
+        mean = totals[total] / totals[n]
+        df[m2] = df[m2] + (df[n] * (df[total] / df[n] - mean) ** 2).fillna(0)
+
+    moment_columns = [f"{col}::{stat}" for col in columns for stat in ("n", "sum", "m2")]
+    return df.groupby(keys, as_index=False)[moment_columns].sum()
+
+
+def finalize_moments(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Adds the mean, standard deviation and standard error of the mean of ``columns``
+    computed from their moments (see group_moments).
+
+    As in pandas, the standard deviation is the sample one, and is missing for single values. The
+    rounding of the means leaves a variance of the order of eps * mean**2 in groups of equal values,
+    which depends on how the moments were computed or combined, so it is clamped to 0 for every
+    conversion to give the same one.
+
+    Examples:
+        >>> df = pd.DataFrame({"k": ["a", "b"], "x::n": [2, 1], "x::sum": [4.0, 5.0], "x::m2": [2.0, 0.0]})
+        >>> finalize_moments(df, ["x"])[["x::mean", "x::std"]].values.tolist()
+        [[2.0, 1.4142135623730951], [5.0, nan]]
+    """
+    df = df.copy()
+    for col in columns:
+        n = df[f"{col}::n"]
+        mean = df[f"{col}::sum"] / n.where(n > 0)
+        variance = df[f"{col}::m2"] / (n - 1).where(n > 1)
+        df[f"{col}::mean"] = mean
+        df[f"{col}::std"] = np.sqrt(variance.mask(variance <= np.finfo(float).eps * mean**2, 0.0))
+        df[f"{col}::sem"] = df[f"{col}::std"] / np.sqrt(n)
+    return df
 
 
 def calculate_coverage(ref_sequence: str, sequences: Set[str]):
@@ -1271,11 +3040,11 @@ def calculate_coverage(ref_sequence: str, sequences: Set[str]):
     return coverage
 
 
-def calculate_protein_coverages(report: pd.DataFrame, out_mztab_PRH: pd.DataFrame, fasta_df: pd.DataFrame) -> List[str]:
+def calculate_protein_coverages(report: pd.DataFrame, out_mztab_PRH: pd.DataFrame, fasta: "FastaIndex") -> List[str]:
     """Calculates protein coverages for the PRH table.
 
     The protein coverage is calculated as the fraction of the protein sequence
-    in the fasta df, covered by the peptides in the report table, for every
+    in the fasta file, covered by the peptides in the report table, for every
     protein in the PRH table (defined by accession, not protein.ids).
     """
     nested_df = (
@@ -1290,25 +3059,15 @@ def calculate_protein_coverages(report: pd.DataFrame, out_mztab_PRH: pd.DataFram
     # 2                A0AVT1;A0AVT1-2  {EDFTLLDFINAVK, KPDHVPISSEDER, QDVIITALDNVEAR,...
     ids_to_seqs = dict(zip(nested_df["Protein.Ids"], nested_df["Stripped.Sequence"]))
     acc_to_ids = dict(zip(out_mztab_PRH["accession"], out_mztab_PRH["Protein.Ids"]))
-    fasta_id_to_seqs = dict(zip(fasta_df["id"], fasta_df["seq"]))
     acc_to_fasta_ids: dict = {}
 
     # Since fasta ids are something like sp|P51451|BLK_HUMAN but
     # accessions are something like Q9Y6V7-2, we need to find a
     # partial string match between the two (the best one)
     for acc in acc_to_ids:
-        # I am pretty sure this is the slowest part of the code
-        matches = fasta_df[fasta_df["id"].str.contains(acc)]["id"]
-        if len(matches) == 0:
+        acc_to_fasta_ids[acc] = fasta.find_accession(acc)
+        if acc_to_fasta_ids[acc] is None:
             logger.warning(f"Could not find fasta id for accession {acc} in the fasta file.")
-            acc_to_fasta_ids[acc] = None
-        elif len(matches) == 1:
-            acc_to_fasta_ids[acc] = matches.iloc[0]
-        else:
-            # If multiple, find best match. ej. Pick Q9Y6V7 over Q9Y6V7-2
-            # This can be acquired by finding the shortest string, since
-            # it entails more un-matched characters.
-            acc_to_fasta_ids[acc] = min(matches, key=len)
 
     out: List[str] = [""] * len(out_mztab_PRH["accession"])
 
@@ -1317,7 +3076,7 @@ def calculate_protein_coverages(report: pd.DataFrame, out_mztab_PRH: pd.DataFram
         if f_id is None:
             out_cov = "null"
         else:
-            cov = calculate_coverage(fasta_id_to_seqs[f_id], ids_to_seqs[acc_to_ids[acc]])
+            cov = calculate_coverage(fasta.sequence(f_id), ids_to_seqs[acc_to_ids[acc]])
             out_cov = format(cov, ".03f")
 
         out[i] = out_cov
@@ -1326,6 +3085,9 @@ def calculate_protein_coverages(report: pd.DataFrame, out_mztab_PRH: pd.DataFram
 
 
 cli.add_command(convert)
+cli.add_command(shard)
+cli.add_command(merge)
+cli.add_command(incremental)
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,128 @@
+"""
+This module reads the OpenMS two-table experimental design: a file table, a blank line, then a sample table. The
+file is read in a single pass, which builds both tables with their integer columns typed and collects every error
+found on the way, so they can all be reported at once.
+License: Apache 2.0
+"""
+import os
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, List, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+FILE_COLUMNS = ("Fraction_Group", "Fraction", "Spectra_Filepath", "Label", "Sample")
+SAMPLE_COLUMNS = ("Sample", "MSstats_Condition", "MSstats_BioReplicate")
+# Columns holding indices, typed as integers
+INTEGER_COLUMNS = ("Fraction_Group", "Sample")
+
+
+@dataclass
+class ExpDesign:
+    """The two tables of an experimental design.
+
+    :param file_table: One row per spectra file, with its run name, the file name without extensions, in "run"
+    :type file_table: pandas.core.frame.DataFrame
+    :param sample_table: One row per sample
+    :type sample_table: pandas.core.frame.DataFrame
+    :param errors: Problems found in the design, empty if it is valid
+    :type errors: list
+    """
+
+    file_table: "pd.DataFrame"
+    sample_table: "pd.DataFrame"
+    errors: List[str] = field(default_factory=list)
+
+
+def read_expdesign(path: os.PathLike, validate: bool = False) -> ExpDesign:
+    """Reads a two-table experimental design.
+
+    Lines with another number of fields than their table header are left out, and integer columns with
+    other values are kept as strings, each with an error. With ``validate``, the consistency of the design,
+    e.g. that every Fraction_Group is used, is also checked.
+
+    :param path: Path to the experimental design
+    :type path: str
+    :param validate: Whether to also check the consistency of the design
+    :type validate: bool
+    :return: The file and sample tables, and the errors found
+    :rtype: ExpDesign
+    """
+    import pandas as pd
+
+    errors = []
+    # Header and rows of the file table, then of the sample table
+    tables: List[Tuple[List[str], List[List[str]]]] = []
+    ended = False
+    with open(path, "r") as f:
+        for number, line in enumerate(f, start=1):
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                # The first blank line after the file table ends it, the others are ignored
+                ended = ended or bool(tables)
+                continue
+            fields = line.split("\t")
+            if not tables or (ended and len(tables) == 1):
+                tables.append((fields, []))
+            elif len(fields) != len(tables[-1][0]):
+                errors.append(f"Line {number}: {len(fields)} fields instead of the {len(tables[-1][0])} of the header")
+            else:
+                tables[-1][1].append(fields)
+
+    one_table = len(tables) < 2
+    if one_table:
+        errors.append("the one-table format parser is broken in OpenMS2.5, please use one-table or sdrf")
+        tables += [([], [])] * (2 - len(tables))
+    file_table = pd.DataFrame(tables[0][1], columns=tables[0][0], dtype=object)
+    sample_table = pd.DataFrame(tables[1][1], columns=tables[1][0], dtype=object)
+
+    for name, table, columns in (("file", file_table, FILE_COLUMNS), ("sample", sample_table, SAMPLE_COLUMNS)):
+        missed_columns = [c for c in columns if c not in table.columns]
+        if missed_columns and not one_table:
+            errors.append("{0} column missed in the {1} table".format(" ".join(missed_columns), name))
+        for column in INTEGER_COLUMNS:
+            if column in table.columns:
+                integers = pd.to_numeric(table[column], errors="coerce")
+                if integers.isna().any() or (integers % 1 != 0).any():
+                    errors.append(f"{column} of the {name} table has non-integer values")
+                else:
+                    table[column] = integers.astype(int)
+    if "Spectra_Filepath" in file_table.columns:
+        file_table["run"] = true_stems(file_table["Spectra_Filepath"])
+
+    if validate and not one_table:
+        errors.extend(design_errors(file_table, sample_table))
+    return ExpDesign(file_table, sample_table, errors)
+
+
+def true_stems(paths: "pd.Series") -> "pd.Series":
+    """The file names of paths without any of their extensions, e.g. "foo" for "/data/foo.d.tar"."""
+    return paths.str.rsplit("/", n=1).str[-1].str.split(".", n=1).str[0]
+
+
+def design_errors(file_table: "pd.DataFrame", sample_table: "pd.DataFrame") -> List[str]:
+    """Consistency errors of a design, each checked if the columns it needs are there and typed."""
+    import pandas as pd
+
+    def has(table, *columns):
+        return all(
+            c in table.columns and (c not in INTEGER_COLUMNS or pd.api.types.is_integer_dtype(table[c]))
+            for c in columns
+        )
+
+    errors = []
+    if has(file_table, "Label") and file_table["Label"].nunique() > 1 and "MSstats_Mixture" not in sample_table.columns:
+        errors.append("MSstats_Mixture column missed in ISO experiments")
+    if (
+        has(file_table, "Fraction_Group")
+        and file_table["Fraction_Group"].max() > file_table["Fraction_Group"].nunique()
+    ):
+        errors.append("Fraction_Group discontinuous!")
+    if (
+        has(file_table, *FILE_COLUMNS)
+        and file_table.duplicated(["Fraction_Group", "Fraction", "Label", "Sample"]).any()
+    ):
+        errors.append("Existing duplicate entries in Fraction_Group, Fraction, Label and Sample")
+    if has(sample_table, "Sample") and sample_table["Sample"].duplicated().any():
+        errors.append("Existing duplicate Sample in sample table!")
+    return errors
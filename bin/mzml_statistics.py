@@ -8,11 +8,11 @@ import sys
 from pathlib import Path
 import sqlite3
 
-import pandas as pd
-from pyopenms import MSExperiment, MzMLFile
-
 
 def ms_dataframe(ms_path: str) -> None:
+    # Imported here rather than at the top, for the script to start fast; pyOpenMS is not needed for Bruker files
+    import pandas as pd
+
     file_columns = [
         "SpectrumID",
         "MSLevel",
@@ -23,9 +23,13 @@ def ms_dataframe(ms_path: str) -> None:
         "Retention_Time",
         "Exp_Mass_To_Charge",
         "AcquisitionDateTime",
+        "Isolation_Window_Lower",
+        "Isolation_Window_Upper",
     ]
 
     def parse_mzml(file_name: str, file_columns: list):
+        from pyopenms import MSExperiment, MzMLFile
+
         info = []
         exp = MSExperiment()
         acquisition_datetime = exp.getDateTime().get()
@@ -49,13 +53,33 @@ def ms_dataframe(ms_path: str) -> None:
                 tic = spectrum.getMetaValue("total ion current")
 
             if MSLevel == 1:
-                info_list = [id_, MSLevel, None, peak_per_ms, bpc, tic, rt, None, acquisition_datetime]
+                info_list = [id_, MSLevel, None, peak_per_ms, bpc, tic, rt, None, acquisition_datetime, None, None]
             elif MSLevel == 2:
-                charge_state = spectrum.getPrecursors()[0].getCharge()
-                emz = spectrum.getPrecursors()[0].getMZ() if spectrum.getPrecursors()[0].getMZ() else None
-                info_list = [id_, MSLevel, charge_state, peak_per_ms, bpc, tic, rt, emz, acquisition_datetime]
+                precursor = spectrum.getPrecursors()[0]
+                charge_state = precursor.getCharge()
+                emz = precursor.getMZ() if precursor.getMZ() else None
+                # Bounds of the isolation window, if recorded
+                lower_offset = precursor.getIsolationWindowLowerOffset()
+                upper_offset = precursor.getIsolationWindowUpperOffset()
+                if emz and (lower_offset or upper_offset):
+                    lower, upper = emz - lower_offset, emz + upper_offset
+                else:
+                    lower, upper = None, None
+                info_list = [
+                    id_,
+                    MSLevel,
+                    charge_state,
+                    peak_per_ms,
+                    bpc,
+                    tic,
+                    rt,
+                    emz,
+                    acquisition_datetime,
+                    lower,
+                    upper,
+                ]
             else:
-                info_list = [id_, MSLevel, None, None, None, None, rt, None, acquisition_datetime]
+                info_list = [id_, MSLevel, None, None, None, None, rt, None, acquisition_datetime, None, None]
 
             info.append(info_list)
 
@@ -90,6 +114,7 @@ def ms_dataframe(ms_path: str) -> None:
             df["Charge"] = df["Charge"].fillna(0)
         else:
             df[["Charge", "Exp_Mass_To_Charge"]] = None, None
+        df[["Isolation_Window_Lower", "Isolation_Window_Upper"]] = None, None
 
         df = df[
             [
@@ -102,6 +127,8 @@ def ms_dataframe(ms_path: str) -> None:
                 "Time",
                 "Exp_Mass_To_Charge",
                 "AcquisitionDateTime",
+                "Isolation_Window_Lower",
+                "Isolation_Window_Upper",
             ]
         ]
         df.columns = pd.Index(file_columns)
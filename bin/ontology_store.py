@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+This script builds an offline store of ontology terms from ontology dumps, and this module reads it, so SDRF files
+can be validated without the Ontology Lookup Service (OLS). The store is one file holding an open addressing hash
+table of the lowercase labels of the terms of each ontology. It is read through a memory map, so it opens in
+constant time whatever its size, and a lookup reads a few bytes of it.
+License: Apache 2.0
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import click
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+STORE_MAGIC = b"QMSONTO1"
+# Magic, number of slots of the hash table, number of terms and size of the metadata
+STORE_HEADER = struct.Struct("<8sQQQ")
+# A slot holds 0 when empty, else 1 + the offset of its term in the terms section
+STORE_SLOT = struct.Struct("<I")
+# A term is its length then "<ontology>\t<label>" in UTF-8
+STORE_TERM_LENGTH = struct.Struct("<H")
+
+logger = logging.getLogger(__name__)
+
+
+class OntologyStore:
+    """Offline store of the labels of the terms of some ontologies, read through a memory map.
+
+    It answers ``search`` as the OLS client of sdrf-pipelines does for exact searches, so it can replace the
+    client during a validation.
+
+    :param path: Path to the store, as written by ``build_store``
+    :type path: str
+    """
+
+    def __init__(self, path: os.PathLike):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._slots, self.terms, metadata_size = STORE_HEADER.unpack_from(self._map)
+        if magic != STORE_MAGIC:
+            raise ValueError(f"{self.path} is not an ontology store")
+        metadata = json.loads(self._map[STORE_HEADER.size : STORE_HEADER.size + metadata_size])
+        self.version: str = metadata["version"]
+        self.ontologies: Dict[str, Dict] = metadata["ontologies"]
+        self._slots_offset = STORE_HEADER.size + metadata_size
+        self._terms_offset = self._slots_offset + self._slots * STORE_SLOT.size
+
+    def contains(self, ontology: str, label: str) -> bool:
+        """Whether an ontology has a term of this label, compared in lowercase."""
+        term = f"{ontology.lower()}\t{label.lower()}".encode()
+        mask = self._slots - 1
+        slot = term_hash(term) & mask
+        while True:
+            (offset,) = STORE_SLOT.unpack_from(self._map, self._slots_offset + slot * STORE_SLOT.size)
+            if offset == 0:
+                return False
+            start = self._terms_offset + offset - 1
+            (length,) = STORE_TERM_LENGTH.unpack_from(self._map, start)
+            start += STORE_TERM_LENGTH.size
+            if length == len(term) and self._map[start : start + length] == term:
+                return True
+            slot = (slot + 1) & mask
+
+    def search(self, name: str, ontology: Optional[str] = None, exact=None, **kwargs) -> Optional[List[Dict]]:
+        """The terms of an exact search of a label, in any ontology of the store if none is given, as OLS returns
+        them: a list of the matching terms, or None if there are none."""
+        ontologies = [ontology.lower()] if ontology else list(self.ontologies)
+        found = [{"label": name, "ontology_name": o} for o in ontologies if self.contains(o, name)]
+        return found or None
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self) -> "OntologyStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def term_hash(term: bytes) -> int:
+    """Hash of a term in the store, the same on every platform and interpreter."""
+    return int.from_bytes(hashlib.blake2b(term, digest_size=8).digest(), "little")
+
+
+def build_store(out: os.PathLike, ontologies: Dict[str, Tuple[Iterable[str], Dict]]) -> str:
+    """Writes a store of the labels of the terms of some ontologies.
+
+    The terms are written sorted, so the same dumps always give the same file, whose version is a hash of its
+    terms. The hash table has at least twice as many slots as terms, which keeps the probes of a lookup short.
+
+    :param out: Path to the store, replaced atomically
+    :type out: str
+    :param ontologies: For each ontology name, e.g. "ncbitaxon", the labels of its terms and a description of
+        their source, e.g. its file and its version, saved in the metadata of the store
+    :type ontologies: dict
+    :return: The version of the store
+    :rtype: str
+    """
+    terms, descriptions = [], {}
+    for ontology, (labels, source) in ontologies.items():
+        ontology_terms = {f"{ontology.lower()}\t{label.lower()}".encode() for label in labels}
+        too_long = {t for t in ontology_terms if len(t) >= 2 ** (8 * STORE_TERM_LENGTH.size)}
+        if too_long:
+            logger.warning(f"Leaving out {len(too_long)} terms of {ontology} with a label too long to be stored")
+        terms.extend(ontology_terms - too_long)
+        descriptions[ontology.lower()] = {**source, "terms": len(ontology_terms - too_long)}
+    terms.sort()
+
+    slots = 1 << (2 * len(terms) - 1).bit_length()
+    mask = slots - 1
+    table = array("I", bytes(slots * STORE_SLOT.size))
+    section = bytearray()
+    for term in terms:
+        slot = term_hash(term) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = len(section) + 1
+        section += STORE_TERM_LENGTH.pack(len(term)) + term
+    if sys.byteorder != "little":
+        table.byteswap()
+
+    version = hashlib.sha1(section).hexdigest()[:16]
+    metadata = json.dumps({"version": version, "ontologies": descriptions}, separators=(",", ":")).encode()
+    # Padded with spaces, so the slots stay aligned
+    metadata += b" " * (-(STORE_HEADER.size + len(metadata)) % 8)
+
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    # Written aside and moved in place, so concurrent tasks never read a partial store
+    with tempfile.NamedTemporaryFile("wb", dir=out.parent, suffix=".tmp", delete=False) as f:
+        f.write(STORE_HEADER.pack(STORE_MAGIC, slots, len(terms), len(metadata)))
+        f.write(metadata)
+        f.write(table.tobytes())
+        f.write(section)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, out)
+    return version
+
+
+def read_obo(path: os.PathLike) -> Tuple[Set[str], Optional[str]]:
+    """Reads the names of the terms of an ontology in the OBO format, gzipped or not, leaving out the obsolete
+    ones as OLS does.
+
+    :return: The names of the terms and the data-version of the ontology, None if it has none
+    :rtype: tuple
+    """
+    opener = gzip.open if str(path).endswith(".gz") else open
+    names, version = set(), None
+    in_term, name, obsolete = False, None, False
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("["):
+                if in_term and name and not obsolete:
+                    names.add(name)
+                in_term, name, obsolete = line.strip() == "[Term]", None, False
+            elif in_term and line.startswith("name:"):
+                name = line[len("name:") :].strip()
+            elif in_term and line.startswith("is_obsolete:"):
+                obsolete = line[len("is_obsolete:") :].strip() == "true"
+            elif version is None and line.startswith("data-version:"):
+                version = line[len("data-version:") :].strip()
+    if in_term and name and not obsolete:
+        names.add(name)
+    return names, version
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def cli():
+    logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+
+
+@click.command("build")
+@click.option("--obo", "-b", multiple=True, help="Ontology dump as <ontology>=<path>, e.g. ms=psi-ms.obo.gz")
+@click.option("--unimod", is_flag=True, help="Add the Unimod database of sdrf-pipelines as the unimod ontology")
+@click.option("--out", "-o", required=True, help="Path to the store")
+def build(obo, unimod, out):
+    """
+    Build an ontology store from ontology dumps.
+
+    The ontologies the SDRF validation looks up are those of sdrf-pipelines' schemas, e.g. ncbitaxon for the
+    organisms, ms for the instruments and cleavage agents, pride for the labels and unimod for the
+    modifications.
+
+    :param obo: Ontology names, as OLS names them, and paths to their dumps in the OBO format
+    :type obo: list
+    :param unimod: Whether to add the modifications of the Unimod database shipped with sdrf-pipelines
+    :type unimod: bool
+    :param out: Path to the store
+    :type out: str
+    """
+    ontologies = {}
+    for dump in obo:
+        ontology, sep, path = dump.partition("=")
+        if not sep or not ontology or not path:
+            raise ValueError(f"{dump} is not an ontology dump as <ontology>=<path>")
+        if not Path(path).exists():
+            raise FileNotFoundError(f"Ontology dump {path} not found")
+        names, version = read_obo(path)
+        ontologies[ontology] = (names, {"source": Path(path).name, "data_version": version})
+        logger.info(f"{len(names)} terms read from {path} for {ontology} (version {version})")
+    if unimod:
+        from unimod_resolver import read_unimod_database, unimod_database_file
+
+        unimod_xml = unimod_database_file()
+        names = {m.name for m in read_unimod_database()}
+        version = hashlib.sha1(unimod_xml.read_bytes()).hexdigest()[:16]
+        ontologies["unimod"] = (names, {"source": unimod_xml.name, "data_version": version})
+        logger.info(f"{len(names)} terms read from {unimod_xml} for unimod")
+    if not ontologies:
+        raise ValueError("No ontology to build the store from, give --obo or --unimod")
+
+    version = build_store(out, ontologies)
+    logger.info(f"Ontology store {out} built, version {version}")
+
+
+@click.command("lookup")
+@click.option("--store", "-s", required=True, help="Path to the store")
+@click.option("--ontology", default=None, help="Ontology of the labels, any of the store by default")
+@click.argument("labels", nargs=-1)
+def lookup(store, ontology, labels):
+    """
+    Print the ontologies of the store holding each label, or "-" if none does.
+    """
+    with OntologyStore(store) as ontology_store:
+        for label in labels:
+            found = ontology_store.search(label, ontology=ontology) or []
+            print(label, ",".join(t["ontology_name"] for t in found) or "-", sep="\t")
+
+
+cli.add_command(build)
+cli.add_command(lookup)
+
+if __name__ == "__main__":
+    cli()
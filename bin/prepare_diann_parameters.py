@@ -6,13 +6,17 @@ License: Apache 2.0
 Authors: Dai Chengxin, Yasset Perez-Riverol
 """
 
-import re
-from typing import List, Tuple
+import csv
+import hashlib
+import os
+from typing import List, Optional, Tuple
 
 import click
-from sdrf_pipelines.openms.unimod import UnimodDatabase
+from unimod_resolver import UnimodResolver, split_modification
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+# Columns of the parameter sets of generate-batch, named after the keys of the experiment meta map
+BATCH_COLUMNS = ("enzyme", "fixedmodifications", "variablemodifications")
 
 
 @click.group(context_settings=CONTEXT_SETTINGS)
@@ -26,9 +30,56 @@ def cli():
 @click.option("--var_mod", "-v", help="")
 @click.pass_context
 def generate_cfg(ctx, enzyme, fix_mod, var_mod):
+    unimod_resolver = UnimodResolver.load()
+    with open("diann_config.cfg", "w") as file:
+        file.write(diann_config(unimod_resolver, enzyme, fix_mod, var_mod))
+
+
+@click.command("generate-batch")
+@click.option("--params", "-p", help="TSV with the enzyme, fixedmodifications and variablemodifications columns")
+@click.option("--out_dir", "-o", default=".", show_default=True)
+@click.pass_context
+def generate_batch(ctx, params, out_dir):
+    """
+    Generate the DIA-NN configurations of several parameter sets, resolved against one Unimod index.
+
+    Each distinct set gets a "diann_config_<hash>.cfg" file named after its parameters, so a set is written
+    to the same file whatever the order of the table. The table of the sets is written to
+    "diann_configs.tsv", with the name of the configuration of each of them.
+
+    :param params: Table of the parameter sets, one per row
+    :type params: str
+    :param out_dir: Directory the configurations are written in
+    :type out_dir: str
+    """
+    with open(params, newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        missing = set(BATCH_COLUMNS) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"Missing columns in {params}: {', '.join(sorted(missing))}")
+        parameter_sets = [tuple(row[c] or "" for c in BATCH_COLUMNS) for row in reader]
+
+    unimod_resolver = UnimodResolver.load()
+    os.makedirs(out_dir, exist_ok=True)
+    configs = {}
+    for parameter_set in parameter_sets:
+        if parameter_set not in configs:
+            name = "diann_config_" + hashlib.sha1("\t".join(parameter_set).encode()).hexdigest()[:12] + ".cfg"
+            with open(os.path.join(out_dir, name), "w") as file:
+                file.write(diann_config(unimod_resolver, *parameter_set))
+            configs[parameter_set] = name
+
+    with open(os.path.join(out_dir, "diann_configs.tsv"), "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow([*BATCH_COLUMNS, "config"])
+        writer.writerows([*parameter_set, name] for parameter_set, name in configs.items())
+    print(f"{len(configs)} DIA-NN configurations written for {len(parameter_sets)} parameter sets")
+
+
+def diann_config(unimod_resolver: UnimodResolver, enzyme: str, fix_mod: str, var_mod: str) -> str:
+    """The DIA-NN command line options of a parameter set."""
     cut = enzyme_cut(enzyme)
-    unimod_database = UnimodDatabase()
-    fix_ptm, var_ptm = convert_mod(unimod_database, fix_mod, var_mod)
+    fix_ptm, var_ptm = convert_mod(unimod_resolver, fix_mod, var_mod)
 
     var_ptm_str = " --var-mod "
     fix_ptm_str = " --fixed-mod "
@@ -39,60 +90,38 @@ def generate_cfg(ctx, enzyme, fix_mod, var_mod):
     for mod in var_ptm:
         diann_var_ptm += var_ptm_str + mod
 
-    with open("diann_config.cfg", "w") as file:
-        file.write("--cut " + cut + diann_fix_ptm + diann_var_ptm)
-
-
-def convert_mod(unimod_database, fix_mod: str, var_mod: str) -> Tuple[List, List]:
-    pattern = re.compile(r"\((.*?)\)")
-    var_ptm = []
-    fix_ptm = []
-
-    if fix_mod != "":
-        for mod in fix_mod.split(","):
-            tag = 0
-            for modification in unimod_database.modifications:
-                if modification.get_name() == mod.split(" ")[0]:
-                    diann_mod = modification.get_name() + "," + str(modification._delta_mono_mass)
-                    tag = 1
-                    break
-            if tag == 0:
-                print("Warning: Currently only supported unimod modifications for DIA pipeline. Skipped: " + mod)
-                continue
-            site = re.findall(pattern, " ".join(mod.split(" ")[1:]))[0]
-            if site == "Protein N-term":
-                site = "*n"
-            elif site == "N-term":
-                site = "n"
-
-            if "TMT" in diann_mod or "Label" in diann_mod or "iTRAQ" in diann_mod or "mTRAQ" in diann_mod:
-                fix_ptm.append(diann_mod + "," + site + "," + "label")
-            else:
-                fix_ptm.append(diann_mod + "," + site)
-
-    if var_mod != "":
-        for mod in var_mod.split(","):
-            tag = 0
-            for modification in unimod_database.modifications:
-                if modification.get_name() == mod.split(" ")[0]:
-                    diann_mod = modification.get_name() + "," + str(modification._delta_mono_mass)
-                    tag = 1
-                    break
-            if tag == 0:
-                print("Warning: Currently only supported unimod modifications for DIA pipeline. Skipped: " + mod)
-                continue
-            site = re.findall(pattern, " ".join(mod.split(" ")[1:]))[0]
-            if site == "Protein N-term":
-                site = "*n"
-            elif site == "N-term":
-                site = "n"
-
-            if "TMT" in diann_mod or "Label" in diann_mod or "iTRAQ" in diann_mod or "mTRAQ" in diann_mod:
-                var_ptm.append(diann_mod + "," + site + "," + "label")
-            else:
-                var_ptm.append(diann_mod + "," + site)
-
-    return fix_ptm, var_ptm
+    return "--cut " + cut + diann_fix_ptm + diann_var_ptm
+
+
+def convert_mod(unimod_resolver: UnimodResolver, fix_mod: str, var_mod: str) -> Tuple[List, List]:
+    fix_ptm = [diann_mod(unimod_resolver, mod) for mod in fix_mod.split(",")]
+    var_ptm = [diann_mod(unimod_resolver, mod) for mod in var_mod.split(",")]
+    return [ptm for ptm in fix_ptm if ptm], [ptm for ptm in var_ptm if ptm]
+
+
+# DIA-NN notation of the terminal sites
+_DIANN_TERMINI = {"Protein N-term": "*n", "N-term": "n"}
+
+
+def diann_mod(unimod_resolver: UnimodResolver, mod: str) -> Optional[str]:
+    """Converts a modification such as "Oxidation (M)" to the DIA-NN "name,mass,site[,label]" form.
+
+    :return: The DIA-NN modification, None if the modification is empty or not in Unimod
+    :rtype: str
+    """
+    if mod == "":
+        return None
+    name, site = split_modification(mod)
+    modification = unimod_resolver.resolve(name)
+    if modification is None or site is None:
+        print("Warning: Currently only supported unimod modifications for DIA pipeline. Skipped: " + mod)
+        return None
+    site = _DIANN_TERMINI.get(site, site)
+
+    diann_mod = modification.name + "," + modification.delta_mono_mass + "," + site
+    if any(label in modification.name for label in ("TMT", "Label", "iTRAQ", "mTRAQ")):
+        diann_mod += ",label"
+    return diann_mod
 
 
 _ENZYME_SPECIFICITY = {
@@ -110,6 +139,7 @@ def enzyme_cut(enzyme: str) -> str:
 
 
 cli.add_command(generate_cfg)
+cli.add_command(generate_batch)
 
 if __name__ == "__main__":
     cli()
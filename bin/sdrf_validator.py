@@ -0,0 +1,210 @@
+"""
+This module validates SDRF files with the schemas of sdrf-pipelines, without validating the same cell twice. The
+cell checks of a template, e.g. the ontology lookups, depend only on the value of the cell, so each distinct value
+of a column is checked once and its result broadcast to the rows holding it. The results of the rows are cached,
+keyed by a hash of their content, so a re-validation of an edited file only checks the rows that changed. The
+ontology terms are looked up in OLS, or in an offline ontology store (see ontology_store.py) when one is given.
+License: Apache 2.0
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Set
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Directory of the cached results, ~/.cache/quantms unless set
+SDRF_CACHE_ENV = "QUANTMS_CACHE_DIR"
+# Version of the layout of the cache, part of its key
+SDRF_CACHE_FORMAT = 1
+
+logger = logging.getLogger(__name__)
+
+
+def validate_sdrf(
+    df: "pd.DataFrame", template: str, cache_dir: Optional[os.PathLike] = None, ontology_store=None
+) -> List:
+    """Validates an SDRF against a template, as ``SdrfDataFrame.validate`` does, with the errors in the same order.
+
+    The checks of the header run on every validation. The checks of the cells only run on the rows missing from
+    the cache, which is keyed by the version of sdrf-pipelines, the template, the header of the file and the
+    version of the ontology store.
+
+    :param df: The SDRF, as read by ``SdrfDataFrame.parse``
+    :type df: sdrf_pipelines.sdrf.sdrf.SdrfDataFrame
+    :param template: Name of the template, e.g. "default" or "mass_spectrometry"
+    :type template: str
+    :param cache_dir: Directory of the cache, ``$QUANTMS_CACHE_DIR`` or ~/.cache/quantms by default
+    :type cache_dir: str
+    :param ontology_store: Store to look the ontology terms up in instead of OLS, which must hold every
+        ontology the template looks up in the columns of the SDRF
+    :type ontology_store: ontology_store.OntologyStore
+    :return: The errors and warnings of the SDRF, with the row and column of those found in a cell
+    :rtype: list
+    """
+    import importlib.metadata
+
+    schemas = template_schemas(template)
+    if ontology_store is not None:
+        missing = sorted(required_ontologies(df, schemas) - set(ontology_store.ontologies))
+        if missing:
+            raise ValueError(
+                f"The ontology store {ontology_store.path} has no terms of {', '.join(missing)}, looked up by {template}"
+            )
+    key = hashlib.sha1(
+        json.dumps(
+            [
+                SDRF_CACHE_FORMAT,
+                importlib.metadata.version("sdrf-pipelines"),
+                template,
+                list(df.columns),
+                ontology_store.version if ontology_store is not None else "ols",
+            ]
+        ).encode()
+    ).hexdigest()[:16]
+    if cache_dir is None:
+        cache_dir = os.environ.get(SDRF_CACHE_ENV) or Path.home() / ".cache" / "quantms"
+    cache = Path(cache_dir) / f"sdrf_validation_{key}.json"
+
+    cached = {}
+    if cache.exists():
+        try:
+            with open(cache) as f:
+                cached = json.load(f)["rows"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring the unreadable SDRF validation cache {cache}: {e}")
+
+    hashes = [hashlib.sha1("\x1f".join(row).encode()).hexdigest() for row in df.itertuples(index=False)]
+    new_rows = [i for i, h in enumerate(hashes) if h not in cached]
+    logger.info(f"Validating {len(new_rows)} of the {len(df)} rows of the SDRF against {template}")
+    results = dict(cached)
+    with ontology_client(ontology_store):
+        results.update(zip((hashes[i] for i in new_rows), cell_errors(df.iloc[new_rows], schemas)))
+
+    errors = []
+    for s, schema in enumerate(schemas):
+        errors.extend(schema_errors(df, schema, [results[h][s] for h in hashes]))
+
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        # Only the rows of this file are kept, so the cache does not grow with every edit
+        with tempfile.NamedTemporaryFile("w", dir=cache.parent, suffix=".tmp", delete=False) as f:
+            json.dump({"key": key, "rows": {h: results[h] for h in hashes}}, f, separators=(",", ":"))
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, cache)
+    except OSError as e:
+        logger.warning(f"Could not cache the SDRF validation in {cache.parent}: {e}")
+    return errors
+
+
+def template_schemas(template: str) -> List:
+    """The schemas ``SdrfDataFrame.validate`` checks an SDRF against for a template, in the order it does."""
+    from sdrf_pipelines.sdrf import sdrf_schema as s
+
+    if template == s.MASS_SPECTROMETRY:
+        return [s.mass_spectrometry_schema]
+    extra = {
+        s.HUMAN_TEMPLATE: s.human_schema,
+        s.VERTEBRATES_TEMPLATE: s.vertebrates_chema,
+        s.NON_VERTEBRATES_TEMPLATE: s.nonvertebrates_chema,
+        s.PLANTS_TEMPLATE: s.plants_chema,
+        s.CELL_LINES_TEMPLATE: s.cell_lines_schema,
+    }
+    return [s.default_schema] + ([extra[template]] if template in extra else [])
+
+
+def required_ontologies(df: "pd.DataFrame", schemas: List) -> Set[str]:
+    """The ontologies the schemas look terms up in, for the columns of an SDRF."""
+    from sdrf_pipelines.sdrf.sdrf_schema import OntologyTerm
+
+    return {
+        validation._ontology_name.lower()
+        for schema in schemas
+        for column in schema.columns
+        if column.name in df.columns
+        for validation in column.validations + list(column.optional_validations)
+        if isinstance(validation, OntologyTerm) and validation._ontology_name
+    }
+
+
+@contextmanager
+def ontology_client(ontology_store):
+    """Looks the ontology terms up in an ontology store instead of OLS, if one is given."""
+    from sdrf_pipelines.sdrf import sdrf_schema
+
+    if ontology_store is None:
+        yield
+        return
+    client = sdrf_schema.client
+    sdrf_schema.client = ontology_store
+    try:
+        yield
+    finally:
+        sdrf_schema.client = client
+
+
+def cell_errors(df: "pd.DataFrame", schemas: List) -> List[List]:
+    """The errors and warnings found in the cells of each row, for each schema.
+
+    Every distinct value of a column is validated once, and its errors given to all the rows holding it.
+
+    :return: For each row, for each schema, the (column, message) pairs of its errors then of its warnings, in
+        the order of the columns and validations of the schema
+    :rtype: list
+    """
+    import pandas as pd
+
+    rows = [[[[], []] for _ in schemas] for _ in range(len(df))]
+    for s, schema in enumerate(schemas):
+        for column in schema.columns:
+            if len(df) == 0 or column.name not in df.columns:
+                continue
+            values = pd.Series(df[column.name].unique(), name=column.name, dtype=object)
+            for kind, found in enumerate((column.validate(values), column.validate_optional(values))):
+                messages: Dict[str, List[str]] = {}
+                for error in found:
+                    messages.setdefault(values[error.row], []).append(error.message)
+                if not messages:
+                    continue
+                for i, value in enumerate(df[column.name]):
+                    for message in messages.get(value, []):
+                        rows[i][s][kind].append([column.name, message])
+    return rows
+
+
+def schema_errors(df: "pd.DataFrame", schema, rows: List[List]) -> List:
+    """The errors of an SDRF against a schema, from the checks of its header and the errors found in its cells.
+
+    :param rows: For each row of ``df``, its errors then its warnings, as from ``cell_errors``
+    :type rows: list
+    """
+    from pandas_schema import ValidationWarning
+    from sdrf_pipelines.sdrf.sdrf_schema import check_minimum_columns
+    from sdrf_pipelines.utils.exceptions import LogicError
+
+    errors = []
+    if check_minimum_columns(df, schema._min_columns):
+        errors.append(
+            LogicError(
+                "The number of columns in the SDRF ({}) is smaller than the number of mandatory fields ({})".format(
+                    len(df.get_sdrf_columns()), schema._min_columns
+                ),
+                error_type=logging.WARN,
+            )
+        )
+    mandatory = schema.validate_mandatory_columns(df)
+    if mandatory is not None:
+        errors.append(mandatory)
+    errors.extend(schema.validate_columns_order(df) or [])
+    errors.extend(schema._get_column_pairs(df)[1])
+    for row, (found, _) in zip(df.index, rows):
+        errors.extend(ValidationWarning(message, df.at[row, c], row, c) for c, message in found)
+    errors.extend(schema.validate_column_names(df))
+    for row, (_, warnings) in zip(df.index, rows):
+        errors.extend(LogicError(message, df.at[row, c], row, c, error_type=logging.WARN) for c, message in warnings)
+    return errors
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""
+This script recommends the resources of the processes of the pipeline from the Nextflow traces of past runs. For
+each process, it fits the peak memory and the run time of its tasks as a linear function of their input size,
+approximated by the bytes they read (rchar), and sizes its memory and time for the largest inputs seen, and its CPUs
+for the usage seen. It writes the recommendations as a config to pass with ``-c``, and a report of the resources
+reserved and of the retries expected with them and with the settings the traces were recorded with.
+License: Apache 2.0
+"""
+import csv
+import logging
+import math
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import click
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+GB = 1024**3
+# Exit statuses of the tasks killed for their resources, which the base config retries
+RESOURCE_EXIT_STATUSES = set(range(130, 146)) | {104}
+# Tasks of a process under which its memory and time are not fitted to its inputs, but set from the largest seen
+MIN_FIT_TASKS = 5
+# Margins over the fitted peak memory, run time and CPU usage
+MEMORY_MARGIN = 1.2
+TIME_MARGIN = 1.5
+CPU_MARGIN = 1.2
+# CPU usage, as a share of the CPUs of the task, over which the task is taken as limited by its CPUs
+CPU_BOUND_SHARE = 0.9
+MIN_MEMORY_GB = 1
+MIN_TIME_MINUTES = 10
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4, "PB": 1024**5}
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+DURATION_PART = re.compile(r"([\d.]+)\s*(ms|s|m|h|d)")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Task:
+    """A task of a trace, with its resources in bytes, seconds and CPUs, None when not traced."""
+
+    process: str
+    status: str
+    exit: Optional[int]
+    input_bytes: Optional[float]
+    peak_rss: Optional[float]
+    realtime: Optional[float]
+    cpu_usage: Optional[float]
+    cpus: Optional[float]
+    memory: Optional[float]
+    time: Optional[float]
+
+
+@dataclass
+class Recommendation:
+    """Resources recommended for a process, and the observations they come from."""
+
+    process: str
+    cpus: int
+    memory_gb: int
+    time_minutes: int
+    completed: List[Task] = field(default_factory=list)
+    failed: List[Task] = field(default_factory=list)
+    fitted: bool = False
+
+
+def parse_size(value: str) -> Optional[float]:
+    """Bytes of a size of a trace, raw ("1048576") or formatted ("1 MB"), None if not traced."""
+    value = value.strip()
+    if value in ("", "-"):
+        return None
+    number, _, unit = value.partition(" ")
+    return float(number) * SIZE_UNITS[unit.upper() or "B"]
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Seconds of a duration of a trace, raw in milliseconds ("61000") or formatted ("1m 1s"), None if not traced."""
+    value = value.strip()
+    if value in ("", "-"):
+        return None
+    if re.fullmatch(r"[\d.]+", value):
+        return float(value) / 1000
+    return sum(float(n) * DURATION_UNITS[u] for n, u in DURATION_PART.findall(value))
+
+
+def parse_number(value: str) -> Optional[float]:
+    value = value.strip().rstrip("%")
+    return None if value in ("", "-") else float(value)
+
+
+def read_traces(paths: Iterable[Path]) -> List[Task]:
+    """Reads the tasks of Nextflow trace files.
+
+    The process of a task is read from the process field, or from its name without its tag with the default fields.
+    The CPUs, memory and time the tasks were given are read when traced.
+    """
+    tasks = []
+    for path in paths:
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                process = row.get("process") or re.sub(r" \(.*\)$", "", row["name"])
+                exit_status = row.get("exit", "-").strip()
+                tasks.append(
+                    Task(
+                        process=process,
+                        status=row.get("status", ""),
+                        exit=int(exit_status) if exit_status.lstrip("-").isdigit() else None,
+                        input_bytes=parse_size(row.get("rchar", "-")),
+                        peak_rss=parse_size(row.get("peak_rss", "-")),
+                        realtime=parse_duration(row.get("realtime", "-")),
+                        cpu_usage=parse_number(row.get("%cpu", "-")),
+                        cpus=parse_number(row.get("cpus", "-")),
+                        memory=parse_size(row.get("memory", "-")),
+                        time=parse_duration(row.get("time", "-")),
+                    )
+                )
+    return tasks
+
+
+def fit_envelope(xs: List[float], ys: List[float], x_max: float) -> Tuple[float, bool]:
+    """The value of ``ys`` expected at ``x_max``, from a least squares line shifted up by its largest residual, so it
+    is above every observation. Without enough observations, or if ``ys`` do not grow with ``xs``, the largest of
+    ``ys``.
+
+    :return: The expected value, and whether it comes from a fitted line
+    :rtype: tuple
+    """
+    n = len(xs)
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if n < MIN_FIT_TASKS or variance == 0:
+        return max(ys), False
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+    if slope <= 0:
+        return max(ys), False
+    intercept = mean_y - slope * mean_x
+    shift = max(y - (intercept + slope * x) for x, y in zip(xs, ys))
+    return intercept + slope * x_max + shift, True
+
+
+def recommend(process: str, tasks: List[Task], input_scale: float) -> Optional[Recommendation]:
+    """Recommends the resources of a process from its tasks, None if none of them completed with its metrics.
+
+    :param input_scale: Size of the largest input to size the process for, relative to the largest one traced
+    :type input_scale: float
+    """
+    completed = [t for t in tasks if t.status == "COMPLETED" and None not in (t.input_bytes, t.peak_rss, t.realtime)]
+    if not completed:
+        return None
+    failed = [t for t in tasks if t.status in ("FAILED", "ABORTED") and t.exit in RESOURCE_EXIT_STATUSES]
+    xs = [t.input_bytes for t in completed]
+    x_max = max(xs) * input_scale
+    memory, fitted_memory = fit_envelope(xs, [t.peak_rss for t in completed], x_max)
+    time, fitted_time = fit_envelope(xs, [t.realtime for t in completed], x_max)
+    memory_gb = max(MIN_MEMORY_GB, math.ceil(memory * MEMORY_MARGIN / GB))
+    # Tasks killed for their memory needed more than they were given
+    memory_gb = max([memory_gb] + [math.ceil(t.memory / GB) + 1 for t in failed if t.memory])
+    time_minutes = max(MIN_TIME_MINUTES, math.ceil(time * TIME_MARGIN / 60 / MIN_TIME_MINUTES) * MIN_TIME_MINUTES)
+
+    usage = sorted(t.cpu_usage / 100 for t in completed if t.cpu_usage is not None)
+    given = max((t.cpus for t in completed if t.cpus), default=None)
+    cpus = math.ceil(usage[int(0.95 * (len(usage) - 1))] * CPU_MARGIN) if usage else (given or 1)
+    if given:
+        # A process limited by the CPUs it was given may use more, they are kept, and never raised as its usage
+        # above them is unknown
+        cpus = int(given) if usage and usage[-1] >= CPU_BOUND_SHARE * given else min(cpus, int(given))
+    return Recommendation(
+        process=process,
+        cpus=max(1, cpus),
+        memory_gb=memory_gb,
+        time_minutes=time_minutes,
+        completed=completed,
+        failed=failed,
+        fitted=fitted_memory or fitted_time,
+    )
+
+
+def expected_retries(recommendation: Recommendation) -> List[Task]:
+    """The traced tasks that would be killed for their memory or time with the recommended resources."""
+    memory, time = recommendation.memory_gb * GB, recommendation.time_minutes * 60
+    retried = [t for t in recommendation.completed if t.peak_rss > memory or t.realtime > time]
+    retried += [t for t in recommendation.failed if t.memory and t.memory >= memory]
+    return retried
+
+
+def reserved(tasks: Iterable[Task], cpus: Optional[float] = None, memory: Optional[float] = None) -> Tuple:
+    """CPU hours and memory GB hours reserved by tasks, with the resources they were given unless others are.
+
+    :return: The CPU hours and memory GB hours, None if the resources of a task are unknown
+    :rtype: tuple
+    """
+    cpu_hours, gb_hours = 0.0, 0.0
+    for t in tasks:
+        hours = (t.realtime or 0) / 3600
+        task_cpus, task_memory = cpus or t.cpus, memory or t.memory
+        cpu_hours = None if cpu_hours is None or task_cpus is None else cpu_hours + task_cpus * hours
+        gb_hours = None if gb_hours is None or task_memory is None else gb_hours + task_memory / GB * hours
+    return cpu_hours, gb_hours
+
+
+def format_time(minutes: int) -> str:
+    return f"{minutes // 60}.h" if minutes % 60 == 0 else f"{minutes}.min"
+
+
+def write_config(path: Path, recommendations: List[Recommendation], traces: int):
+    """Writes the recommendations as a config overriding the resources of the base config for each process. The
+    memory and time still grow with the attempts, so a task killed for them is retried with more."""
+    lines = [
+        "/*",
+        f"    Resources of the processes recommended by trace_resources.py from {traces} Nextflow traces",
+        "    Use with: nextflow run ... -c <this file>",
+        "*/",
+        "",
+        "process {",
+    ]
+    for r in recommendations:
+        memory, time = f"{r.memory_gb}.GB", format_time(r.time_minutes)
+        width = max(len(memory), len(time))
+        lines += [
+            f"    withName: '{r.process}' {{",
+            f"        cpus   = {{ check_max( {str(r.cpus):<{width + len(' * task.attempt')}}, 'cpus'   ) }}",
+            f"        memory = {{ check_max( {memory:<{width}} * task.attempt, 'memory' ) }}",
+            f"        time   = {{ check_max( {time:<{width}} * task.attempt, 'time'   ) }}",
+            "    }",
+        ]
+    lines.append("}")
+    path.write_text("\n".join(lines) + "\n")
+
+
+def report_rows(recommendations: List[Recommendation]) -> List[Dict]:
+    """A row of the report for each process, and one for all of them."""
+
+    def rate(retries, tasks):
+        return round(retries / tasks, 4) if tasks else 0.0
+
+    def rounded(value):
+        return "" if value is None else round(value, 2)
+
+    rows, totals = [], {"current": [0.0, 0.0], "recommended": [0.0, 0.0]}
+    for r in recommendations:
+        current = reserved(r.completed + r.failed)
+        retries = expected_retries(r)
+        recommended = reserved(r.completed + retries, r.cpus, r.memory_gb * GB)
+        for name, values in (("current", current), ("recommended", recommended)):
+            totals[name] = [None if t is None or v is None else t + v for t, v in zip(totals[name], values)]
+        rows.append(
+            {
+                "process": r.process,
+                "tasks": len(r.completed),
+                "fitted": r.fitted,
+                "cpus": r.cpus,
+                "memory_gb": r.memory_gb,
+                "time": format_time(r.time_minutes),
+                "max_peak_rss_gb": round(max(t.peak_rss for t in r.completed) / GB, 2),
+                "max_input_gb": round(max(t.input_bytes for t in r.completed) / GB, 2),
+                "cpu_hours": rounded(current[0]),
+                "recommended_cpu_hours": rounded(recommended[0]),
+                "memory_gb_hours": rounded(current[1]),
+                "recommended_memory_gb_hours": rounded(recommended[1]),
+                "retry_rate": rate(len(r.failed), len(r.completed)),
+                "recommended_retry_rate": rate(len(retries), len(r.completed)),
+            }
+        )
+    tasks = sum(len(r.completed) for r in recommendations)
+    rows.append(
+        {
+            "process": "all",
+            "tasks": tasks,
+            "cpu_hours": rounded(totals["current"][0]),
+            "recommended_cpu_hours": rounded(totals["recommended"][0]),
+            "memory_gb_hours": rounded(totals["current"][1]),
+            "recommended_memory_gb_hours": rounded(totals["recommended"][1]),
+            "retry_rate": rate(sum(len(r.failed) for r in recommendations), tasks),
+            "recommended_retry_rate": rate(sum(len(expected_retries(r)) for r in recommendations), tasks),
+        }
+    )
+    return rows
+
+
+@click.command("recommend", context_settings=CONTEXT_SETTINGS)
+@click.argument("traces", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--out", "-o", default="resources.config", show_default=True, help="Config to write")
+@click.option("--report", "-r", default="resources_report.tsv", show_default=True, help="Report to write")
+@click.option(
+    "--input_scale",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Largest input to size the processes for, relative to the largest traced",
+)
+def main(traces, out, report, input_scale):
+    """
+    Recommend the resources of the processes of the pipeline from the Nextflow traces of past runs.
+
+    The traces need the process, status, exit, realtime, %cpu, peak_rss and rchar fields, as the pipeline
+    writes them. With the cpus, memory and time fields, the report also gives the CPU and memory hours reserved
+    with the resources the traces were recorded with. Only the tasks that completed are fitted, and the tasks
+    killed for their resources raise the memory of their process.
+
+    :param traces: Paths to the traces, e.g. pipeline_info/execution_trace_*.txt
+    :type traces: list
+    :param input_scale: Factor of the largest input traced to size the memory and time for, e.g. 2 for a run
+        with files twice as large
+    :type input_scale: float
+    """
+    # Configured when the command runs rather than on import
+    logging.basicConfig(format="%(asctime)s [%(funcName)s] - %(message)s", level=logging.INFO)
+    tasks = read_traces(Path(t) for t in traces)
+    by_process: Dict[str, List[Task]] = {}
+    for task in tasks:
+        by_process.setdefault(task.process, []).append(task)
+    recommendations = []
+    for process in sorted(by_process):
+        recommendation = recommend(process, by_process[process], input_scale)
+        if recommendation is None:
+            logger.warning(f"No completed task of {process} with its peak_rss, realtime and rchar, left out")
+        else:
+            recommendations.append(recommendation)
+    if not recommendations:
+        raise ValueError("No completed task with its peak_rss, realtime and rchar in the traces")
+
+    write_config(Path(out), recommendations, len(traces))
+    rows = report_rows(recommendations)
+    with open(report, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]), delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    total = rows[-1]
+    logger.info(
+        f"{len(recommendations)} processes from {total['tasks']} tasks: CPU hours {total['cpu_hours'] or 'n/a'}"
+        f" -> {total['recommended_cpu_hours']}, memory GB hours {total['memory_gb_hours'] or 'n/a'}"
+        f" -> {total['recommended_memory_gb_hours']}, retry rate {total['retry_rate']}"
+        f" -> {total['recommended_retry_rate']}"
+    )
+    logger.info(f"Config written to {out}, report to {report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+This module resolves modification names and accessions to their Unimod records. The records are read once from
+the Unimod database shipped with sdrf-pipelines and cached as JSON, keyed by the version of the database, so
+later runs load them in milliseconds instead of parsing the XML again. The index of the database of the
+sdrf-pipelines containers of the pipeline is shipped in bin/unimod_index, as the cache of a task container does not
+outlive it.
+License: Apache 2.0
+"""
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Directory of the cached index, ~/.cache/quantms unless set
+UNIMOD_CACHE_ENV = "QUANTMS_CACHE_DIR"
+# Prebuilt indexes shipped with the pipeline, read before the cache
+UNIMOD_INDEX_DIR = Path(__file__).resolve().parent / "unimod_index"
+# A modification as written in the parameters, e.g. "Carbamidomethyl (C)" or "Acetyl (Protein N-term)"
+MODIFICATION_PATTERN = re.compile(r"^(.*?)(?: \((.*?)\))?$")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UnimodModification:
+    """A Unimod record.
+
+    :param name: Title of the modification, e.g. "Carbamidomethyl"
+    :type name: str
+    :param accession: Accession of the modification, e.g. "UNIMOD:4"
+    :type accession: str
+    :param delta_mono_mass: Monoisotopic mass shift, as written in the database
+    :type delta_mono_mass: str
+    :param sites: Specificities of the modification, as (site, position) pairs
+    :type sites: tuple
+    """
+
+    name: str
+    accession: str
+    delta_mono_mass: str
+    sites: Tuple[Tuple[str, str], ...]
+
+
+class UnimodResolver:
+    """Index of the Unimod records by name and by accession.
+
+    When several records share a name, the first one of the database is kept, as a linear search would find.
+    """
+
+    def __init__(self, modifications: List[UnimodModification], version: str):
+        self.version = version
+        self.modifications = modifications
+        self._by_name: Dict[str, UnimodModification] = {}
+        self._by_accession: Dict[str, UnimodModification] = {}
+        for modification in modifications:
+            self._by_name.setdefault(modification.name, modification)
+            self._by_accession.setdefault(modification.accession.upper(), modification)
+
+    def resolve(self, name_or_accession: str) -> Optional[UnimodModification]:
+        """The record of a modification name, e.g. "Oxidation", or accession, e.g. "UNIMOD:35"."""
+        if name_or_accession.upper().startswith("UNIMOD:"):
+            return self._by_accession.get(name_or_accession.upper())
+        return self._by_name.get(name_or_accession)
+
+    @classmethod
+    def load(cls, cache_dir: Optional[os.PathLike] = None) -> "UnimodResolver":
+        """Loads the index shipped with the pipeline for the version of the database, or from the cache, building and
+        caching it first if the cache is missing or stale.
+
+        :param cache_dir: Directory of the cache, ``$QUANTMS_CACHE_DIR`` or ~/.cache/quantms by default
+        :type cache_dir: str
+        """
+        unimod_xml = unimod_database_file()
+        version = hashlib.sha1(unimod_xml.read_bytes()).hexdigest()[:16]
+        if cache_dir is None:
+            cache_dir = os.environ.get(UNIMOD_CACHE_ENV) or Path.home() / ".cache" / "quantms"
+        cache = Path(cache_dir) / f"unimod_{version}.json"
+
+        for index in (UNIMOD_INDEX_DIR / cache.name, cache):
+            if index.exists():
+                try:
+                    with open(index) as f:
+                        records = json.load(f)["modifications"]
+                    return cls([UnimodModification(n, a, m, tuple(map(tuple, s))) for n, a, m, s in records], version)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Ignoring the unreadable Unimod index {index}: {e}")
+
+        resolver = cls(read_unimod_database(), version)
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            # Written aside and moved in place, so concurrent tasks never read a partial cache
+            with tempfile.NamedTemporaryFile("w", dir=cache.parent, suffix=".tmp", delete=False) as f:
+                json.dump(
+                    {
+                        "version": version,
+                        "modifications": [
+                            [m.name, m.accession, m.delta_mono_mass, m.sites] for m in resolver.modifications
+                        ],
+                    },
+                    f,
+                    separators=(",", ":"),
+                )
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, cache)
+            logger.info(f"Unimod index cached in {cache}")
+        except OSError as e:
+            logger.warning(f"Could not cache the Unimod index in {cache.parent}: {e}")
+        return resolver
+
+
+def unimod_database_file() -> Path:
+    """Path to the Unimod database of sdrf-pipelines, found without importing the package."""
+    spec = importlib.util.find_spec("sdrf_pipelines")
+    if spec is None or spec.origin is None:
+        raise ModuleNotFoundError("sdrf-pipelines is needed for its Unimod database")
+    return Path(spec.origin).parent / "openms" / "unimod.xml"
+
+
+def read_unimod_database() -> List[UnimodModification]:
+    """Reads every record of the Unimod database of sdrf-pipelines, in the order of the database."""
+    from sdrf_pipelines.openms.unimod import UnimodDatabase
+
+    return [
+        UnimodModification(
+            m.get_name(),
+            m.get_accession(),
+            m._delta_mono_mass,
+            tuple((site._site, site._position) for site in m._site),
+        )
+        for m in UnimodDatabase().modifications
+    ]
+
+
+def split_modification(modification: str) -> Tuple[str, Optional[str]]:
+    """Splits a modification such as "Oxidation (M)" into its name and its site, None if it has none."""
+    name, site = MODIFICATION_PATTERN.match(modification.strip()).groups()
+    return name, site
@@ -56,6 +56,42 @@ generated_parameters = {
         section_title=None,
         description='Proteomics data acquisition method',
     ),
+    'ontology_store': NextflowParameter(
+        type=typing.Optional[str],
+        default=None,
+        section_title=None,
+        description='Ontology store to validate the SDRF against instead of the Ontology Lookup Service',
+    ),
+    'sdrf_cache_dir': NextflowParameter(
+        type=typing.Optional[str],
+        default=None,
+        section_title=None,
+        description='Directory keeping the SDRF validation results between runs',
+    ),
+    'spectra_preflight': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Check that every spectra file exists and is complete before processing them',
+    ),
+    'eager_cleanup': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Delete the intermediate files of the work directory once every process reading them is done',
+    ),
+    'task_cache': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Resume the tasks of the last execution of the same SDRF/design and database from a cache kept on Latch Data, not with eager_cleanup',
+    ),
+    'prefetch_spectra': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Download the spectra files to the shared volume in parallel before the run, instead of staging them task by task',
+    ),
     'database': NextflowParameter(
         type=LatchFile,
         default=None,
@@ -632,6 +668,18 @@ generated_parameters = {
         section_title=None,
         description='Enable cross-run normalization between runs by diann.',
     ),
+    'diannconvert_shards': NextflowParameter(
+        type=typing.Optional[int],
+        default=1,
+        section_title=None,
+        description='Number of shards of runs the conversion of the DIA-NN results is split in',
+    ),
+    'diannconvert_table_format': NextflowParameter(
+        type=typing.Optional[str],
+        default='text',
+        section_title=None,
+        description='Format of the MSstats and Triqler tables of the conversion of the DIA-NN results',
+    ),
     'skip_post_msstats': NextflowParameter(
         type=typing.Optional[bool],
         default=None,
@@ -4,6 +4,8 @@
 
 import nextflow.Nextflow
 import groovy.text.SimpleTemplateEngine
+import java.nio.file.Files
+import java.nio.file.Path
 
 class WorkflowQuantms {
 
@@ -14,6 +16,12 @@ class WorkflowQuantms {
         if (!params.database) {
             Nextflow.error "database file not specified with e.g. '--database *.fasta' or via a detectable config file."
         }
+        if (params.diannconvert_table_format in ['zstd', 'parquet'] && !params.skip_post_msstats) {
+            Nextflow.error "MSstats can not read '${params.diannconvert_table_format}' tables, use '--diannconvert_table_format text' or 'gzip', or '--skip_post_msstats'."
+        }
+        if (params.diannconvert_table_format != 'text' && params.enable_pmultiqc) {
+            Nextflow.error "pmultiqc can only read 'text' tables, use '--diannconvert_table_format text' or '--enable_pmultiqc false'."
+        }
     }
 
     //
@@ -115,4 +123,30 @@ class WorkflowQuantms {
     public static boolean hasExtension(file, extension) {
         return file.toString().toLowerCase().endsWith(extension.toLowerCase())
     }
+
+    //
+    // Delete intermediate files once every process reading them is done, with --eager_cleanup
+    //
+    public static void deleteIntermediates(workflow, log, files) {
+        def work_dir = workflow.workDir.toAbsolutePath().normalize()
+        for (item in isCollectionOrArray(files) ? files : [files]) {
+            def path = (item instanceof Path ? item : Nextflow.file(item)).toAbsolutePath().normalize()
+            // Only the outputs of the tasks are deleted, in <workDir>/<xx>/<hash>/, never the inputs of the run
+            // nor the files Nextflow staged from remote storage
+            if (!path.startsWith(work_dir) || work_dir.relativize(path).getNameCount() < 3
+                    || !(work_dir.relativize(path).getName(0).toString() ==~ /[0-9a-f]{2}/)) {
+                continue
+            }
+            try {
+                if (Files.isSymbolicLink(path) || !Files.isDirectory(path)) {
+                    Files.deleteIfExists(path)
+                } else {
+                    path.deleteDir()
+                }
+                log.debug "Eager cleanup: deleted ${path}"
+            } catch (Exception e) {
+                log.warn "Eager cleanup: could not delete ${path}: ${e.message}"
+            }
+        }
+    }
 }
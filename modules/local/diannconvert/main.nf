@@ -20,9 +20,12 @@ process DIANNCONVERT {
     path("version/versions.yml")
 
     output:
-    path "*msstats_in.csv", emit: out_msstats
-    path "*triqler_in.tsv", emit: out_triqler
+    path "*msstats_in.*", emit: out_msstats
+    path "*triqler_in.*", emit: out_triqler
     path "*.mzTab", emit: out_mztab
+    path "*.mzTab.index.json", emit: out_mztab_index
+    path "*_metrics.json", emit: metrics
+    path "*_profiles", emit: profiles, optional: true
     path "*.log", emit: log
     path "versions.yml", emit: version
 
@@ -43,6 +46,8 @@ process DIANNCONVERT {
         --charge $params.max_precursor_charge \\
         --missed_cleavages $params.allowed_missed_cleavages \\
         --qvalue_threshold $params.protein_level_fdr_cutoff \\
+        --table_format $params.diannconvert_table_format \\
+        $args \\
         2>&1 | tee convert_report.log
 
     cat <<-END_VERSIONS > versions.yml
@@ -0,0 +1,54 @@
+process DIANNCONVERT_MERGE {
+    tag "$meta.experiment_id"
+    label 'process_low'
+
+    conda "conda-forge::pandas_schema conda-forge::lzstring bioconda::pmultiqc=0.0.21"
+    if (workflow.containerEngine == 'singularity' && !params.singularity_pull_docker_container) {
+        container "https://depot.galaxyproject.org/singularity/pmultiqc:0.0.22--pyhdfd78af_0"
+    } else {
+        container "biocontainers/pmultiqc:0.0.22--pyhdfd78af_0"
+    }
+
+    input:
+    path(shards, stageAs: "shards/*")
+    path(exp_design)
+    path(report_pg)
+    path(report_pr)
+    val(meta)
+    path(fasta)
+    path("version/versions.yml")
+
+    output:
+    path "*msstats_in.*", emit: out_msstats
+    path "*triqler_in.*", emit: out_triqler
+    path "*.mzTab", emit: out_mztab
+    path "*.mzTab.index.json", emit: out_mztab_index
+    path "*_metrics.json", emit: metrics
+    path "*_profiles", emit: profiles, optional: true
+    path "*.log", emit: log
+    path "versions.yml", emit: version
+
+    script:
+    def args = task.ext.args ?: ''
+    def dia_params = [meta.fragmentmasstolerance,meta.fragmentmasstoleranceunit,meta.precursormasstolerance,
+                        meta.precursormasstoleranceunit,meta.enzyme,meta.fixedmodifications,meta.variablemodifications].join(';')
+
+    """
+    diann_convert.py merge \\
+        --folder ./ \\
+        --exp_design ${exp_design} \\
+        --diann_version ./version/versions.yml \\
+        --dia_params "${dia_params}" \\
+        --charge $params.max_precursor_charge \\
+        --missed_cleavages $params.allowed_missed_cleavages \\
+        --shards_folder ./shards \\
+        --table_format $params.diannconvert_table_format \\
+        $args \\
+        2>&1 | tee convert_report.log
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        pyopenms: \$(pip show pyopenms | grep "Version" | awk -F ': ' '{print \$2}')
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,43 @@
+process DIANNCONVERT_SHARD {
+    tag "$meta.experiment_id shard $shard_index"
+    label 'process_low'
+
+    conda "conda-forge::pandas_schema conda-forge::lzstring bioconda::pmultiqc=0.0.21"
+    if (workflow.containerEngine == 'singularity' && !params.singularity_pull_docker_container) {
+        container "https://depot.galaxyproject.org/singularity/pmultiqc:0.0.22--pyhdfd78af_0"
+    } else {
+        container "biocontainers/pmultiqc:0.0.22--pyhdfd78af_0"
+    }
+
+    input:
+    tuple val(shard_index), path(report), path(exp_design)
+    path(ms_information)
+    val(meta)
+    path(fasta)
+    path("version/versions.yml")
+
+    output:
+    path "*_shard_*", emit: shard
+    path "*.log", emit: log
+    path "versions.yml", emit: version
+
+    script:
+    def args = task.ext.args ?: ''
+
+    """
+    diann_convert.py shard \\
+        --folder ./ \\
+        --exp_design ${exp_design} \\
+        --diann_version ./version/versions.yml \\
+        --qvalue_threshold $params.protein_level_fdr_cutoff \\
+        --shard_index ${shard_index} \\
+        --num_shards $params.diannconvert_shards \\
+        $args \\
+        2>&1 | tee convert_shard_${shard_index}.log
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        pyopenms: \$(pip show pyopenms | grep "Version" | awk -F ': ' '{print \$2}')
+    END_VERSIONS
+    """
+}
@@ -13,10 +13,15 @@ process SAMPLESHEET_CHECK {
     input:
     path input_file
     val is_sdrf
+    path ontology_store
+    path sdrf_cache, stageAs: 'sdrf_cache_in'
+    val root_folder
 
     output:
     path "*.log", emit: log
     path "${input_file}", emit: checked_file
+    path "spectra_manifest.tsv", optional: true, emit: manifest
+    path "sdrf_cache/*.json", optional: true, emit: sdrf_cache
     path "versions.yml", emit: versions
 
     when:
@@ -25,9 +30,24 @@ process SAMPLESHEET_CHECK {
     script: // This script is bundled with the pipeline, in nf-core/quantms/bin/
     // TODO validate experimental design file
     def args = task.ext.args ?: ''
+    def store = ontology_store ? "--ONTOLOGY_STORE ${ontology_store}" : ''
+    // The validation cache of the previous runs is copied, so the task writes its own and leaves the input unchanged
+    def cache = params.sdrf_cache_dir ? '--CACHE_DIR sdrf_cache' : ''
+    def preflight = params.spectra_preflight ? '--PREFLIGHT' : ''
+    if (params.spectra_preflight && root_folder) {
+        preflight += " --ROOT_FOLDER '${root_folder}'" + (params.local_input_type ? " --LOCAL_INPUT_TYPE ${params.local_input_type}" : '')
+    }
+    // The host paths of the local spectra files are not mounted in the container, so only the remote ones are checked
+    if (params.spectra_preflight && workflow.containerEngine) {
+        preflight += ' --REMOTE_ONLY'
+    }
 
     """
-    check_samplesheet.py "${input_file}" ${is_sdrf} --CHECK_MS 2>&1 | tee input_check.log
+    mkdir -p sdrf_cache
+    if [ -d sdrf_cache_in ]; then
+        cp -L sdrf_cache_in/*.json sdrf_cache/ 2>/dev/null || true
+    fi
+    check_samplesheet.py "${input_file}" ${is_sdrf} --CHECK_MS ${store} ${cache} ${preflight} 2>&1 | tee input_check.log
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
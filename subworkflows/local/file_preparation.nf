@@ -80,6 +80,23 @@ workflow FILE_PREPARATION {
         ch_results = indexed_mzml_bundle.mix(ch_branched_input.dotd)
     }
 
+    if (params.eager_cleanup) {
+        // A decompressed file converted to mzML or re-indexed is only read by its conversion
+        ch_converted = THERMORAWFILEPARSER.out.mzmls_converted
+        if (params.reindex_mzml) {
+            ch_converted = ch_converted.mix(MZMLINDEXING.out.mzmls_indexed)
+        }
+        if (params.convert_dotd) {
+            ch_converted = ch_converted.mix(TDF2MZML.out.mzmls_converted)
+        }
+        DECOMPRESS.out.decompressed_files
+            .map { meta, decompressed -> [meta.mzml_id, decompressed] }
+            .join(ch_converted.map { meta, converted -> [meta.mzml_id, converted] })
+            .subscribe { mzml_id, decompressed, converted ->
+                WorkflowQuantms.deleteIntermediates(workflow, log, decompressed)
+            }
+    }
+
     MZMLSTATISTICS(ch_results)
     ch_statistics = ch_statistics.mix(MZMLSTATISTICS.out.ms_statistics.collect())
     ch_versions = ch_versions.mix(MZMLSTATISTICS.out.version)
@@ -18,7 +18,14 @@ workflow INPUT_CHECK {
             exit 1
         }
     }
-    SAMPLESHEET_CHECK ( input_file, is_sdrf )
+    ontology_store = params.ontology_store ? file(params.ontology_store, checkIfExists: true) : []
+    // Missing before the first run, which creates it
+    sdrf_cache = params.sdrf_cache_dir && file(params.sdrf_cache_dir).exists() ? file(params.sdrf_cache_dir) : []
+    // Given as is, not staged, so the pre-flight check writes the original paths to the manifest and does not
+    // download a remote folder, whose files it checks from their metadata. In a container, which does not mount
+    // the local folder, only the remote files are checked
+    root_folder = params.spectra_preflight && params.root_folder ? params.root_folder.toString() : ''
+    SAMPLESHEET_CHECK ( input_file, is_sdrf, ontology_store, sdrf_cache, root_folder )
 
     emit:
     ch_input_file   = SAMPLESHEET_CHECK.out.checked_file
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# The Latch workflow is imported as the wf package, the scripts of bin/ and benchmarks/ as top-level modules, as
+# they are run
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "bin"), str(ROOT / "benchmarks")]
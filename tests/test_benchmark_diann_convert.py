@@ -0,0 +1,29 @@
+import json
+
+from benchmark_diann_convert import cli
+from click.testing import CliRunner
+
+
+def test_run_and_compare(tmp_path):
+    results = tmp_path / "results.json"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["run", "--scales", "2x200", "--repeats", "1", "--workdir", str(tmp_path / "work"), "--out", str(results)]
+    )
+    assert result.exit_code == 0, result.output
+
+    (scale,) = json.loads(results.read_text())["scales"]
+    assert scale["scale"] == "2x200"
+    assert {"read report", "MSstats", "Triqler", "PSH", "write", "total"} <= set(scale["median"])
+    assert scale["median"]["total"]["peak_rss_mb"] > 0
+    # The experiment is generated once, and reused by the next runs
+    assert sorted(p.name for p in (tmp_path / "work").iterdir()) == ["out", "synthetic_2x200_0"]
+
+    assert runner.invoke(cli, ["compare", str(results), str(results)]).exit_code == 0
+    slower = json.loads(results.read_text())
+    for metrics in slower["scales"][0]["median"].values():
+        metrics["wall_time_s"] = metrics["wall_time_s"] * 2 + 1
+    (tmp_path / "slower.json").write_text(json.dumps(slower))
+    result = runner.invoke(cli, ["compare", str(results), str(tmp_path / "slower.json")])
+    assert result.exit_code == 1
+    assert "regressions above 1.1x" in result.output
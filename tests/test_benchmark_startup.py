@@ -0,0 +1,43 @@
+import json
+from benchmark_startup import BIN_DIR, HEAVY_MODULES, import_times, startup
+from click.testing import CliRunner
+
+
+def test_scripts_start_fast(tmp_path):
+    out = tmp_path / "startup.json"
+
+    result = CliRunner().invoke(startup, ["--repeats", "1", "--out", str(out)])
+
+    assert result.exit_code == 0, result.output
+    scripts = json.loads(out.read_text())["scripts"]
+    assert set(scripts) == {p.name for p in BIN_DIR.glob("*.py")}
+    assert not any(s["heavy_modules"] for s in scripts.values())
+
+
+def test_heavy_import_fails(tmp_path):
+    script = tmp_path / "heavy.py"
+    script.write_text("import pandas\n")
+
+    result = CliRunner().invoke(startup, ["--scripts", str(script), "--repeats", "1"])
+
+    assert result.exit_code == 1
+    assert "heavy.py imports numpy, pandas" in result.output
+
+
+def test_diann_convert_help_loads_no_heavy_module():
+    # numpy and pandas are bound lazily, so are only loaded, and reported by -X importtime, once used
+    for command in (["--help"], ["convert", "--help"]):
+        code = (
+            f"import runpy, sys; sys.path.insert(0, {str(BIN_DIR)!r}); sys.argv = ['diann_convert.py', *{command!r}]\n"
+            "try:\n"
+            f"    runpy.run_path({str(BIN_DIR / 'diann_convert.py')!r}, run_name='__main__')\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            # The logging is configured by the group, when a command runs, so not for the help of the script
+            "import logging; assert sys.argv[1] != '--help' or not logging.root.handlers, 'logging configured'\n"
+        )
+
+        modules = {m["module"].split(".")[0] for m in import_times(code)}
+
+        assert "click" in modules
+        assert not modules & set(HEAVY_MODULES)
@@ -0,0 +1,61 @@
+import csv
+import hashlib
+
+import pytest
+
+from check_samplesheet import check_spectra_files
+
+MZML = b'<?xml version="1.0"?>\n<indexedmzML>\n<mzML>\n</mzML>\n</indexedmzML>\n'
+
+
+def write_sdrf(path, names):
+    path.write_text(
+        "source name\tcomment[data file]\tcomment[file uri]\n"
+        + "".join(f"{i}\t{name}\thttps://example.org/{name}\n" for i, name in enumerate(names))
+    )
+
+
+def read_manifest(path):
+    with open(path, newline="") as f:
+        return {row["run"]: row for row in csv.DictReader(f, delimiter="\t")}
+
+
+def test_check_local_spectra_files(tmp_path, capsys):
+    root = tmp_path / "spectra"
+    root.mkdir()
+    (root / "good.mzML").write_bytes(MZML)
+    (root / "truncated.mzML").write_bytes(MZML[:-30])
+    sdrf = tmp_path / "design.sdrf.tsv"
+    write_sdrf(sdrf, ["good.mzML", "truncated.mzML", "missing.mzML"])
+    checksums = tmp_path / "checksums.md5"
+    checksums.write_text(f"{hashlib.md5(MZML).hexdigest()}  good.mzML\n")
+    manifest = tmp_path / "spectra_manifest.tsv"
+
+    with pytest.raises(SystemExit):
+        check_spectra_files(str(sdrf), True, str(root), None, str(checksums), 2, str(manifest))
+
+    rows = read_manifest(manifest)
+    assert rows["good"]["path"] == f"{root}/good.mzML"
+    assert rows["good"]["size_bytes"] == str(len(MZML))
+    assert rows["good"]["checksum"] == hashlib.md5(MZML).hexdigest()
+    assert rows["good"]["status"] == "ok"
+    assert rows["truncated"]["status"] == "truncated mzML file, its closing tag is missing"
+    assert rows["missing"]["status"] == "missing"
+    out = capsys.readouterr().out
+    assert "3 spectra files checked" in out and "2 with errors" in out
+
+
+def test_check_remote_spectra_files_only(tmp_path, capsys):
+    # The host folder of a pipeline run in a container, which does not mount it
+    sdrf = tmp_path / "design.sdrf.tsv"
+    write_sdrf(sdrf, ["a.mzML", "b.raw"])
+    manifest = tmp_path / "spectra_manifest.tsv"
+
+    check_spectra_files(str(sdrf), True, str(tmp_path / "unmounted"), "mzML", None, 2, str(manifest), True)
+
+    rows = read_manifest(manifest)
+    assert [(row["path"], row["format"], row["status"]) for row in rows.values()] == [
+        (f"{tmp_path}/unmounted/a.mzML", "mzML", "local"),
+        (f"{tmp_path}/unmounted/b.mzML", "mzML", "local"),
+    ]
+    assert "0 spectra files checked" in capsys.readouterr().out
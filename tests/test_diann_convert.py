@@ -0,0 +1,236 @@
+import math
+import os
+
+import diann_convert
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+from synthetic_diann import SyntheticExperiment
+
+DIA_PARAMS = "20;ppm;10;ppm;Trypsin;Carbamidomethyl (C);Oxidation (M)"
+
+
+def test_concat_parquet_promotes_types(tmp_path, monkeypatch):
+    # One row per chunk, so the missing intensity and the numeric run come in later chunks than the first
+    monkeypatch.setattr(diann_convert, "REPORT_CHUNKSIZE", 1)
+    (tmp_path / "a.tsv").write_text("Protein\tIntensity\tRun\nP1\t1\tr1\nP2\t2\tr1\n")
+    (tmp_path / "b.tsv").write_text("Protein\tIntensity\tRun\nP3\t\tr2\nP4\t4\t7\n")
+    path = diann_convert.concat_tables([tmp_path / "a.tsv", tmp_path / "b.tsv"], tmp_path / "out.tsv", "parquet")
+    table = pd.read_parquet(path)
+    assert table["Intensity"].dtype == "float64"
+    assert table["Intensity"].isna().tolist() == [False, False, True, False]
+    assert table["Run"].tolist() == ["r1", "r1", "r2", "7"]
+
+
+def test_table_writer_without_affinity(tmp_path, monkeypatch):
+    # macOS has no sched_getaffinity
+    monkeypatch.delattr(diann_convert.os, "sched_getaffinity", raising=False)
+    with diann_convert.TableWriter(tmp_path / "out.tsv", sep="\t", table_format="gzip") as writer:
+        writer.write_frame(pd.DataFrame({"Protein": ["P1"], "Intensity": [1]}))
+    assert pd.read_csv(tmp_path / "out.tsv", sep="\t", compression="gzip")["Intensity"].tolist() == [1]
+
+
+@pytest.mark.parametrize("table_format", list(diann_convert.TABLE_FORMATS))
+def test_table_writer_formats(tmp_path, monkeypatch, table_format):
+    # Blocks of a few bytes, so the gzip table is made of many members compressed concurrently
+    monkeypatch.setattr(diann_convert, "GZIP_BLOCKSIZE", 16)
+    if table_format == "zstd":
+        pytest.importorskip("zstandard")
+    frames = [
+        pd.DataFrame({"Protein": ["P1", "P2"], "Run": ["r1", "r1"], "Intensity": [1.5, 2.0]}),
+        pd.DataFrame({"Protein": ["P3"], "Run": ["r2"], "Intensity": [3.25]}),
+    ]
+    path = tmp_path / f"out.tsv{diann_convert.TABLE_FORMATS[table_format]}"
+    with diann_convert.TableWriter(path, sep="\t", table_format=table_format, threads=2) as writer:
+        for frame in frames:
+            writer.write_frame(frame)
+
+    table = pd.read_parquet(path) if table_format == "parquet" else pd.read_csv(path, sep="\t")
+    pd.testing.assert_frame_equal(table, pd.concat(frames, ignore_index=True))
+
+
+def report_rows(rows):
+    """A report merged with its ms_run and study_variable, from (run, modified sequence, protein, Q.Value) rows."""
+    return pd.DataFrame(
+        [
+            {
+                "Precursor.Id": f"{sequence}2",
+                "ms_run": f"ms_run[{run}]",
+                "study_variable": run,
+                "Q.Value": qvalue,
+                "Global.Q.Value": qvalue,
+                "Lib.Q.Value": qvalue,
+                "RT.Start": 10.0,
+                "Calculate.Precursor.Mz": 500.25,
+                "Precursor.Normalised": 1.0e6,
+                "Protein.Ids": protein,
+                "PG.MaxLFQ": 2.0e6,
+                "Modified.Sequence": sequence,
+                "Stripped.Sequence": sequence.replace("(UniMod:4)", "").replace("(UniMod:35)", ""),
+                "Global.PG.Q.Value": 0.001,
+            }
+            for run, sequence, protein, qvalue in rows
+        ]
+    )
+
+
+def test_best_protein_precursor_ties(tmp_path):
+    # Every precursor of P1 shares its Global.PG.Q.Value: the one with the best Q.Value is kept, not the first in
+    # lexicographic order, and the sharded aggregates pick the same one as the full ones
+    rows = [
+        (1, "AC(UniMod:4)DEFGHIK", "P1", 0.01),
+        (1, "PEPTIDEC(UniMod:4)K", "P1", 0.002),
+        (2, "AM(UniMod:35)PEPTIDEK", "P1", 0.02),
+        (2, "PEPTIDEC(UniMod:4)K", "P1", 0.003),
+        (2, "LLLK", "P2", 0.01),
+    ]
+    report = report_rows(rows)
+    full = diann_convert.ReportAggregates.from_report(report)
+    best = full.protein_best.set_index("Protein.Ids")["Modified.Sequence"].to_dict()
+    assert best == {"P1": "PEPTIDEC(UniMod:4)K", "P2": "LLLK"}
+
+    parts = [
+        diann_convert.ReportAggregates.from_report(report[report["ms_run"] == r]) for r in ("ms_run[2]", "ms_run[1]")
+    ]
+    combined = diann_convert.ReportAggregates.combine(parts)
+    assert combined.protein_best.set_index("Protein.Ids")["Modified.Sequence"].to_dict() == best
+
+
+def test_combined_moments_of_equal_values():
+    # The means of the parts are rounded, which without clamping leaves a tiny variance
+    df = pd.DataFrame({"k": ["a"] * 7 + ["b"] * 2, "x": [3.3] * 7 + [1.0, 3.0]})
+    parts = pd.concat(
+        [diann_convert.group_moments(df.iloc[i : i + 3], ["k"], ["x"]) for i in range(0, len(df), 3)],
+        ignore_index=True,
+    )
+    combined = diann_convert.finalize_moments(diann_convert.combine_moments(parts, ["k"], ["x"]), ["x"])
+    assert combined["x::std"].tolist() == [0.0, df[df["k"] == "b"]["x"].std()]
+
+
+def test_fasta_index_cache(tmp_path):
+    fasta = tmp_path / "db.fasta"
+    fasta.write_text(">sp|P1|A_HUMAN\nPEPT\nIDE\n>sp|P2|B_HUMAN\nLLLK\n")
+    with diann_convert.FastaIndex(fasta) as index:
+        assert index.sequence(index.find_accession("P1")) == "PEPTIDE"
+    # Not a samtools index, which would not handle the uneven lines of P1
+    assert not (tmp_path / "db.fasta.fai").exists()
+    assert (tmp_path / "db.fasta.quantms.idx").exists()
+
+    # A new version of the database keeping the modification time of the old one is indexed again
+    mtime = fasta.stat().st_mtime
+    fasta.write_text(">sp|P1|A_HUMAN\nPEPTIDEK\n>sp|P2|B_HUMAN\nLLLK\n")
+    os.utime(fasta, (mtime, mtime))
+    with diann_convert.FastaIndex(fasta) as index:
+        assert index.sequence("sp|P1|A_HUMAN") == "PEPTIDEK"
+        assert index.sequence("sp|P2|B_HUMAN") == "LLLK"
+
+
+def test_peptide_locations_with_unresolved_protein(tmp_path):
+    fasta = tmp_path / "db.fasta"
+    fasta.write_text(">sp|P1|A_HUMAN\nMPEPTLDEK\n>sp|P2|B_HUMAN\nPEPTIDE\n")
+    peptides = pd.DataFrame({"sequence": ["PEPTIDE"] * 3, "accession": ["P1;P2", "P1;P3", "P3"]})
+    with diann_convert.FastaIndex(fasta) as index:
+        located = diann_convert.peptide_locations(peptides, index)
+    assert located[["pre", "post", "start", "end"]].values.tolist() == [
+        ["M;-", "K;-", "2;1", "8;7"],
+        ["null", "null", "null", "null"],
+        ["null", "null", "null", "null"],
+    ]
+
+
+@pytest.fixture
+def experiment(tmp_path):
+    """A small synthetic DIA-NN experiment, where every protein group has the same PG.MaxLFQ in all runs."""
+    folder = tmp_path / "experiment"
+    SyntheticExperiment(runs=4, precursors=200, protein_group_size=2).generate(folder)
+    report = pd.read_csv(folder / "diann_report.tsv", sep="\t")
+    # Not a binary fraction, so the means of the groups are rounded
+    report["PG.MaxLFQ"] = report["Protein.Group"].str[1:7].astype(int) * 1000.1 + 0.3
+    report.to_csv(folder / "diann_report.tsv", sep="\t", index=False)
+    return folder
+
+
+def run_commands(folder, out, *commands):
+    """Runs diann_convert.py commands on an experiment in ``out``, returning the PRT rows of the mzTab written."""
+    out.mkdir()
+    inputs = ["-f", folder, "-d", folder / "synthetic_design.tsv", "-v", folder / "version" / "versions.yml"]
+    cwd = os.getcwd()
+    os.chdir(out)
+    try:
+        for command in commands:
+            args = [str(a) for a in command[:1] + inputs + command[1:]]
+            result = CliRunner().invoke(diann_convert.cli, args, catch_exceptions=False)
+            assert result.exit_code == 0, result.output
+    finally:
+        os.chdir(cwd)
+    return sorted(line for line in (out / "synthetic_design_out.mzTab").read_text().splitlines() if line[:3] == "PRT")
+
+
+def same_cells(expected, actual):
+    """Whether two rows have the same cells, numbers within a relative tolerance of the order of the summations."""
+    if expected == actual:
+        return True
+    try:
+        return math.isclose(float(expected), float(actual), rel_tol=1e-12)
+    except ValueError:
+        return False
+
+
+def test_sharded_conversion_of_equal_values(experiment, tmp_path):
+    # Without clamping, the standard deviations of these groups are tiny and differ between the conversions
+    conversion = ["-p", DIA_PARAMS, "-c", "4", "-m", "1"]
+    full = run_commands(experiment, tmp_path / "full", ["convert", *conversion, "-q", "0.01"])
+    shards = [["shard", "-q", "0.01", "-i", i, "-n", 2] for i in range(2)]
+    merged = run_commands(experiment, tmp_path / "merged", *shards, ["merge", *conversion, "-s", tmp_path / "merged"])
+
+    header = (tmp_path / "full" / "synthetic_design_out.mzTab").read_text().split("\nPRH\t", 1)[1].split("\n", 1)[0]
+    columns = ["PRH", *header.split("\t")]
+    spread = [i for i, c in enumerate(columns) if c.startswith("protein_abundance_std")]
+    assert len(full) == len(merged) and spread
+    for expected, actual in zip(full, merged):
+        expected, actual = expected.split("\t"), actual.split("\t")
+        assert [expected[i] for i in spread] == [actual[i] for i in spread]
+        assert {expected[i] for i in spread} <= {"0.0", "null"}
+        assert all(same_cells(e, a) for e, a in zip(expected, actual)), (expected, actual)
+
+
+def test_incremental_self_check(experiment, tmp_path):
+    conversion = ["-p", DIA_PARAMS, "-c", "4", "-m", "1", "-q", "0.01", "-s", tmp_path / "state", "--self_check"]
+    first = run_commands(experiment, tmp_path / "first", ["incremental", *conversion])
+    # The second conversion reuses the state of every run
+    assert run_commands(experiment, tmp_path / "second", ["incremental", *conversion]) == first
+
+
+def test_spectra_ref_of_unmatched_precursors(tmp_path):
+    pd.DataFrame(
+        {
+            "SpectrumID": ["scan=1", "scan=2"],
+            "MSLevel": [2, 2],
+            "Retention_Time": [60.0, 600.0],
+            "Exp_Mass_To_Charge": [500.0, 500.0],
+            "Isolation_Window_Lower": [400.0, 400.0],
+            "Isolation_Window_Upper": [600.0, 600.0],
+        }
+    ).to_csv(tmp_path / "run_1_ms_info.tsv", sep="\t", index=False)
+    report = pd.DataFrame(
+        {
+            "Run": "run_1",
+            "ms_run": 1,
+            "RT.Start": [1.2, 5.0],
+            "Calculate.Precursor.Mz": [500.25, 500.25],
+            "Stripped.Sequence": ["PEPTIDEK", "LLLK"],
+            "Modified.Sequence": ["PEPTIDEK", "LLLK"],
+            "Protein.Ids": ["P1", "P2"],
+            "Precursor.Charge": 2,
+            "Q.Value": 0.001,
+            "PEP": 0.002,
+            "Global.Q.Value": 0.001,
+        }
+    )
+    # The precursor at 5 min is more than 0.5 min away from both spectra
+    psh = diann_convert.mztab_PSH(report, str(tmp_path), "db")
+    assert psh["spectra_ref"].tolist() == ["ms_run[1]:scan=1", "null"]
+    assert psh["exp_mass_to_charge"].tolist() == [500.0, "null"]
+    # Within 4 min of the first spectrum with a wider tolerance
+    psh = diann_convert.mztab_PSH(report, str(tmp_path), "db", rt_tolerance=4.0)
+    assert psh["spectra_ref"].tolist() == ["ms_run[1]:scan=1", "ms_run[1]:scan=1"]
@@ -0,0 +1,64 @@
+import json
+
+import pandas as pd
+from click.testing import CliRunner
+from equivalence_diann_convert import DIANN_CONVERT, diff_cells, diff_tables, equivalence
+
+
+def test_diff_cells():
+    expected = pd.Series(["1.0", "null", "", "PEPTIDE", "2.5", "100"])
+    actual = pd.Series(["1.0000000001", "NA", "nan", "PEPTIDF", "2.6", "100"])
+
+    divergence = diff_cells(expected, actual, rtol=1e-9, atol=0)
+
+    assert divergence["divergent_cells"] == 2
+    assert divergence["divergent_mask"].tolist() == [False, False, False, True, True, False]
+    assert divergence["max_abs_diff"] == 2.6 - 2.5
+    assert divergence["max_rel_diff"] == (2.6 - 2.5) / 2.5
+
+
+def test_diff_tables():
+    # The rows of the same key are matched in the order of their values, whatever the order of the rows
+    expected = pd.DataFrame(
+        {"run": ["a", "a", "b", "c"], "peptide": ["P", "P", "P", "P"], "intensity": ["1", "2", "3", "4"]}
+    )
+    actual = pd.DataFrame(
+        {"run": ["a", "b", "a", "d"], "peptide": ["P", "P", "P", "P"], "intensity": ["2", "3.5", "1", "4"]}
+    )
+
+    result = diff_tables(expected, actual, ["run", "peptide"], rtol=1e-9, atol=1e-12)
+
+    assert not result["equivalent"]
+    assert result["rows_only_in_reference"] == {"count": 1, "examples": [{"run": "c", "peptide": "P", "occurrence": 0}]}
+    assert result["rows_only_in_candidate"]["examples"] == [{"run": "d", "peptide": "P", "occurrence": 0}]
+    assert result["columns"]["intensity"]["divergent_cells"] == 1
+    assert result["columns"]["intensity"]["examples"] == [
+        {"key": {"run": "b", "peptide": "P", "occurrence": 0}, "reference": "3", "candidate": "3.5"}
+    ]
+    assert diff_tables(expected, expected.iloc[::-1], ["run", "peptide"], 1e-9, 1e-12)["equivalent"]
+    assert diff_tables(expected, expected.drop(columns="intensity"), ["run"], 1e-9, 1e-12)[
+        "columns_only_in_reference"
+    ] == ["intensity"]
+    assert diff_tables(expected, None, ["run"], 1e-9, 1e-12)["equivalent"] is False
+
+
+def test_equivalence_report(tmp_path):
+    runner = CliRunner()
+    common = ["--reference", str(DIANN_CONVERT), "--scales", "2x200", "--workdir", str(tmp_path / "work")]
+
+    result = runner.invoke(equivalence, [*common, "--out", str(tmp_path / "same.json")])
+    assert result.exit_code == 0, result.output
+    report = json.loads((tmp_path / "same.json").read_text())
+    assert report["equivalent"]
+    assert set(report["inputs"][0]["tables"]) == {"msstats", "triqler", "MTD", "PRT", "PEP", "PSM"}
+
+    # No spectrum is within the tolerance, so no PSM of the candidate has a spectrum
+    args = ["--candidate_args", "--spectrum_rt_tolerance 0.0", "--out", str(tmp_path / "diverging.json")]
+    result = runner.invoke(equivalence, [*common, *args])
+    assert result.exit_code == 1
+    tables = json.loads((tmp_path / "diverging.json").read_text())["inputs"][0]["tables"]
+    assert [table for table, diff in tables.items() if not diff["equivalent"]] == ["PSM"]
+    columns = tables["PSM"]["columns"]
+    assert set(columns) == {"spectra_ref", "opt_global_spectrum_reference", "exp_mass_to_charge"}
+    assert all(c["divergent_cells"] == tables["PSM"]["rows_reference"] for c in columns.values())
+    assert columns["spectra_ref"]["examples"][0]["candidate"] == "null"
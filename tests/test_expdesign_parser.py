@@ -0,0 +1,76 @@
+import pandas as pd
+from expdesign_parser import design_errors, read_expdesign
+
+DESIGN = (
+    "Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample\n"
+    "1\t1\t/data/a.mzML\t1\t1\n"
+    "2\t1\ts3://bucket/b.d.tar\t1\t2\n"
+    "\n"
+    "\n"
+    "Sample\tMSstats_Condition\tMSstats_BioReplicate\n"
+    "1\tcontrol\t1\n"
+    "2\ttreated\t1\n"
+)
+
+
+def test_read_expdesign(tmp_path):
+    path = tmp_path / "design.tsv"
+    path.write_text(DESIGN)
+
+    design = read_expdesign(path, validate=True)
+
+    assert design.errors == []
+    assert design.file_table["run"].tolist() == ["a", "b"]
+    assert design.file_table["Sample"].tolist() == [1, 2]
+    assert pd.api.types.is_integer_dtype(design.file_table["Fraction_Group"])
+    assert design.sample_table["MSstats_Condition"].tolist() == ["control", "treated"]
+
+
+def test_malformed_design(tmp_path):
+    path = tmp_path / "design.tsv"
+    path.write_text(
+        "Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample\n"
+        "1\t1\t/data/a.mzML\t1\t1\n"
+        "3\t1\t/data/b.mzML\t1\n"
+        "1\t1\t/data/c.mzML\t1\t1\n"
+        "3\t1\t/data/d.mzML\t1\t2\n"
+        "\n"
+        "Sample\tMSstats_BioReplicate\n"
+        "one\t1\n"
+    )
+
+    design = read_expdesign(path, validate=True)
+
+    # Every error is found in the same pass, the checks needing a typed column left out
+    assert design.errors == [
+        "Line 3: 4 fields instead of the 5 of the header",
+        "MSstats_Condition column missed in the sample table",
+        "Sample of the sample table has non-integer values",
+        "Fraction_Group discontinuous!",
+        "Existing duplicate entries in Fraction_Group, Fraction, Label and Sample",
+    ]
+    assert design.file_table["Spectra_Filepath"].tolist() == ["/data/a.mzML", "/data/c.mzML", "/data/d.mzML"]
+    assert design.sample_table["Sample"].tolist() == ["one"]
+
+
+def test_one_table_design(tmp_path):
+    path = tmp_path / "design.tsv"
+    path.write_text(DESIGN.split("\n\n")[0] + "\n")
+
+    design = read_expdesign(path, validate=True)
+
+    assert design.errors == ["the one-table format parser is broken in OpenMS2.5, please use one-table or sdrf"]
+    assert len(design.file_table) == 2 and design.sample_table.empty
+
+
+def test_design_errors_of_labelled_design():
+    file_table = pd.DataFrame(
+        {"Fraction_Group": [1, 1], "Fraction": ["1", "1"], "Spectra_Filepath": ["a.mzML"] * 2, "Label": ["1", "2"]}
+    )
+    file_table["Sample"] = [1, 1]
+    sample_table = pd.DataFrame({"Sample": [1, 1], "MSstats_Condition": ["c", "c"], "MSstats_BioReplicate": [1, 1]})
+
+    assert design_errors(file_table, sample_table) == [
+        "MSstats_Mixture column missed in ISO experiments",
+        "Existing duplicate Sample in sample table!",
+    ]
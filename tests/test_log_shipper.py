@@ -0,0 +1,56 @@
+from wf.log_shipper import LogShipper, local_store
+
+
+def shipped_log(store, name):
+    return b"".join(chunk.read_bytes() for chunk in sorted(store.glob(f"{name}.*")))
+
+
+def test_ship_appended_and_replaced(tmp_path):
+    store = tmp_path / "store"
+    log, trace = tmp_path / ".nextflow.log", tmp_path / "trace.txt"
+    shipper = LogShipper(local_store(store), appended={"nextflow.log": log}, replaced={"trace.txt": trace})
+
+    log.write_bytes(b"line 1\nline 2\npartial")
+    trace.write_text("task_id\tstatus\n1\tRUNNING\n")
+    shipper.ship()
+    # The line still being written waits for the next shipment
+    assert shipped_log(store, "nextflow.log") == b"line 1\nline 2\n"
+    assert (store / "trace.txt").read_text() == "task_id\tstatus\n1\tRUNNING\n"
+
+    with open(log, "ab") as f:
+        f.write(b" line 3\nline 4")
+    trace.write_text("task_id\tstatus\n1\tCOMPLETED\n")
+    shipper.stop()
+    assert shipped_log(store, "nextflow.log") == log.read_bytes()
+    assert sorted(p.name for p in store.glob("nextflow.log.*")) == ["nextflow.log.00001", "nextflow.log.00002"]
+    assert (store / "trace.txt").read_text() == "task_id\tstatus\n1\tCOMPLETED\n"
+
+
+def test_retry_failed_upload(tmp_path):
+    store = tmp_path / "store"
+    log = tmp_path / ".nextflow.log"
+    log.write_bytes(b"line 1\n")
+    upload, failures = local_store(store), []
+
+    def flaky(local, name):
+        if not failures:
+            failures.append(name)
+            raise ConnectionError("connection reset")
+        upload(local, name)
+
+    shipper = LogShipper(flaky, appended={"nextflow.log": log})
+    shipper.ship()
+    assert not store.exists()
+    shipper.ship()
+    assert shipped_log(store, "nextflow.log") == b"line 1\n"
+
+
+def test_rollover(tmp_path):
+    store = tmp_path / "store"
+    log = tmp_path / ".nextflow.log"
+    log.write_bytes(b"first run, a long line\n")
+    shipper = LogShipper(local_store(store), appended={"nextflow.log": log})
+    shipper.ship()
+    log.write_bytes(b"second run\n")
+    shipper.ship()
+    assert shipped_log(store, "nextflow.log") == b"first run, a long line\nsecond run\n"
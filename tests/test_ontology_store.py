@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from ontology_store import OntologyStore, cli, read_obo
+from sdrf_pipelines.sdrf.sdrf import SdrfDataFrame
+from sdrf_validator import validate_sdrf
+
+DUMP = Path(__file__).parent / "data" / "ncbitaxon_sample.obo"
+
+
+def build(out, *dumps):
+    result = CliRunner().invoke(cli, ["build", *(f"--obo={d}" for d in dumps), "--out", str(out)])
+    assert result.exit_code == 0, result.output
+
+
+def test_read_obo():
+    names, version = read_obo(DUMP)
+
+    assert names == {"Homo sapiens", "Mus musculus", "Saccharomyces cerevisiae S288C"}
+    assert version == "ncbitaxon/releases/2023-06-20/ncbitaxon.obo"
+
+
+def test_store_round_trip(tmp_path):
+    build(tmp_path / "ontologies.store", f"ncbitaxon={DUMP}")
+    build(tmp_path / "again.store", f"ncbitaxon={DUMP}")
+
+    assert (tmp_path / "ontologies.store").read_bytes() == (tmp_path / "again.store").read_bytes()
+    with OntologyStore(tmp_path / "ontologies.store") as store:
+        assert store.terms == 3
+        assert store.ontologies["ncbitaxon"]["source"] == DUMP.name
+        assert store.contains("NCBITaxon", "homo SAPIENS")
+        assert not store.contains("ncbitaxon", "obsolete organism")
+        assert not store.contains("ms", "homo sapiens")
+        assert store.search("Mus musculus", exact="true") == [{"label": "Mus musculus", "ontology_name": "ncbitaxon"}]
+        assert store.search("Mus", ontology="ncbitaxon") is None
+
+
+def test_validate_sdrf_with_store(tmp_path):
+    build(tmp_path / "ontologies.store", f"ncbitaxon={DUMP}")
+    build(tmp_path / "other.store", f"efo={DUMP}")
+    sdrf = tmp_path / "design.sdrf.tsv"
+    sdrf.write_text(
+        "source name\tcharacteristics[organism]\tcharacteristics[organism part]\tcharacteristics[disease]\t"
+        "characteristics[cell type]\tassay name\tcomment[data file]\n"
+        "s1\thomo sapiens\tliver\tnormal\thepatocyte\trun 1\trun1.raw\n"
+        "s2\tunicorn\tliver\tnormal\thepatocyte\trun 2\trun2.raw\n"
+    )
+    df = SdrfDataFrame.parse(str(sdrf))
+
+    with OntologyStore(tmp_path / "ontologies.store") as store:
+        errors = validate_sdrf(df, "default", tmp_path / "cache", store)
+    # The columns missing from this SDRF are reported too, without a cell
+    assert [(e.row, e.column) for e in errors if e.column] == [(1, "characteristics[organism]")]
+
+    with OntologyStore(tmp_path / "other.store") as store:
+        with pytest.raises(ValueError, match="has no terms of ncbitaxon, looked up by default"):
+            validate_sdrf(df, "default", tmp_path / "cache", store)
@@ -0,0 +1,123 @@
+import os
+
+from wf.prefetch import STAGED_MTIME, fetch_file, stage_spectra
+
+
+def make_remote(tmp_path):
+    """A local directory standing in for the remote store of the spectra files."""
+    remote = tmp_path / "remote"
+    (remote / "sub").mkdir(parents=True)
+    (remote / "a.mzML").write_bytes(b"a" * 4)
+    (remote / "sub" / "b.mzML").write_bytes(b"b" * 6)
+    (remote / "c.d").mkdir()
+    (remote / "c.d" / "analysis.tdf").write_bytes(b"c")
+    return remote
+
+
+def test_stage_sdrf_uris(tmp_path):
+    remote = make_remote(tmp_path)
+    sdrf = tmp_path / "design.sdrf.tsv"
+    sdrf.write_text(
+        "source name\tcomment[data file]\tcomment[file uri]\n"
+        f"1\ta.mzML\t{remote}/a.mzML\n"
+        f"2\ta.mzML\t{remote}/a.mzML\n"
+        f"3\tb.mzML\tfile://{remote}/sub/b.mzML\n"
+    )
+    fetched = []
+
+    def fetch(source, target):
+        fetched.append(source)
+        fetch_file(source, target)
+
+    staged = stage_spectra(sdrf, None, None, tmp_path / "spectra", fetch=fetch, threads=2)
+    assert (staged.root_folder, staged.local_input_type, staged.design) == (str(tmp_path / "spectra"), "mzML", sdrf)
+    assert (staged.files, staged.size_bytes) == (2, 10)
+    # The identical URIs of runs 1 and 2 are fetched once
+    assert sorted(fetched) == [f"{remote}/a.mzML", f"file://{remote}/sub/b.mzML"]
+    assert (tmp_path / "spectra" / "b.mzML").read_bytes() == b"b" * 6
+    assert os.stat(tmp_path / "spectra" / "a.mzML").st_mtime == STAGED_MTIME
+
+    # Staged files of the size of their source are not fetched again
+    fetched.clear()
+    assert stage_spectra(sdrf, None, None, tmp_path / "spectra", fetch=fetch) is not None
+    assert fetched == []
+
+
+def test_stage_root_folder(tmp_path):
+    remote = make_remote(tmp_path)
+    design = tmp_path / "design.tsv"
+    design.write_text(
+        "Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample\n1\t1\ta.raw\t1\t1\n2\t1\tsub/b.raw\t1\t2\n"
+    )
+    staged = stage_spectra(design, str(remote), "mzML", tmp_path / "spectra")
+    assert (staged.root_folder, staged.local_input_type, staged.design) == (str(tmp_path / "spectra"), "mzML", design)
+    assert (tmp_path / "spectra" / "sub" / "b.mzML").read_bytes() == b"b" * 6
+
+
+def test_stage_bruker_folder(tmp_path):
+    remote = make_remote(tmp_path)
+    sdrf = tmp_path / "design.sdrf.tsv"
+    sdrf.write_text(f"source name\tcomment[data file]\tcomment[file uri]\n1\tc.d\t{remote}/c.d\n")
+    staged = stage_spectra(sdrf, None, "mzML", tmp_path / "spectra")
+    assert staged.local_input_type == "d"
+    assert (tmp_path / "spectra" / "c.d" / "analysis.tdf").read_bytes() == b"c"
+
+
+def test_rewrite_expdesign(tmp_path):
+    remote = make_remote(tmp_path)
+    design = tmp_path / "design.tsv"
+    design.write_text(
+        "Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample\n"
+        f"1\t1\t{remote}/a.mzML\t1\t1\n"
+        f"2\t1\t{remote}/sub/b.mzML\t1\t2\n"
+        "\n"
+        "Sample\tMSstats_Condition\n1\tA\n2\tB\n"
+    )
+    staged = stage_spectra(design, None, None, tmp_path / "spectra")
+    assert staged.design != design
+    assert staged.design.read_text().splitlines()[1:3] == ["1\t1\ta.mzML\t1\t1", "2\t1\tb.mzML\t1\t2"]
+    assert staged.design.read_text().endswith("\nSample\tMSstats_Condition\n1\tA\n2\tB\n")
+    # The same in the next execution, so the tasks reading it keep their hashes
+    assert os.stat(staged.design).st_mtime == STAGED_MTIME
+    inode = os.stat(staged.design).st_ino
+    assert stage_spectra(design, None, None, tmp_path / "spectra").design == staged.design
+    assert os.stat(staged.design).st_ino == inode
+    assert os.stat(staged.design).st_mtime == STAGED_MTIME
+
+
+def test_retry_failed_fetch(tmp_path):
+    remote = make_remote(tmp_path)
+    sdrf = tmp_path / "design.sdrf.tsv"
+    sdrf.write_text(f"source name\tcomment[data file]\tcomment[file uri]\n1\ta.mzML\t{remote}/a.mzML\n")
+    attempts = []
+
+    def flaky(source, target):
+        attempts.append(source)
+        if len(attempts) == 1:
+            raise ConnectionError("connection reset")
+        fetch_file(source, target)
+
+    assert stage_spectra(sdrf, None, None, tmp_path / "spectra", fetch=flaky) is not None
+    assert len(attempts) == 2
+
+
+def test_give_up(tmp_path):
+    remote = make_remote(tmp_path)
+    sdrf = tmp_path / "design.sdrf.tsv"
+    sdrf.write_text(f"source name\tcomment[data file]\tcomment[file uri]\n1\ta.mzML\t{remote}/a.mzML\n")
+    # A size mismatch on every attempt, then a missing source
+    assert stage_spectra(sdrf, None, None, tmp_path / "spectra", size_of=lambda source: 99) is None
+    assert not (tmp_path / "spectra" / "a.mzML").exists()
+    (remote / "a.mzML").unlink()
+    assert stage_spectra(sdrf, None, None, tmp_path / "spectra") is None
+
+
+def test_name_collision(tmp_path):
+    remote = make_remote(tmp_path)
+    sdrf = tmp_path / "design.sdrf.tsv"
+    sdrf.write_text(
+        "source name\tcomment[data file]\tcomment[file uri]\n"
+        f"1\ta.mzML\t{remote}/a.mzML\n"
+        f"2\ta.mzML\t{remote}/sub/b.mzML\n"
+    )
+    assert stage_spectra(sdrf, None, None, tmp_path / "spectra") is None
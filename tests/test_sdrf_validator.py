@@ -0,0 +1,113 @@
+import json
+
+import pytest
+import sdrf_validator
+from sdrf_pipelines.sdrf.sdrf import SdrfDataFrame
+from sdrf_validator import ontology_client, validate_sdrf
+
+HEADER = (
+    "source name",
+    "characteristics[organism]",
+    "characteristics[organism part]",
+    "characteristics[disease]",
+    "characteristics[cell type]",
+    "characteristics[biological replicate]",
+    "assay name",
+    "comment[technical replicate]",
+    "comment[fraction identifier]",
+    "comment[data file]",
+)
+
+
+class Ontologies:
+    """Stands in for OLS, knowing a single organism, and records the labels looked up."""
+
+    path = "in memory"
+    version = "1"
+    ontologies = {"ncbitaxon": {}}
+
+    def __init__(self):
+        self.searched = []
+
+    def search(self, name, ontology=None, exact=None, **kwargs):
+        self.searched.append(name)
+        return [{"label": name, "ontology_name": "ncbitaxon"}] if name == "homo sapiens" else None
+
+
+def write_sdrf(path, organisms, cell_types):
+    rows = [
+        (f"s{i}", organism, "liver", "normal", cell_type, "1", f"run {i}", "1", "1", f"run{i}.raw")
+        for i, (organism, cell_type) in enumerate(zip(organisms, cell_types))
+    ]
+    path.write_text("".join("\t".join(row) + "\n" for row in [HEADER, *rows]))
+    return SdrfDataFrame.parse(str(path))
+
+
+def described(errors):
+    return [(type(e).__name__, e.row, e.column, e.message) for e in errors]
+
+
+@pytest.fixture
+def sdrf(tmp_path):
+    # The trailing whitespace of the cell type, on two rows, is found once and reported on both
+    return write_sdrf(
+        tmp_path / "design.sdrf.tsv",
+        ["homo sapiens", "homo sapiens", "unicorn", "homo sapiens"],
+        ["hepatocyte", "hepatocyte ", "hepatocyte", "hepatocyte "],
+    )
+
+
+def test_same_errors_as_sdrf_pipelines(sdrf, tmp_path):
+    with ontology_client(Ontologies()):
+        expected = described(sdrf.validate("default"))
+    ontologies = Ontologies()
+
+    errors = described(validate_sdrf(sdrf, "default", tmp_path / "cache", ontologies))
+
+    assert errors == expected
+    assert [(row, column) for _, row, column, _ in errors] == [
+        (1, "characteristics[cell type]"),
+        (2, "characteristics[organism]"),
+        (3, "characteristics[cell type]"),
+    ]
+    assert sorted(ontologies.searched) == ["homo sapiens", "unicorn"]
+
+
+def test_only_edited_rows_are_validated_again(sdrf, tmp_path, monkeypatch):
+    cache = tmp_path / "cache"
+    validate_sdrf(sdrf, "default", cache, Ontologies())
+    validated = []
+    cell_errors = sdrf_validator.cell_errors
+
+    def record(df, schemas):
+        validated.extend(df["source name"])
+        return cell_errors(df, schemas)
+
+    monkeypatch.setattr(sdrf_validator, "cell_errors", record)
+    edited = write_sdrf(
+        tmp_path / "design.sdrf.tsv",
+        ["homo sapiens", "homo sapiens", "homo sapiens", "homo sapiens"],
+        ["hepatocyte", "hepatocyte ", "hepatocyte", "hepatocyte "],
+    )
+    ontologies = Ontologies()
+
+    errors = described(validate_sdrf(edited, "default", cache, ontologies))
+
+    assert validated == ["s2"]
+    assert ontologies.searched == ["homo sapiens"]
+    assert [(row, column) for _, row, column, _ in errors] == [
+        (1, "characteristics[cell type]"),
+        (3, "characteristics[cell type]"),
+    ]
+
+
+def test_corrupt_cache_is_ignored(sdrf, tmp_path):
+    cache = tmp_path / "cache"
+    expected = described(validate_sdrf(sdrf, "default", cache, Ontologies()))
+    (cache_file,) = cache.glob("sdrf_validation_*.json")
+    cache_file.write_text('{"key": "truncated", "rows": {')
+    ontologies = Ontologies()
+
+    assert described(validate_sdrf(sdrf, "default", cache, ontologies)) == expected
+    assert sorted(ontologies.searched) == ["homo sapiens", "unicorn"]
+    assert len(json.loads(cache_file.read_text())["rows"]) == 4
@@ -0,0 +1,48 @@
+import pandas as pd
+from synthetic_diann import SyntheticExperiment
+
+FILES = ("diann_report.tsv", "diann_report.pr_matrix.tsv", "diann_report.pg_matrix.tsv", "synthetic.fasta")
+
+
+def test_same_seed_same_files(tmp_path):
+    SyntheticExperiment(runs=3, precursors=100, protein_group_size=2).generate(tmp_path / "a")
+    SyntheticExperiment(runs=3, precursors=100, protein_group_size=2).generate(tmp_path / "b")
+    SyntheticExperiment(runs=3, precursors=100, protein_group_size=2, seed=1).generate(tmp_path / "c")
+
+    files = [*FILES, "synthetic_design.tsv", "run_00002_ms_info.tsv"]
+    assert all((tmp_path / "a" / f).read_bytes() == (tmp_path / "b" / f).read_bytes() for f in files)
+    assert (tmp_path / "a" / "diann_report.tsv").read_bytes() != (tmp_path / "c" / "diann_report.tsv").read_bytes()
+
+
+def test_experiment_layout(tmp_path):
+    experiment = SyntheticExperiment(runs=4, precursors=120, precursors_per_group=6, protein_group_size=3)
+    experiment.generate(tmp_path)
+
+    report = pd.read_csv(tmp_path / "diann_report.tsv", sep="\t")
+    assert sorted(report["Run"].unique()) == experiment.run_names
+    assert report["Precursor.Id"].nunique() <= 120
+    assert not report.duplicated(["Run", "Precursor.Id"]).any()
+    assert report["Protein.Group"].str.count(";").eq(2).all()
+    assert report["Q.Value"].max() < 0.01
+
+    accessions = {line[4:].split("|")[0] for line in open(tmp_path / "synthetic.fasta") if line.startswith(">")}
+    assert set(report["Protein.Ids"].str.split(";").explode()) <= accessions
+    assert len(accessions) == 20 * 3
+
+    pg = pd.read_csv(tmp_path / "diann_report.pg_matrix.tsv", sep="\t")
+    pr = pd.read_csv(tmp_path / "diann_report.pr_matrix.tsv", sep="\t")
+    files = [f"/data/{run}.mzML" for run in experiment.run_names]
+    assert list(pg.columns[-4:]) == files and list(pr.columns[-4:]) == files
+    assert set(pr["Precursor.Id"]) == set(report["Precursor.Id"])
+
+    design = (tmp_path / "synthetic_design.tsv").read_text().split("\n\n")
+    assert [line.split("\t")[1] for line in design[1].splitlines()[1:]] == [
+        "condition_1",
+        "condition_2",
+        "condition_1",
+        "condition_2",
+    ]
+
+    ms_info = pd.read_csv(tmp_path / "run_00000_ms_info.tsv", sep="\t")
+    assert ms_info["MSLevel"].iloc[: experiment.windows + 2].tolist() == [1] + [2] * experiment.windows + [1]
+    assert ms_info["Isolation_Window_Upper"].max() == 2150.0
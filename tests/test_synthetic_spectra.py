@@ -0,0 +1,80 @@
+import hashlib
+import json
+import re
+
+import pandas as pd
+import pytest
+from benchmark_mzml_statistics import cli as benchmark
+from click.testing import CliRunner
+from mzml_statistics import ms_dataframe
+from synthetic_spectra import SyntheticSpectra, cli
+
+
+def statistics(path, workdir, monkeypatch):
+    monkeypatch.chdir(workdir)
+    ms_dataframe(str(path))
+    return pd.read_csv(workdir / f"{path.stem}_ms_info.tsv", sep="\t")
+
+
+def test_indexed_mzml(tmp_path):
+    path = SyntheticSpectra(spectra=23, peaks=20, ms2_per_ms1=10).write(tmp_path / "run", "mzml")
+    content = path.read_bytes()
+
+    offsets = re.findall(rb'<offset idRef="([^"]+)">(\d+)</offset>', content)
+    assert len(offsets) == 23
+    for native_id, offset in offsets:
+        assert content[int(offset) :].startswith(b'<spectrum index="') and native_id in content[int(offset) :][:200]
+    index_offset = int(re.search(rb"<indexListOffset>(\d+)</indexListOffset>", content).group(1))
+    assert content[index_offset:].startswith(b"<indexList ")
+    checksum_end = content.index(b"<fileChecksum>") + len(b"<fileChecksum>")
+    assert re.search(rb"<fileChecksum>(\w+)</fileChecksum>", content).group(1).decode() == (
+        hashlib.sha1(content[:checksum_end]).hexdigest()
+    )
+
+
+@pytest.mark.parametrize("compression", ["zlib", "none"])
+def test_mzml_statistics(tmp_path, monkeypatch, compression):
+    full = SyntheticSpectra(spectra=23, peaks=20, ms2_per_ms1=10, compression=compression)
+    minimal = SyntheticSpectra(spectra=23, peaks=20, ms2_per_ms1=10, compression=compression, cv_params="minimal")
+
+    df = statistics(full.write(tmp_path / "full", "mzml"), tmp_path, monkeypatch)
+    computed = statistics(minimal.write(tmp_path / "minimal", "mzml"), tmp_path, monkeypatch)
+
+    assert df["MSLevel"].tolist() == full.levels().tolist() == [1] + [2] * 10 + [1] + [2] * 10 + [1]
+    # The retention time 0 of the first spectrum is left out as missing
+    assert df["Retention_Time"].iloc[1:].is_monotonic_increasing
+    ms2 = df[df["MSLevel"] == 2]
+    assert (ms2["Isolation_Window_Lower"] < ms2["Exp_Mass_To_Charge"]).all()
+    assert (ms2["Exp_Mass_To_Charge"] < ms2["Isolation_Window_Upper"]).all()
+    # Without their cvParams, the base peak and total ion current are computed from the peaks
+    assert computed["MS_peaks"].tolist() == df["MS_peaks"].tolist()
+    for column in ("Base_Peak_Intensity", "Summed_Peak_Intensities"):
+        assert computed[column].tolist() == pytest.approx(df[column].tolist(), rel=1e-5)
+
+
+@pytest.mark.parametrize("acquisition", ["dda", "dia"])
+def test_tdf_statistics(tmp_path, monkeypatch, acquisition):
+    result = CliRunner().invoke(
+        cli, ["tdf", "--out", str(tmp_path / "run"), "--spectra", "30", "--acquisition", acquisition]
+    )
+    assert result.exit_code == 0, result.output
+
+    df = statistics(tmp_path / "run.d", tmp_path, monkeypatch)
+
+    assert len(df) == 30
+    assert df["MSLevel"].tolist() == SyntheticSpectra(spectra=30).levels().tolist()
+    assert (df["MS_peaks"] > 0).all()
+    assert df["AcquisitionDateTime"].unique().tolist() == ["2023-01-01T00:00:00Z"]
+
+
+def test_benchmark_mzml_statistics(tmp_path):
+    out = tmp_path / "results.json"
+    args = ["run", "-n", "40", "-c", "mzml_uncompressed", "-c", "tdf_dia", "-r", "1", "-w", str(tmp_path), "-o", out]
+    result = CliRunner().invoke(benchmark, [str(a) for a in args])
+    assert result.exit_code == 0, result.output
+
+    scales = json.loads(out.read_text())["scales"]
+    assert [s["scale"] for s in scales] == ["mzml_uncompressed_40", "tdf_dia_40"]
+    assert all(s["median"]["total"]["spectra_per_s"] > 0 and s["median"]["total"]["peak_rss_mb"] > 0 for s in scales)
+    # The files are generated once, and reused by the next runs
+    assert (tmp_path / "mzml_uncompressed_40.json").exists() and (tmp_path / "tdf_dia_40.d").is_dir()
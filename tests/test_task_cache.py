@@ -0,0 +1,67 @@
+import os
+
+from wf.task_cache import LocalCacheStore, TaskCache, cache_inputs, cache_key, last_session
+
+SESSION = "1f2e3d4c-0000-4000-8000-0123456789ab"
+
+
+def make_run(work_dir, session=SESSION):
+    """A work directory as left by a Nextflow run: a task directory, its cache database and its history."""
+    task = work_dir / "ab" / "cdef0123"
+    task.mkdir(parents=True)
+    (task / ".command.sh").write_text("echo hello\n")
+    (task / "out.mzML").write_bytes(b"<mzML/>" * 100)
+    os.symlink("/data/input.raw", task / "input.raw")
+    (work_dir / ".nextflow" / "cache" / session / "db").mkdir(parents=True)
+    (work_dir / ".nextflow" / "cache" / session / "db" / "000001.log").write_bytes(b"\0" * 64)
+    (work_dir / ".nextflow" / "history").write_text(
+        f"2026-10-19 12:00:00\t1h\tsilly_name\tERR\tabc123\t{session}\tnextflow run main.nf\n"
+    )
+
+
+def make_inputs(tmp_path, spectra_size=100):
+    (tmp_path / "design.sdrf.tsv").write_text("source name\tcomment[data file]\n1\tinput.raw\n")
+    (tmp_path / "db.fasta").write_text(">P1\nPEPTIDE\n")
+    return cache_inputs(tmp_path / "design.sdrf.tsv", tmp_path / "db.fasta", {"/data/input.raw": spectra_size})
+
+
+def test_save_then_restore(tmp_path):
+    inputs = make_inputs(tmp_path)
+    key = cache_key(inputs)
+    make_run(tmp_path / "run")
+    cache = TaskCache(LocalCacheStore(tmp_path / "store"), max_bytes=1024**3)
+    assert cache.save(key, inputs, tmp_path / "run")
+
+    restored = tmp_path / "fresh"
+    restored.mkdir()
+    assert cache.restore(key, inputs, restored) == SESSION
+    task = restored / "ab" / "cdef0123"
+    assert (task / "out.mzML").read_bytes() == b"<mzML/>" * 100
+    assert os.readlink(task / "input.raw") == "/data/input.raw"
+    assert (restored / ".nextflow" / "cache" / SESSION / "db" / "000001.log").exists()
+    # Listed in the history, so -resume finds the session on a new volume
+    assert last_session(restored) == SESSION
+
+
+def test_restore_changed_inputs(tmp_path):
+    inputs = make_inputs(tmp_path)
+    key = cache_key(inputs)
+    make_run(tmp_path / "run")
+    cache = TaskCache(LocalCacheStore(tmp_path / "store"), max_bytes=1024**3)
+    cache.save(key, inputs, tmp_path / "run")
+
+    changed = make_inputs(tmp_path, spectra_size=200)
+    assert cache_key(changed) == key
+    assert cache.restore(key, changed, tmp_path / "fresh") is None
+    assert cache.restore("0" * 16, inputs, tmp_path / "fresh") is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    store = LocalCacheStore(tmp_path / "store")
+    inputs = make_inputs(tmp_path)
+    for key in ("old", "new"):
+        make_run(tmp_path / key)
+        TaskCache(store, max_bytes=1024**3).save(key, inputs, tmp_path / key)
+    size = TaskCache(store, 0).entry("new")["size_bytes"]
+    TaskCache(store, max_bytes=size).evict(keep="new")
+    assert store.list() == ["new"]
@@ -0,0 +1,55 @@
+import csv
+from pathlib import Path
+
+from click.testing import CliRunner
+from trace_resources import GB, main, read_traces, recommend
+
+TRACE = Path(__file__).parent / "data" / "execution_trace.txt"
+DIANN = "NFCORE_QUANTMS:QUANTMS:DIA:DIANN_PRELIMINARY_ANALYSIS"
+STATISTICS = "NFCORE_QUANTMS:QUANTMS:MZML_STATISTICS"
+
+
+def test_read_traces():
+    tasks = read_traces([TRACE])
+
+    assert len(tasks) == 9
+    completed, failed = tasks[1], tasks[6]
+    assert (completed.process, completed.status, completed.exit) == (DIANN, "COMPLETED", 0)
+    assert completed.input_bytes == 2 * GB and completed.peak_rss == 2 * GB
+    assert completed.realtime == 18 * 60 + 30 and completed.time == 2 * 3600
+    assert (completed.cpu_usage, completed.cpus, completed.memory) == (210.5, 4, 8 * GB)
+    # The metrics of a task killed for its memory are not traced
+    assert (failed.status, failed.exit, failed.memory) == ("FAILED", 137, 4 * GB)
+    assert failed.peak_rss is None and failed.input_bytes is None
+    assert tasks[8].realtime == 36.5
+
+
+def test_recommend():
+    tasks = read_traces([TRACE])
+
+    diann = recommend(DIANN, [t for t in tasks if t.process == DIANN], input_scale=1.0)
+    # The peak memory grows as 1 GB + rchar / 2, so 4 GB at the largest input, with its margin
+    assert (diann.cpus, diann.memory_gb, diann.time_minutes, diann.fitted) == (3, 5, 100, True)
+    assert len(diann.completed) == 6 and len(diann.failed) == 1
+    assert recommend(DIANN, [t for t in tasks if t.process == DIANN], input_scale=2.0).memory_gb == 9
+
+    statistics = recommend(STATISTICS, [t for t in tasks if t.process == STATISTICS], input_scale=1.0)
+    assert (statistics.cpus, statistics.memory_gb, statistics.time_minutes, statistics.fitted) == (1, 1, 10, False)
+
+
+def test_config_and_report(tmp_path):
+    config, report = tmp_path / "resources.config", tmp_path / "report.tsv"
+
+    result = CliRunner().invoke(main, [str(TRACE), "--out", str(config), "--report", str(report)])
+
+    assert result.exit_code == 0, result.output
+    text = config.read_text()
+    assert f"    withName: '{DIANN}' {{\n" in text
+    assert "        memory = { check_max( 5.GB    * task.attempt, 'memory' ) }\n" in text
+    assert "        time   = { check_max( 100.min * task.attempt, 'time'   ) }\n" in text
+    with open(report, newline="") as f:
+        rows = {row["process"]: row for row in csv.DictReader(f, delimiter="\t")}
+    assert list(rows) == [DIANN, STATISTICS, "all"]
+    assert rows[DIANN]["retry_rate"] == str(round(1 / 6, 4))
+    assert rows["all"]["tasks"] == "8"
+    assert float(rows["all"]["recommended_memory_gb_hours"]) < float(rows["all"]["memory_gb_hours"])
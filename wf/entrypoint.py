@@ -2,12 +2,14 @@ import os
 import shutil
 import subprocess
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
 import typing_extensions
 from flytekit.core.annotation import FlyteAnnotation
 from latch.ldata.path import LPath
+from latch.ldata.type import LatchPathError
 from latch.resources.tasks import custom_task, nextflow_runtime_task
 from latch.resources.workflow import workflow
 from latch.types import metadata
@@ -18,24 +20,135 @@ from latch_cli.nextflow.workflow import get_flag
 from latch_cli.services.register.utils import import_module_by_path
 from latch_cli.utils import urljoins
 
+from wf.log_shipper import LogShipper
+from wf.prefetch import fetch_file, stage_spectra
+from wf.resource_plan import GIB, SIZE_THREADS, design_spectra_files, file_size, plan_head, plan_resources
+from wf.task_cache import TaskCache, cache_inputs, cache_key
+
 meta = Path("latch_metadata") / "__init__.py"
 import_module_by_path(meta)
 
+# Resources of the Nextflow head, fixed when the workflow is registered
+RUNTIME_CPU = 4
+RUNTIME_MEMORY_GIB = 8
+# Memory of the Nextflow head left to the JVM outside of its heap
+RUNTIME_NON_HEAP_GIB = 1
+# Directory of the logs of the executions on Latch Data
+LOG_DIR = "latch:///your_log_dir/nf_nf_core_quantms"
+# Execution timeline, report and trace, written in the launch directory by latch.config
+PIPELINE_INFO_FILES = ("execution_timeline.html", "execution_report.html", "execution_trace.txt")
+# Directory of the task cache on Latch Data, and its size over which the least recently used entries are evicted
+TASK_CACHE_DIR = "latch:///quantms_task_cache"
+TASK_CACHE_MAX_GIB = 2048
+
+
+def spectra_file_size(path: str) -> typing.Optional[int]:
+    """Size of a spectra file on Latch Data or reachable by ``file_size``, None if it cannot be read."""
+    if not path.startswith("latch://"):
+        return file_size(path)
+    try:
+        return LPath(path).size_recursive()
+    except Exception as e:
+        # The size is only an estimate, a file missing here is reported by the pipeline
+        print(f"Could not read the size of {path}: {e}")
+        return None
+
+
+def fetch_spectra_file(source: str, target: Path):
+    """Downloads a spectra file from Latch Data, or fetches it with ``fetch_file``, as the fetch of a prefetch."""
+    if source.startswith("latch://"):
+        LPath(source).download(target)
+    else:
+        fetch_file(source, target)
+
+
+def latch_upload(remote_dir: str):
+    """Uploads a local file under a name in a directory of Latch Data, as the store of a ``LogShipper``."""
+
+    def upload(local: Path, name: str):
+        LPath(urljoins(remote_dir, name)).upload_from(local)
+
+    return upload
+
+
+class LatchCacheStore:
+    """A store of a task cache in a directory of Latch Data, with the methods of ``LocalCacheStore``."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def upload(self, local: Path, name: str):
+        LPath(urljoins(self.root, name)).upload_from(local)
+
+    def download(self, name: str, local: Path) -> bool:
+        remote = LPath(urljoins(self.root, name))
+        try:
+            remote.fetch_metadata()
+        except LatchPathError:
+            return False
+        remote.download(local)
+        return True
+
+    def list(self) -> typing.List[str]:
+        try:
+            return [p.name() for p in LPath(self.root).iterdir()]
+        except LatchPathError:
+            return []
+
+    def delete(self, name: str):
+        try:
+            LPath(urljoins(self.root, name)).rmr()
+        except LatchPathError:
+            pass
+
+
+def open_task_cache(
+    input: LatchFile, database: LatchFile, root_folder: typing.Optional[str], local_input_type: typing.Optional[str]
+) -> typing.Tuple[TaskCache, str, typing.Dict]:
+    """The task cache, and the key and inputs of the entry of a run in it."""
+    spectra = list(dict.fromkeys(design_spectra_files(Path(input), root_folder, local_input_type)))
+    with ThreadPoolExecutor(max_workers=SIZE_THREADS) as pool:
+        sizes = dict(zip(spectra, pool.map(spectra_file_size, spectra)))
+    inputs = cache_inputs(Path(input), Path(database), sizes)
+    return TaskCache(LatchCacheStore(TASK_CACHE_DIR), TASK_CACHE_MAX_GIB * GIB), cache_key(inputs), inputs
+
+
+def previous_spectra_manifest(outdir: LatchDir) -> typing.Optional[Path]:
+    """The manifest of the spectra files of a previous run in the output directory, None if there is none."""
+    try:
+        return LPath(urljoins(outdir.remote_path, "pipeline_info", "spectra_manifest.tsv")).download()
+    except Exception:
+        return None
+
 
 @custom_task(cpu=0.25, memory=0.5, storage_gib=1)
-def initialize() -> str:
+def initialize(
+    input: LatchFile,
+    outdir: LatchDir,
+    root_folder: typing.Optional[str],
+    local_input_type: typing.Optional[str],
+) -> str:
     token = os.environ.get("FLYTE_INTERNAL_EXECUTION_ID")
     if token is None:
         raise RuntimeError("failed to get execution token")
 
     headers = {"Authorization": f"Latch-Execution-Token {token}"}
 
-    print("Provisioning shared storage volume... ", end="")
+    plan = plan_resources(
+        Path(input),
+        root_folder,
+        local_input_type,
+        size_of=spectra_file_size,
+        manifest=previous_spectra_manifest(outdir),
+    )
+    print(plan.describe(), flush=True)
+
+    print(f"Provisioning shared storage volume of {plan.storage_gib} GiB... ", end="")
     resp = requests.post(
         "http://nf-dispatcher-service.flyte.svc.cluster.local/provision-storage",
         headers=headers,
         json={
-            "storage_gib": 100,
+            "storage_gib": plan.storage_gib,
         },
     )
     resp.raise_for_status()
@@ -44,7 +157,7 @@ def initialize() -> str:
     return resp.json()["name"]
 
 
-@nextflow_runtime_task(cpu=4, memory=8, storage_gib=100)
+@nextflow_runtime_task(cpu=RUNTIME_CPU, memory=RUNTIME_MEMORY_GIB, storage_gib=100)
 def nextflow_runtime(
     pvc_name: str,
     input: LatchFile,
@@ -52,6 +165,12 @@ def nextflow_runtime(
     email: typing.Optional[str],
     multiqc_title: typing.Optional[str],
     root_folder: typing.Optional[str],
+    ontology_store: typing.Optional[str],
+    sdrf_cache_dir: typing.Optional[str],
+    spectra_preflight: typing.Optional[bool],
+    eager_cleanup: typing.Optional[bool],
+    task_cache: typing.Optional[bool],
+    prefetch_spectra: typing.Optional[bool],
     database: LatchFile,
     add_decoys: typing.Optional[bool],
     openms_peakpicking: typing.Optional[bool],
@@ -156,6 +275,8 @@ def nextflow_runtime(
     pg_level: typing.Optional[float],
     species_genes: typing.Optional[bool],
     diann_normalize: typing.Optional[bool],
+    diannconvert_shards: typing.Optional[int],
+    diannconvert_table_format: typing.Optional[str],
     msstats_threshold: typing.Optional[float],
     add_triqler_output: typing.Optional[bool],
     msstatslfq_feature_subset_protein: typing.Optional[str],
@@ -172,6 +293,13 @@ def nextflow_runtime(
     msstats_plot_profile_qc: typing.Optional[bool],
     skip_table_plots: typing.Optional[bool],
 ) -> None:
+    if task_cache and eager_cleanup:
+        # The intermediate files eager_cleanup deletes are missing from the saved work directory, so every task
+        # reading them would run again
+        raise ValueError("task_cache can not be used with eager_cleanup, disable one of them")
+
+    shipper = None
+    cache = None
     try:
         shared_dir = Path("/nf-workdir")
 
@@ -195,6 +323,33 @@ def nextflow_runtime(
             dirs_exist_ok=True,
         )
 
+        resume = []
+        if task_cache:
+            # Runs of the same design and database resume the tasks of the last one
+            try:
+                cache, key, inputs = open_task_cache(input, database, root_folder, local_input_type)
+                session = cache.restore(key, inputs, shared_dir)
+                if session is not None:
+                    resume = ["-resume", session]
+            except Exception as e:
+                cache = None
+                print(f"Task cache unavailable, running from scratch: {e}")
+
+        if prefetch_spectra:
+            # The spectra files are staged on the shared volume at once, the tasks read them from there
+            staged = stage_spectra(
+                Path(input),
+                root_folder,
+                local_input_type,
+                shared_dir / "spectra",
+                fetch_spectra_file,
+                spectra_file_size,
+            )
+            if staged is not None:
+                if staged.design != Path(input):
+                    input = str(staged.design)
+                root_folder, local_input_type = staged.root_folder, staged.local_input_type
+
         cmd = [
             "/root/nextflow",
             "run",
@@ -205,6 +360,7 @@ def nextflow_runtime(
             "docker",
             "-c",
             "latch.config",
+            *resume,
             *get_flag("input", input),
             *get_flag("outdir", outdir),
             *get_flag("email", email),
@@ -212,6 +368,10 @@ def nextflow_runtime(
             *get_flag("root_folder", root_folder),
             *get_flag("local_input_type", local_input_type),
             *get_flag("acquisition_method", acquisition_method),
+            *get_flag("ontology_store", ontology_store),
+            *get_flag("sdrf_cache_dir", sdrf_cache_dir),
+            *get_flag("spectra_preflight", spectra_preflight),
+            *get_flag("eager_cleanup", eager_cleanup),
             *get_flag("database", database),
             *get_flag("add_decoys", add_decoys),
             *get_flag("decoy_string", decoy_string),
@@ -308,6 +468,8 @@ def nextflow_runtime(
             *get_flag("species_genes", species_genes),
             *get_flag("diann_speclib", diann_speclib),
             *get_flag("diann_normalize", diann_normalize),
+            *get_flag("diannconvert_shards", diannconvert_shards),
+            *get_flag("diannconvert_table_format", diannconvert_table_format),
             *get_flag("skip_post_msstats", skip_post_msstats),
             *get_flag("ref_condition", ref_condition),
             *get_flag("contrasts", contrasts),
@@ -335,13 +497,33 @@ def nextflow_runtime(
         print(" ".join(cmd))
         print(flush=True)
 
+        # The head gets all the memory of its pod, the plan only tells when that is not enough
+        head = plan_head(len(design_spectra_files(Path(input), root_folder, local_input_type)))
+        heap_gib = RUNTIME_MEMORY_GIB - RUNTIME_NON_HEAP_GIB
+        print(f"Nextflow head: {heap_gib} GiB of heap for {head.files} spectra files, {head.heap_gib} GiB needed")
+        if head.heap_gib > heap_gib:
+            print(
+                f"Warning: {head.files} spectra files need {head.heap_gib} GiB of heap, more than the"
+                f" {RUNTIME_MEMORY_GIB} GiB of the Nextflow head, raise RUNTIME_MEMORY_GIB"
+            )
         env = {
             **os.environ,
             "NXF_HOME": "/root/.nextflow",
-            "NXF_OPTS": "-Xms2048M -Xmx8G -XX:ActiveProcessorCount=4",
+            "NXF_OPTS": (f"-Xms{min(2, heap_gib)}G -Xmx{heap_gib}G -XX:ActiveProcessorCount={RUNTIME_CPU}"),
             "K8S_STORAGE_CLAIM_NAME": pvc_name,
             "NXF_DISABLE_CHECK_LATEST": "true",
         }
+        name = _get_execution_name()
+        if name is None:
+            print("Skipping logs upload during the run, failed to get execution name")
+        else:
+            # The log and the trace are shipped while the run goes on, the log as chunks of its new lines
+            shipper = LogShipper(
+                latch_upload(urljoins(LOG_DIR, name)),
+                appended={"nextflow.log": shared_dir / ".nextflow.log"},
+                replaced={"execution_trace.txt": shared_dir / "pipeline_info" / "execution_trace.txt"},
+            )
+            shipper.start()
         subprocess.run(
             cmd,
             env=env,
@@ -350,16 +532,29 @@ def nextflow_runtime(
         )
     finally:
         print()
+        if shipper is not None:
+            shipper.stop()
+        if cache is not None:
+            try:
+                cache.save(key, inputs, shared_dir)
+            except Exception as e:
+                print(f"Could not save the task cache: {e}")
 
         nextflow_log = shared_dir / ".nextflow.log"
-        if nextflow_log.exists():
-            name = _get_execution_name()
-            if name is None:
-                print("Skipping logs upload, failed to get execution name")
-            else:
-                remote = LPath(urljoins("latch:///your_log_dir/nf_nf_core_quantms", name, "nextflow.log"))
+        name = _get_execution_name()
+        if name is None:
+            print("Skipping logs upload, failed to get execution name")
+        else:
+            if nextflow_log.exists():
+                remote = LPath(urljoins(LOG_DIR, name, "nextflow.log"))
                 print(f"Uploading .nextflow.log to {remote.path}")
                 remote.upload_from(nextflow_log)
+            for file_name in PIPELINE_INFO_FILES:
+                local = shared_dir / "pipeline_info" / file_name
+                if local.exists():
+                    print(f"Uploading {file_name} to {urljoins(LOG_DIR, name)} and the pipeline_info of the outdir")
+                    LPath(urljoins(LOG_DIR, name, file_name)).upload_from(local)
+                    LPath(urljoins(outdir.remote_path, "pipeline_info", file_name)).upload_from(local)
 
 
 @workflow(metadata._nextflow_metadata)
@@ -369,6 +564,12 @@ def nf_nf_core_quantms(
     email: typing.Optional[str],
     multiqc_title: typing.Optional[str],
     root_folder: typing.Optional[str],
+    ontology_store: typing.Optional[str],
+    sdrf_cache_dir: typing.Optional[str],
+    spectra_preflight: typing.Optional[bool],
+    eager_cleanup: typing.Optional[bool],
+    task_cache: typing.Optional[bool],
+    prefetch_spectra: typing.Optional[bool],
     database: LatchFile,
     add_decoys: typing.Optional[bool],
     openms_peakpicking: typing.Optional[bool],
@@ -473,6 +674,8 @@ def nf_nf_core_quantms(
     pg_level: typing.Optional[float] = 2.0,
     species_genes: typing.Optional[bool] = False,
     diann_normalize: typing.Optional[bool] = True,
+    diannconvert_shards: typing.Optional[int] = 1,
+    diannconvert_table_format: typing.Optional[str] = "text",
     msstats_threshold: typing.Optional[float] = 0.05,
     add_triqler_output: typing.Optional[bool] = False,
     msstatslfq_feature_subset_protein: typing.Optional[str] = "top3",
@@ -495,7 +698,7 @@ def nf_nf_core_quantms(
     Sample Description
     """
 
-    pvc_name: str = initialize()
+    pvc_name: str = initialize(input=input, outdir=outdir, root_folder=root_folder, local_input_type=local_input_type)
     nextflow_runtime(
         pvc_name=pvc_name,
         input=input,
@@ -505,6 +708,12 @@ def nf_nf_core_quantms(
         root_folder=root_folder,
         local_input_type=local_input_type,
         acquisition_method=acquisition_method,
+        ontology_store=ontology_store,
+        sdrf_cache_dir=sdrf_cache_dir,
+        spectra_preflight=spectra_preflight,
+        eager_cleanup=eager_cleanup,
+        task_cache=task_cache,
+        prefetch_spectra=prefetch_spectra,
         database=database,
         add_decoys=add_decoys,
         decoy_string=decoy_string,
@@ -601,6 +810,8 @@ def nf_nf_core_quantms(
         species_genes=species_genes,
         diann_speclib=diann_speclib,
         diann_normalize=diann_normalize,
+        diannconvert_shards=diannconvert_shards,
+        diannconvert_table_format=diannconvert_table_format,
         skip_post_msstats=skip_post_msstats,
         ref_condition=ref_condition,
         contrasts=contrasts,
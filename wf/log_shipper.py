@@ -0,0 +1,156 @@
+"""
+Ships the logs of a run to a store while it runs, from a background thread, so the progress and the resources of the
+tasks of a long run can be followed before it ends. Logs Nextflow appends to, e.g. .nextflow.log, are shipped as
+numbered chunks of the lines added since the last shipment. Files rewritten as a whole, e.g. the trace, are shipped
+whole when they change. The store is a function uploading a local file under a name, e.g. to Latch Data, or to a
+local directory with ``local_store``.
+"""
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+# Seconds between two shipments
+LOG_SHIP_INTERVAL = 60
+# Largest chunk of a log shipped at once
+LOG_CHUNK_BYTES = 64 * 1024**2
+# Seconds the end of a run waits for a shipment in progress
+LOG_SHIP_STOP_TIMEOUT = 120
+
+Upload = Callable[[Path, str], None]
+
+
+class LogShipper(threading.Thread):
+    """Background thread shipping logs to a store every ``interval`` seconds, until stopped.
+
+    Failed uploads are reported and retried at the next shipment, they never stop the run.
+
+    :param upload: Uploads a local file to the store under a name
+    :type upload: callable
+    :param appended: Logs written by appending lines, by name in the store, shipped as the chunks
+        ``<name>.00001``, ``<name>.00002``, etc
+    :type appended: dict
+    :param replaced: Files rewritten as a whole, by name in the store, shipped whole when they change
+    :type replaced: dict
+    :param interval: Seconds between two shipments
+    :type interval: float
+    """
+
+    def __init__(
+        self,
+        upload: Upload,
+        appended: Optional[Dict[str, Path]] = None,
+        replaced: Optional[Dict[str, Path]] = None,
+        interval: float = LOG_SHIP_INTERVAL,
+    ):
+        super().__init__(name="log-shipper", daemon=True)
+        self.upload = upload
+        self.appended = {name: Path(path) for name, path in (appended or {}).items()}
+        self.replaced = {name: Path(path) for name, path in (replaced or {}).items()}
+        self.interval = interval
+        # Offset shipped and number of chunks of each appended log, and state of each replaced file when shipped
+        self._offsets: Dict[str, Tuple[int, int]] = {name: (0, 0) for name in self.appended}
+        self._states: Dict[str, Tuple[int, int]] = {}
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.ship()
+
+    def stop(self, timeout: float = LOG_SHIP_STOP_TIMEOUT):
+        """Stops the thread, then ships what the logs hold, including a last line without its newline."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+        self.ship(final=True)
+
+    def ship(self, final: bool = False):
+        """Ships the new lines of the appended logs and the replaced files that changed.
+
+        :param final: Whether to also ship the end of the logs after their last newline
+        :type final: bool
+        """
+        with self._lock:
+            for name, path in self.appended.items():
+                try:
+                    self._ship_chunks(name, path, final)
+                except Exception as e:
+                    print(f"Could not ship {path} as {name}: {e}", flush=True)
+            for name, path in self.replaced.items():
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                state = (stat.st_size, stat.st_mtime_ns)
+                if self._states.get(name) == state:
+                    continue
+                try:
+                    with tempfile.TemporaryDirectory() as tmp:
+                        # Copied first, so the file shipped is consistent even if it is rewritten meanwhile
+                        snapshot = Path(shutil.copy(path, Path(tmp) / path.name))
+                        self.upload(snapshot, name)
+                    self._states[name] = state
+                except Exception as e:
+                    print(f"Could not ship {path} as {name}: {e}", flush=True)
+
+    def _ship_chunks(self, name: str, path: Path, final: bool):
+        offset, chunks = self._offsets[name]
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return
+        if size < offset:
+            # Rolled over, e.g. by a new run, shipped from its start in the next chunks
+            offset = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while offset < size:
+                data = f.read(min(LOG_CHUNK_BYTES, size - offset))
+                if not data:
+                    break
+                end = data.rfind(b"\n") + 1
+                if not final and end == 0 and len(data) < LOG_CHUNK_BYTES:
+                    # A line still being written, shipped with the next one
+                    break
+                if not final and end:
+                    data = data[:end]
+                with tempfile.NamedTemporaryFile("wb", suffix=".log", delete=False) as chunk:
+                    chunk.write(data)
+                try:
+                    self.upload(Path(chunk.name), f"{name}.{chunks + 1:05d}")
+                finally:
+                    os.unlink(chunk.name)
+                offset += len(data)
+                chunks += 1
+                f.seek(offset)
+                self._offsets[name] = (offset, chunks)
+
+    def __enter__(self) -> "LogShipper":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def local_store(root: os.PathLike) -> Upload:
+    """A store in a local directory, e.g. to stand in for a remote one.
+
+    :param root: Directory of the store, created if needed
+    :type root: str
+    """
+    root = Path(root)
+
+    def upload(local: Path, name: str):
+        target = root / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Copied aside and moved in place, so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=target.parent, suffix=".tmp", delete=False) as f:
+            tmp = Path(f.name)
+        shutil.copyfile(local, tmp)
+        os.replace(tmp, target)
+
+    return upload
@@ -0,0 +1,231 @@
+"""
+Stages the spectra files of a run on the shared volume before Nextflow starts, many at a time, instead of each task
+staging its own file when it starts. The files are resolved from the SDRF or experimental design as the pipeline does,
+each distinct one is fetched once and its size checked against its source, and the run is pointed at the staged
+copies through the root_folder and local_input_type parameters. The fetch is a function copying a source to a local
+path, so a local directory can stand in for the remote store.
+"""
+import ftplib
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from wf.resource_plan import design_file_names, design_spectra_files, file_size
+
+# Spectra files fetched at the same time
+PREFETCH_THREADS = 8
+# Fetches of a file before giving up when it fails or its size is not that of its source
+PREFETCH_ATTEMPTS = 2
+# Modification time given to the staged files and the rewritten design, the same in every execution: Nextflow hashes
+# the input files of a task from their path, size and modification time, so the tasks reading them are resumed from
+# the task cache
+STAGED_MTIME = 946684800
+
+Fetch = Callable[[str, Path], None]
+
+
+@dataclass
+class StagedInputs:
+    """Parameters running the pipeline on the staged spectra files.
+
+    :param root_folder: Folder of the staged files
+    :type root_folder: str
+    :param local_input_type: Extension of the staged files, as the local_input_type parameter
+    :type local_input_type: str
+    :param design: SDRF or experimental design to run, rewritten if the paths of its files changed
+    :type design: pathlib.Path
+    :param files: Number of distinct spectra files staged
+    :type files: int
+    :param size_bytes: Size of the staged files
+    :type size_bytes: int
+    """
+
+    root_folder: str
+    local_input_type: Optional[str]
+    design: Path
+    files: int
+    size_bytes: int
+
+
+def stage_spectra(
+    design: os.PathLike,
+    root_folder: Optional[str],
+    local_input_type: Optional[str],
+    staging_dir: os.PathLike,
+    fetch: Optional[Fetch] = None,
+    size_of: Optional[Callable[[str], Optional[int]]] = None,
+    threads: int = PREFETCH_THREADS,
+) -> Optional[StagedInputs]:
+    """Stages the spectra files of a design in a folder, and gives the parameters to run the pipeline on them.
+
+    With a root folder, the files are staged under the same names relative to the staging folder. Without one,
+    they are staged under their data file names for an SDRF, or file names for an experimental design, which is
+    rewritten with them. local_input_type is then set to their extension, which they must all share.
+
+    :param design: Path to the SDRF or experimental design
+    :type design: str
+    :param root_folder: Folder of the spectra files, as the root_folder parameter
+    :type root_folder: str
+    :param local_input_type: Extension of the spectra files in the root folder, as the local_input_type parameter
+    :type local_input_type: str
+    :param staging_dir: Folder to stage the files in, on the volume shared with the tasks
+    :type staging_dir: str
+    :param fetch: Copies a spectra file, or a Bruker .d folder, to a local path, ``fetch_file`` by default
+    :type fetch: callable
+    :param size_of: Size of a spectra file in bytes, None if unknown, ``file_size`` by default
+    :type size_of: callable
+    :param threads: Spectra files fetched at the same time
+    :type threads: int
+    :return: The parameters to run the pipeline with, None if the files could not all be staged
+    :rtype: StagedInputs
+    """
+    design, staging_dir = Path(design), Path(staging_dir)
+    rewrite = False
+    if root_folder:
+        sources = design_spectra_files(design, root_folder, local_input_type)
+        names = [source[len(root_folder) + 1 :] for source in sources]
+    else:
+        sources = design_file_names(design, False)
+        rewrite = is_expdesign(design)
+        names = [s.rstrip("/").rsplit("/", 1)[-1] for s in sources] if rewrite else design_file_names(design, True)
+        extensions = {name.rsplit(".", 1)[-1] for name in names if "." in name}
+        if len(extensions) != 1 or not all("." in name for name in names):
+            print(f"Not prefetching the spectra files, they have several extensions: {', '.join(sorted(extensions))}")
+            return None
+        local_input_type = extensions.pop()
+
+    staged: Dict[str, str] = {}
+    for source, name in zip(sources, names):
+        if not name or Path(name).is_absolute() or ".." in Path(name).parts:
+            print(f"Not prefetching the spectra files, {source} can not be staged as {name}")
+            return None
+        if staged.setdefault(name, source) != source:
+            print(f"Not prefetching the spectra files, {staged[name]} and {source} have the same name {name}")
+            return None
+
+    print(f"Prefetching {len(staged)} spectra files to {staging_dir} with {threads} threads")
+    errors, size = [], 0
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {
+            source: pool.submit(stage_file, source, staging_dir / name, fetch or fetch_file, size_of or file_size)
+            for name, source in staged.items()
+        }
+        for source, future in futures.items():
+            try:
+                size += future.result()
+            except Exception as e:
+                errors.append(f"{source}: {e}")
+    if errors:
+        print(f"Not prefetching the spectra files, {len(errors)} could not be staged:")
+        for error in errors:
+            print(f"  {error}")
+        return None
+
+    if rewrite:
+        design = rewrite_expdesign(design, staging_dir.with_name(f"{staging_dir.name}_{design.name}"))
+    print(f"Prefetched {len(staged)} spectra files, {size / 1024**3:.1f} GiB")
+    return StagedInputs(str(staging_dir), local_input_type, design, len(staged), size)
+
+
+def stage_file(source: str, target: Path, fetch: Fetch, size_of: Callable[[str], Optional[int]]) -> int:
+    """Fetches a spectra file to a path, unless a file of the size of the source is already there, and checks its
+    size. The file is fetched aside and moved in place once checked, and fetched again if the fetch fails or the size
+    is not that of the source.
+
+    :return: The size of the staged file
+    :rtype: int
+    """
+    expected = size_of(source)
+    if target.exists() and expected is not None and file_size(str(target)) == expected:
+        return expected
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(f"{target.name}.part")
+    for attempt in range(1, PREFETCH_ATTEMPTS + 1):
+        remove(partial)
+        try:
+            fetch(source, partial)
+        except Exception as e:
+            error = f"fetch failed: {e}"
+        else:
+            size = file_size(str(partial))
+            if size is not None and (expected is None or size == expected):
+                remove(target)
+                os.replace(partial, target)
+                for path in [target, *(target.rglob("*") if target.is_dir() else [])]:
+                    os.utime(path, (STAGED_MTIME, STAGED_MTIME), follow_symlinks=False)
+                return size
+            error = f"staged with {size} bytes instead of {expected}"
+        print(f"{source} {error} (attempt {attempt}/{PREFETCH_ATTEMPTS})")
+    remove(partial)
+    raise ValueError(error)
+
+
+def fetch_file(source: str, target: Path):
+    """Copies a local file or folder, or downloads an HTTP(S) or FTP resource, to a path."""
+    url = urlparse(source)
+    if url.scheme in ("http", "https"):
+        with requests.get(source, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(target, "wb") as f:
+                for block in response.iter_content(1 << 20):
+                    f.write(block)
+    elif url.scheme == "ftp":
+        with ftplib.FTP(url.hostname, timeout=60) as ftp, open(target, "wb") as f:
+            ftp.login()
+            ftp.retrbinary(f"RETR {url.path}", f.write, blocksize=1 << 20)
+    elif url.scheme in ("", "file"):
+        local = Path(url.path if url.scheme else source)
+        if local.is_dir():
+            shutil.copytree(local, target, symlinks=False)
+        else:
+            shutil.copyfile(local, target)
+    else:
+        raise ValueError(f"no way to fetch {url.scheme}:// files")
+
+
+def is_expdesign(design: Path) -> bool:
+    with open(design) as f:
+        return "spectra_filepath" in [c.strip().lower() for c in f.readline().split("\t")]
+
+
+def rewrite_expdesign(design: Path, out: Path) -> Path:
+    """Writes an experimental design with the Spectra_Filepath of its file table reduced to the file names, unless
+    they already are. The file is only written if its content changed, and gets the modification time of the staged
+    files, so the tasks reading it keep their hashes from one execution to the next.
+
+    :return: The path to the design to run, the given one if it was not rewritten
+    :rtype: pathlib.Path
+    """
+    with open(design, newline="") as f:
+        lines = f.read().splitlines(keepends=True)
+    column = [c.strip().lower() for c in lines[0].split("\t")].index("spectra_filepath")
+    rewritten: List[str] = [lines[0]]
+    in_file_table = True
+    for line in lines[1:]:
+        body = line.rstrip("\r\n")
+        in_file_table = in_file_table and bool(body.strip())
+        if in_file_table:
+            fields = body.split("\t")
+            fields[column] = fields[column].rstrip("/").rsplit("/", 1)[-1]
+            line = "\t".join(fields) + line[len(body) :]
+        rewritten.append(line)
+    content = "".join(rewritten).encode()
+    if content == "".join(lines).encode():
+        return design
+    if not out.exists() or out.read_bytes() != content:
+        out.write_bytes(content)
+    os.utime(out, (STAGED_MTIME, STAGED_MTIME))
+    return out
+
+
+def remove(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
@@ -0,0 +1,201 @@
+"""
+Plans the storage and the Nextflow head resources of a run from its design: the spectra files the SDRF or
+experimental design lists and their sizes. The working directory of a run keeps the outputs of every stage, so its
+peak usage is estimated as the inputs staged in it plus what each stage writes, in proportion to the inputs.
+"""
+import csv
+import ftplib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+GIB = 1024**3
+# Size assumed for a spectra file whose size could not be read
+DEFAULT_SPECTRA_FILE_GIB = 1.0
+# What each stage writes in the working directory, as a multiple of the size of its spectra files, by format, after
+# the remote spectra files are staged in it (local ones are linked). Coarse defaults: Thermo RAW files are about half
+# the size of their mzML, and the searches and the quantification write a fraction of the size of the spectra.
+STAGE_GROWTH: List[Tuple[str, Dict[str, float]]] = [
+    ("decompression", {"compressed": 2.0}),
+    ("conversion to mzML", {"raw": 2.0, "compressed": 2.0}),
+    ("spectra statistics", {"raw": 0.05, "mzml": 0.05, "d": 0.05, "compressed": 0.05}),
+    ("search and rescoring", {"raw": 0.3, "mzml": 0.15, "d": 0.3, "compressed": 0.3}),
+    ("quantification", {"raw": 0.3, "mzml": 0.15, "d": 0.3, "compressed": 0.3}),
+]
+# Margin over the estimated peak, and bounds of the shared volume requested
+STORAGE_MARGIN = 1.3
+MIN_STORAGE_GIB = 20
+MAX_STORAGE_GIB = 10240
+# Tasks of a run for each spectra file, and heap of the Nextflow head for them
+TASKS_PER_SPECTRA_FILE = 10
+MIN_HEAP_GIB = 2
+HEAP_GIB_PER_1000_TASKS = 0.2
+# Threads reading the sizes of remote files, mostly waiting on the network
+SIZE_THREADS = 16
+
+
+@dataclass
+class ResourcePlan:
+    """Estimate of the resources of a run.
+
+    :param files: Number of spectra files of the design
+    :type files: int
+    :param unknown_sizes: Number of spectra files whose size was assumed
+    :type unknown_sizes: int
+    :param stages: Size written by each stage in the working directory, in GiB
+    :type stages: list
+    :param storage_gib: Size of the shared volume to request
+    :type storage_gib: int
+    :param heap_gib: Heap the JVM of the Nextflow head needs, at least
+    :type heap_gib: int
+    """
+
+    files: int
+    unknown_sizes: int
+    stages: List[Tuple[str, float]] = field(default_factory=list)
+    storage_gib: int = MIN_STORAGE_GIB
+    heap_gib: int = MIN_HEAP_GIB
+
+    @property
+    def peak_gib(self) -> float:
+        return sum(size for _, size in self.stages)
+
+    def describe(self) -> str:
+        """The estimate stage by stage, to be logged."""
+        lines = [f"Resource plan for {self.files} spectra files ({self.unknown_sizes} of unknown size):"]
+        cumulative = 0.0
+        for stage, size in self.stages:
+            cumulative += size
+            lines.append(f"  {stage:<22} {size:10.1f} GiB, {cumulative:10.1f} GiB in the working directory")
+        lines.append(f"  peak {self.peak_gib:.1f} GiB, requesting {self.storage_gib} GiB of shared storage")
+        lines.append(
+            f"  Nextflow head: ~{self.files * TASKS_PER_SPECTRA_FILE} tasks, {self.heap_gib} GiB of heap needed"
+        )
+        return "\n".join(lines)
+
+
+def plan_resources(
+    design: os.PathLike,
+    root_folder: Optional[str] = None,
+    local_input_type: Optional[str] = None,
+    size_of: Optional[Callable[[str], Optional[int]]] = None,
+    manifest: Optional[os.PathLike] = None,
+) -> ResourcePlan:
+    """Plans the resources of a run from its design.
+
+    :param design: Path to the SDRF or experimental design
+    :type design: str
+    :param root_folder: Folder of the spectra files, as the root_folder parameter
+    :type root_folder: str
+    :param local_input_type: Extension of the spectra files in the root folder, as the local_input_type parameter
+    :type local_input_type: str
+    :param size_of: Size of a spectra file in bytes, None if unknown, ``file_size`` by default
+    :type size_of: callable
+    :param manifest: Manifest of the spectra files written by the pre-flight check of a previous run, whose
+        sizes are used instead of reading them again
+    :type manifest: str
+    """
+    paths = design_spectra_files(design, root_folder, local_input_type)
+    known = read_manifest_sizes(manifest) if manifest and Path(manifest).exists() else {}
+    missing = [p for p in dict.fromkeys(paths) if p not in known]
+    with ThreadPoolExecutor(max_workers=SIZE_THREADS) as pool:
+        known.update(zip(missing, pool.map(size_of or file_size, missing)))
+
+    input_gib: Dict[str, float] = {}
+    staged_gib, unknown = 0.0, 0
+    for path in paths:
+        size = known.get(path)
+        if size is None:
+            unknown += 1
+        gib = size / GIB if size is not None else DEFAULT_SPECTRA_FILE_GIB
+        fmt = spectra_format(path)
+        input_gib[fmt] = input_gib.get(fmt, 0.0) + gib
+        if urlparse(path).scheme not in ("", "file"):
+            staged_gib += gib
+
+    plan = plan_head(len(paths))
+    plan.unknown_sizes = unknown
+    plan.stages = [("staging", staged_gib)] + [
+        (stage, sum(growth.get(fmt, 0.0) * gib for fmt, gib in input_gib.items())) for stage, growth in STAGE_GROWTH
+    ]
+    plan.storage_gib = int(min(max(plan.peak_gib * STORAGE_MARGIN, MIN_STORAGE_GIB), MAX_STORAGE_GIB) + 0.5)
+    return plan
+
+
+def plan_head(files: int) -> ResourcePlan:
+    """Plans the heap the Nextflow head needs for a number of spectra files, which sets the number of tasks."""
+    tasks = files * TASKS_PER_SPECTRA_FILE
+    heap_gib = max(MIN_HEAP_GIB, int(MIN_HEAP_GIB + tasks / 1000 * HEAP_GIB_PER_1000_TASKS + 0.5))
+    return ResourcePlan(files=files, unknown_sizes=files, heap_gib=heap_gib)
+
+
+def design_spectra_files(
+    design: os.PathLike, root_folder: Optional[str] = None, local_input_type: Optional[str] = None
+) -> List[str]:
+    """Paths of the spectra files of an SDRF or experimental design, resolved as create_input_channel does."""
+    names = design_file_names(design, bool(root_folder))
+    if not root_folder:
+        return names
+    paths = [f"{root_folder}/{name}" for name in names]
+    if local_input_type:
+        paths = [f"{path[: path.rfind('.')]}.{local_input_type}" for path in paths]
+    return paths
+
+
+def design_file_names(design: os.PathLike, in_root_folder: bool) -> List[str]:
+    """The spectra files of an SDRF or experimental design as it lists them: the Spectra_Filepath of an experimental
+    design, and the data file names of an SDRF joined with a root folder, or its URIs without one."""
+    with open(design, newline="") as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    header = [c.strip().lower() for c in rows[0]]
+    if "spectra_filepath" in header:
+        column = header.index("spectra_filepath")
+        # The file table ends at the first blank line
+        end = next((i for i, row in enumerate(rows) if not any(c.strip() for c in row)), len(rows))
+        return [row[column] for row in rows[1:end]]
+    name = "comment[data file]" if in_root_folder else "comment[file uri]"
+    if name not in header:
+        raise ValueError(f"{name} column missed in the SDRF {design}")
+    return [row[header.index(name)] for row in rows[1:] if any(c.strip() for c in row)]
+
+
+def spectra_format(path: str) -> str:
+    """Format of a spectra file for the planning: raw, mzml, d or compressed."""
+    name = path.lower().rstrip("/")
+    if name.endswith((".tar", ".zip", ".gz")):
+        return "compressed"
+    return name.rsplit(".", 1)[-1] if name.endswith((".raw", ".mzml", ".d")) else "raw"
+
+
+def read_manifest_sizes(manifest: os.PathLike) -> Dict[str, int]:
+    """Sizes of the spectra files in a manifest written by ``check_samplesheet.py --PREFLIGHT``."""
+    with open(manifest, newline="") as f:
+        return {row["path"]: int(row["size_bytes"]) for row in csv.DictReader(f, delimiter="\t") if row["size_bytes"]}
+
+
+def file_size(path: str) -> Optional[int]:
+    """Size of a local file or of an HTTP(S) or FTP resource, None if it cannot be read."""
+    url = urlparse(path)
+    try:
+        if url.scheme in ("http", "https"):
+            response = requests.head(path, allow_redirects=True, timeout=30)
+            length = response.headers.get("Content-Length")
+            return int(length) if response.ok and length else None
+        if url.scheme == "ftp":
+            with ftplib.FTP(url.hostname, timeout=30) as ftp:
+                ftp.login()
+                ftp.voidcmd("TYPE I")
+                return ftp.size(url.path)
+        if url.scheme in ("", "file"):
+            local = Path(url.path if url.scheme else path)
+            if local.is_dir():
+                return sum(f.stat().st_size for f in local.rglob("*") if f.is_file())
+            return local.stat().st_size
+    except (OSError, ValueError, ftplib.Error, requests.RequestException):
+        return None
+    return None
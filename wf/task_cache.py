@@ -0,0 +1,340 @@
+"""
+Keeps the Nextflow work directory of a run between executions, so a run of the same experiment resumes its tasks
+instead of recomputing them. An entry of the cache is keyed by the content of the SDRF or experimental design and
+of the protein database. It also records the sizes of the spectra files, and is only restored when they are
+unchanged. An entry holds the task directories and the Nextflow cache database of the run, archived as a stream of
+tar parts, so neither saving nor restoring it needs more than one part of free space, and the line of the run in the
+Nextflow history, without which -resume does not find it. The least recently used entries are evicted when the
+cache grows over its size. The store of the cache is an object uploading, downloading, listing and deleting files
+under names, e.g. on Latch Data, or in a local directory with ``LocalCacheStore``.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Layout of the entries, part of their key
+TASK_CACHE_FORMAT = 2
+# Size of the tar parts an entry is archived in
+TASK_CACHE_PART_BYTES = 1024**3
+# Task directories of a work directory, <xx>/<hash>
+TASK_DIR = re.compile(r"[0-9a-f]{2}")
+
+
+class LocalCacheStore:
+    """A store of a task cache in a local directory, e.g. to stand in for a remote one.
+
+    :param root: Directory of the store, created if needed
+    :type root: str
+    """
+
+    def __init__(self, root: os.PathLike):
+        self.root = Path(root)
+
+    def upload(self, local: Path, name: str):
+        target = self.root / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=target.parent, suffix=".tmp", delete=False) as f:
+            tmp = Path(f.name)
+        shutil.copyfile(local, tmp)
+        os.replace(tmp, target)
+
+    def download(self, name: str, local: Path) -> bool:
+        """Downloads a file of the store, False if it has none of this name."""
+        if not (self.root / name).is_file():
+            return False
+        shutil.copyfile(self.root / name, local)
+        return True
+
+    def list(self) -> List[str]:
+        """Names of the top-level folders of the store."""
+        return sorted(p.name for p in self.root.iterdir() if p.is_dir()) if self.root.is_dir() else []
+
+    def delete(self, name: str):
+        """Deletes a file or a folder of the store."""
+        path = self.root / name
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+
+
+class TaskCache:
+    """Cache of the work directories of runs, keyed by their inputs, bounded in size.
+
+    :param store: Store of the entries, with the methods of ``LocalCacheStore``
+    :type store: LocalCacheStore
+    :param max_bytes: Size over which the least recently used entries are evicted
+    :type max_bytes: int
+    """
+
+    def __init__(self, store, max_bytes: int):
+        self.store = store
+        self.max_bytes = max_bytes
+
+    def entry(self, key: str) -> Optional[Dict]:
+        """The description of an entry, None if the cache has none of this key."""
+        with tempfile.TemporaryDirectory() as tmp:
+            local = Path(tmp) / "entry.json"
+            try:
+                if not self.store.download(f"{key}/entry.json", local):
+                    return None
+                return json.loads(local.read_text())
+            except (OSError, ValueError) as e:
+                print(f"Ignoring the unreadable task cache entry {key}: {e}")
+                return None
+
+    def restore(self, key: str, inputs: Dict, work_dir: Path) -> Optional[str]:
+        """Restores the entry of a key in a work directory, if its inputs are those given.
+
+        :param inputs: Hashes of the design and database and sizes of the spectra files, as from ``cache_inputs``
+        :type inputs: dict
+        :return: The session of the entry to resume, None if there is no valid entry
+        :rtype: str
+        """
+        entry = self.entry(key)
+        if entry is None:
+            print(f"No task cache entry {key}, running from scratch")
+            return None
+        changed = sorted(
+            name for name in set(inputs) | set(entry["inputs"]) if inputs.get(name) != entry["inputs"].get(name)
+        )
+        if changed:
+            print(
+                f"The inputs {', '.join(changed)} changed since task cache entry {key} was saved, running from scratch"
+            )
+            return None
+        print(f"Restoring task cache entry {key} ({entry['size_bytes'] / 1024**3:.1f} GiB)")
+        try:
+            with tarfile.open(
+                fileobj=PartReader(self.store, f"{key}/{entry['save']}", entry["parts"]), mode="r|"
+            ) as tar:
+                # Symbolic links to the inputs staged in other task directories are kept as they are
+                tar.extractall(work_dir, **({"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}))
+            # Nextflow only resumes a session listed in the history of the launch directory
+            add_history(work_dir, entry["session"], entry["history"])
+        except (OSError, tarfile.TarError) as e:
+            print(f"Could not restore task cache entry {key}, running from scratch: {e}")
+            return None
+        entry["last_used"] = time.time()
+        self._write_entry(key, entry)
+        return entry["session"]
+
+    def save(self, key: str, inputs: Dict, work_dir: Path) -> bool:
+        """Saves the task directories and the Nextflow cache of the last session of a work directory as the entry
+        of a key, then evicts the least recently used entries over the size of the cache.
+
+        :return: Whether the entry was saved
+        :rtype: bool
+        """
+        session = last_session(work_dir)
+        if session is None:
+            print("No Nextflow session in the work directory, nothing to save in the task cache")
+            return False
+        files = work_files(work_dir, session)
+        size = sum((work_dir / f).lstat().st_size for f in files)
+        if size > self.max_bytes:
+            print(f"The work directory ({size / 1024**3:.1f} GiB) is larger than the task cache, not saved")
+            return False
+
+        previous = self.entry(key)
+        save = uuid.uuid4().hex[:12]
+        print(f"Saving {len(files)} files ({size / 1024**3:.1f} GiB) as task cache entry {key}")
+        writer = PartWriter(self.store, f"{key}/{save}")
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
+            for f in files:
+                tar.add(work_dir / f, arcname=f, recursive=False)
+        writer.close()
+        now = time.time()
+        entry = {
+            "format": TASK_CACHE_FORMAT,
+            "key": key,
+            "session": session,
+            "history": session_history(work_dir, session),
+            "inputs": inputs,
+            "save": save,
+            "parts": writer.parts,
+            "size_bytes": writer.size,
+            "created": now,
+            "last_used": now,
+        }
+        # Written last, so the entry only points to complete parts
+        self._write_entry(key, entry)
+        if previous is not None and previous.get("save") != save:
+            self.store.delete(f"{key}/{previous['save']}")
+        self.evict(keep=key)
+        return True
+
+    def evict(self, keep: Optional[str] = None):
+        """Deletes the least recently used entries until the cache is within its size, except the entry ``keep``."""
+        entries = [e for e in (self.entry(k) for k in self.store.list()) if e is not None]
+        total = sum(e["size_bytes"] for e in entries)
+        for e in sorted(entries, key=lambda e: e["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if e["key"] == keep:
+                continue
+            print(f"Evicting task cache entry {e['key']} ({e['size_bytes'] / 1024**3:.1f} GiB)")
+            self.store.delete(e["key"])
+            total -= e["size_bytes"]
+
+    def _write_entry(self, key: str, entry: Dict):
+        with tempfile.TemporaryDirectory() as tmp:
+            local = Path(tmp) / "entry.json"
+            local.write_text(json.dumps(entry, indent=1))
+            self.store.upload(local, f"{key}/entry.json")
+
+
+class PartWriter(io.RawIOBase):
+    """A stream written as numbered parts of a store, each uploaded as soon as it is full."""
+
+    def __init__(self, store, prefix: str, part_bytes: int = TASK_CACHE_PART_BYTES):
+        self.store, self.prefix, self.part_bytes = store, prefix, part_bytes
+        self.parts, self.size = 0, 0
+        self._part = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        while view:
+            if self._part is None:
+                self._part = tempfile.NamedTemporaryFile("wb", suffix=".tar", delete=False)
+            n = min(len(view), self.part_bytes - self._part.tell())
+            self._part.write(view[:n])
+            view = view[n:]
+            if self._part.tell() >= self.part_bytes:
+                self._flush_part()
+        self.size += len(data)
+        return len(data)
+
+    def _flush_part(self):
+        self._part.close()
+        try:
+            self.store.upload(Path(self._part.name), f"{self.prefix}/part-{self.parts:05d}.tar")
+        finally:
+            os.unlink(self._part.name)
+        self._part = None
+        self.parts += 1
+
+    def close(self):
+        if self._part is not None:
+            self._flush_part()
+        super().close()
+
+
+class PartReader(io.RawIOBase):
+    """A stream read from the numbered parts of a store, each downloaded when reached and deleted once read."""
+
+    def __init__(self, store, prefix: str, parts: int):
+        self.store, self.prefix, self.parts = store, prefix, parts
+        self._index = 0
+        self._part = None
+        self._tmp = tempfile.TemporaryDirectory()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self._part is None:
+                if self._index >= self.parts:
+                    return 0
+                local = Path(self._tmp.name) / "part.tar"
+                if not self.store.download(f"{self.prefix}/part-{self._index:05d}.tar", local):
+                    raise FileNotFoundError(f"Part {self._index} of {self.prefix} missing from the task cache")
+                self._part = open(local, "rb")
+            n = self._part.readinto(buffer)
+            if n:
+                return n
+            self._part.close()
+            os.unlink(self._part.name)
+            self._part = None
+            self._index += 1
+
+    def close(self):
+        if self._part is not None:
+            self._part.close()
+        self._tmp.cleanup()
+        super().close()
+
+
+def file_sha256(path: os.PathLike) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_inputs(design: os.PathLike, database: os.PathLike, spectra_sizes: Dict[str, Optional[int]]) -> Dict:
+    """The inputs an entry of the cache is checked against: the hashes of the design and of the database, and the
+    sizes of the spectra files, by path."""
+    return {
+        "design": file_sha256(design),
+        "database": file_sha256(database),
+        "spectra": {path: spectra_sizes[path] for path in sorted(spectra_sizes)},
+    }
+
+
+def cache_key(inputs: Dict) -> str:
+    """The key of the entry of the cache of some inputs, the same for runs of the same design and database."""
+    return hashlib.sha256(f"{TASK_CACHE_FORMAT}:{inputs['design']}:{inputs['database']}".encode()).hexdigest()[:16]
+
+
+def history_rows(work_dir: Path) -> List[List[str]]:
+    """The runs of the history of Nextflow in the launch directory: date, duration, run name, status, revision,
+    session and command."""
+    history = work_dir / ".nextflow" / "history"
+    if not history.exists():
+        return []
+    with open(history, newline="") as f:
+        return [row for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE) if len(row) > 5]
+
+
+def last_session(work_dir: Path) -> Optional[str]:
+    """The session of the last run in the launch directory, from the history of Nextflow."""
+    rows = history_rows(work_dir)
+    return rows[-1][5] if rows else None
+
+
+def session_history(work_dir: Path, session: str) -> List[str]:
+    """The last run of a session in the history of Nextflow in the launch directory."""
+    return [row for row in history_rows(work_dir) if row[5] == session][-1]
+
+
+def add_history(work_dir: Path, session: str, row: List[str]):
+    """Adds a run of a session to the history of Nextflow in the launch directory, unless it lists the session."""
+    if any(r[5] == session for r in history_rows(work_dir)):
+        return
+    history = work_dir / ".nextflow" / "history"
+    history.parent.mkdir(parents=True, exist_ok=True)
+    with open(history, "a") as f:
+        f.write("\t".join(row) + "\n")
+
+
+def work_files(work_dir: Path, session: str) -> List[str]:
+    """The files of the task directories and of the Nextflow cache of a session, relative to the work directory,
+    each directory before its content."""
+    roots = [p for p in sorted(work_dir.iterdir()) if p.is_dir() and not p.is_symlink() and TASK_DIR.fullmatch(p.name)]
+    roots.append(work_dir / ".nextflow" / "cache" / session)
+    files = []
+    for root in roots:
+        if not root.exists():
+            continue
+        files.append(str(root.relative_to(work_dir)))
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for name in dir_names + sorted(file_names):
+                files.append(str((Path(dir_path) / name).relative_to(work_dir)))
+    return files
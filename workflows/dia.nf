@@ -9,6 +9,8 @@
 //
 include { GENERATE_DIANN_CFG as DIANNCFG } from '../modules/local/generate_diann_cfg/main'
 include { DIANNCONVERT                   } from '../modules/local/diannconvert/main'
+include { DIANNCONVERT_SHARD             } from '../modules/local/diannconvert_shard/main'
+include { DIANNCONVERT_MERGE             } from '../modules/local/diannconvert_merge/main'
 include { MSSTATS                        } from '../modules/local/msstats/main'
 include { DIANN_PRELIMINARY_ANALYSIS     } from '../modules/local/diann_preliminary_analysis/main'
 include { ASSEMBLE_EMPIRICAL_LIBRARY     } from '../modules/local/assemble_empirical_library/main'
@@ -107,24 +109,73 @@ workflow DIA {
                     INDIVIDUAL_FINAL_ANALYSIS.out.diann_quant.collect(), ch_searchdb)
     ch_software_versions = ch_software_versions.mix(DIANNSUMMARY.out.version.ifEmpty(null))
 
+    if (params.eager_cleanup) {
+        // The preliminary .quant files are only read by the assembly of the empirical library
+        ASSEMBLE_EMPIRICAL_LIBRARY.out.empirical_library
+            .combine(DIANN_PRELIMINARY_ANALYSIS.out.diann_quant)
+            .subscribe { library, quant -> WorkflowQuantms.deleteIntermediates(workflow, log, quant) }
+        // A spectra file is last read by the final analysis of its run, which comes after the assembly, once the
+        // statistics of all the spectra files are computed. The summary only reads the names of the files.
+        ch_file_preparation_results
+            .map { meta, ms_file -> [file(ms_file).baseName, ms_file] }
+            .join(INDIVIDUAL_FINAL_ANALYSIS.out.log.map { final_log -> [final_log.name - '_final_diann.log', final_log] })
+            .combine(ch_ms_info.count())
+            .subscribe { name, ms_file, final_log, statistics ->
+                WorkflowQuantms.deleteIntermediates(workflow, log, ms_file)
+            }
+        // The final .quant files are only read by the summary
+        DIANNSUMMARY.out.main_report
+            .combine(INDIVIDUAL_FINAL_ANALYSIS.out.diann_quant)
+            .subscribe { report, quant -> WorkflowQuantms.deleteIntermediates(workflow, log, quant) }
+    }
+
     //
     // MODULE: DIANNCONVERT
     //
-    DIANNCONVERT(
-        DIANNSUMMARY.out.main_report, ch_expdesign,
-        DIANNSUMMARY.out.pg_matrix,
-        DIANNSUMMARY.out.pr_matrix, ch_ms_info,
-        meta,
-        ch_searchdb,
-        DIANNSUMMARY.out.version
-    )
-    ch_software_versions = ch_software_versions.mix(DIANNCONVERT.out.version.ifEmpty(null))
+    if (params.diannconvert_shards > 1) {
+        // Fan out the conversion over shards of runs and fan in the partial results,
+        // so no single task has to hold the whole report in memory.
+        Channel.of(0..<params.diannconvert_shards)
+            .combine(DIANNSUMMARY.out.main_report)
+            .combine(ch_expdesign)
+            .set { ch_convert_shards }
+        DIANNCONVERT_SHARD(
+            ch_convert_shards,
+            ch_ms_info.first(),
+            meta.first(),
+            ch_searchdb.first(),
+            DIANNSUMMARY.out.version.first()
+        )
+        DIANNCONVERT_MERGE(
+            DIANNCONVERT_SHARD.out.shard.collect(), ch_expdesign,
+            DIANNSUMMARY.out.pg_matrix,
+            DIANNSUMMARY.out.pr_matrix,
+            meta,
+            ch_searchdb,
+            DIANNSUMMARY.out.version
+        )
+        ch_software_versions = ch_software_versions.mix(DIANNCONVERT_MERGE.out.version.ifEmpty(null))
+        ch_out_msstats = DIANNCONVERT_MERGE.out.out_msstats
+        ch_out_triqler = DIANNCONVERT_MERGE.out.out_triqler
+    } else {
+        DIANNCONVERT(
+            DIANNSUMMARY.out.main_report, ch_expdesign,
+            DIANNSUMMARY.out.pg_matrix,
+            DIANNSUMMARY.out.pr_matrix, ch_ms_info,
+            meta,
+            ch_searchdb,
+            DIANNSUMMARY.out.version
+        )
+        ch_software_versions = ch_software_versions.mix(DIANNCONVERT.out.version.ifEmpty(null))
+        ch_out_msstats = DIANNCONVERT.out.out_msstats
+        ch_out_triqler = DIANNCONVERT.out.out_triqler
+    }
 
     //
     // MODULE: MSSTATS
     ch_msstats_out = Channel.empty()
     if (!params.skip_post_msstats) {
-        MSSTATS(DIANNCONVERT.out.out_msstats)
+        MSSTATS(ch_out_msstats)
         ch_msstats_out = MSSTATS.out.msstats_csv
         ch_software_versions = ch_software_versions.mix(MSSTATS.out.version.ifEmpty(null))
     }
@@ -132,8 +183,8 @@ workflow DIA {
     emit:
     versions        = ch_software_versions
     diann_report    = DIANNSUMMARY.out.main_report
-    msstats_in      = DIANNCONVERT.out.out_msstats
-    out_triqler     = DIANNCONVERT.out.out_triqler
+    msstats_in      = ch_out_msstats
+    out_triqler     = ch_out_triqler
     msstats_out     = ch_msstats_out
 }
 